@@ -0,0 +1,319 @@
+# -*- coding:utf-8 -*-
+"""
+Embedding tables kept on disk, with the hot rows cached on the training device.
+
+The rows of a ``CachedEmbedding`` live in a memory-mapped ``.npy`` file. Only ``capacity`` of them are resident, in a
+trainable ``(capacity, embedding_dim)`` weight: a lookup admits the missing rows, evicting the least recently (or
+least frequently) used ones, and evicted rows that were trained are written back to the file by a background thread.
+The rows a training step has looked up stay resident until the optimizer steps, since their gradients are kept by slot.
+``prefetch`` starts reading the rows of an upcoming batch in that same thread.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+TABLE_DTYPE = np.float32
+
+
+def create_table_file(path, num_embeddings, embedding_dim, init_std=0.0001, seed=1024, chunk_rows=1 << 20):
+    """Create the backing file of a table without materializing it: rows drawn from N(0, init_std) chunk by chunk."""
+    table = np.lib.format.open_memmap(path, mode="w+", dtype=TABLE_DTYPE, shape=(num_embeddings, embedding_dim))
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_embeddings, chunk_rows):
+        stop = min(start + chunk_rows, num_embeddings)
+        table[start:stop] = rng.normal(0, init_std, (stop - start, embedding_dim))
+    table.flush()
+    del table
+    return path
+
+
+class CachedEmbedding(nn.Module):
+    """Drop-in for ``nn.Embedding`` in ``embedding_dict`` whose table is the ``.npy`` file at `path`.
+
+    The file is the table: the module holds the ``capacity`` resident rows in ``weight``, which the optimizer
+    trains, and writes them back when they are evicted or on ``flush``. Call ``flush`` before copying the file, and
+    ``register_optimizer`` so that the optimizer state of a slot is reset when the slot gets another row, and so that
+    the slots looked up with grad enabled are pinned until the optimizer steps: a model such as DIN looks the same
+    table up twice per forward pass, and the second lookup must not take the slot of a row the first one put in the
+    graph. Without a registered optimizer, call ``end_step`` after each optimizer step.
+
+    Args:
+        path: str, ``.npy`` file of shape ``(num_embeddings, embedding_dim)``, see ``create_table_file``
+        capacity: int, number of resident rows. A training step, from one optimizer step to the next, must not look
+            up more distinct ids.
+        policy: str, ``"lru"`` or ``"lfu"``, which resident rows are evicted first
+        sparse: bool, as ``nn.Embedding.sparse``
+        device: str, device of the resident rows
+    """
+
+    def __init__(self, path, capacity, policy="lru", sparse=False, device="cpu"):
+        super(CachedEmbedding, self).__init__()
+        if policy not in ("lru", "lfu"):
+            raise ValueError("policy must be 'lru' or 'lfu'")
+        self.path = path
+        self.policy = policy
+        self.sparse = sparse
+        self._open()
+        self.num_embeddings, self.embedding_dim = self._table.shape
+        self.capacity = min(capacity, self.num_embeddings)
+        self.weight = nn.Parameter(torch.zeros(self.capacity, self.embedding_dim, device=device))
+
+        # slot bookkeeping, on the host
+        self._slot_of = np.full(self.num_embeddings, -1, dtype=np.int64)
+        self._id_of = np.full(self.capacity, -1, dtype=np.int64)
+        self._last_used = np.zeros(self.capacity, dtype=np.int64)
+        self._hits = np.zeros(self.capacity, dtype=np.int64)
+        self._dirty = np.zeros(self.capacity, dtype=bool)
+        self._pinned = np.zeros(self.capacity, dtype=bool)
+        self._step = 0
+
+    @classmethod
+    def from_embedding(cls, embedding, path, capacity, chunk_rows=1 << 20, **kwargs):
+        """Write the weights of an ``nn.Embedding`` to `path` and return the ``CachedEmbedding`` over them."""
+        weight = embedding.weight.detach()
+        table = np.lib.format.open_memmap(path, mode="w+", dtype=TABLE_DTYPE, shape=tuple(weight.shape))
+        for start in range(0, weight.shape[0], chunk_rows):
+            table[start:start + chunk_rows] = weight[start:start + chunk_rows].cpu().numpy()
+        table.flush()
+        del table
+        kwargs.setdefault("sparse", embedding.sparse)
+        kwargs.setdefault("device", weight.device)
+        return cls(path, capacity, **kwargs)
+
+    def _open(self):
+        self._table = np.load(self.path, mmap_mode="r+")
+        # one worker: reads and writes reach the file in submission order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._pending = {}  # id -> (rows, i) of a write not done yet
+        self._writes = []
+        self._staged = OrderedDict()  # id -> row read by prefetch
+        self._prefetches = []  # (future, ids, ids written since submission)
+        self._optimizers = []
+        self._step_hooks = []
+
+    def forward(self, ids):
+        flat = ids.reshape(-1).cpu().numpy()
+        unique, inverse = np.unique(flat, return_inverse=True)
+        if len(unique) > self.capacity and not torch.is_grad_enabled():
+            # e.g. scoring a whole catalog: read through without admitting
+            return self._read_through(unique)[torch.from_numpy(inverse).to(self.weight.device)].reshape(
+                *ids.shape, self.embedding_dim)
+        slots = self.admit(unique)
+        slot_ids = torch.from_numpy(slots[inverse]).to(ids.device).reshape(ids.shape)
+        return F.embedding(slot_ids, self.weight, sparse=self.sparse)
+
+    def admit(self, unique):
+        """Make the distinct ids `unique` resident and return their slots."""
+        if len(unique) > self.capacity:
+            raise ValueError("a batch looks up %d distinct ids of %s, more than the capacity %d" % (
+                len(unique), self.path, self.capacity))
+        self._step += 1
+        slots = self._slot_of[unique]
+        missing = slots < 0
+        if missing.any():
+            new_slots = self._free_slots(int(missing.sum()), keep=slots[~missing])
+            rows = self._read_rows(unique[missing])
+            new_slot_ids = torch.from_numpy(new_slots).to(self.weight.device)
+            with torch.no_grad():
+                self.weight.index_copy_(0, new_slot_ids, torch.from_numpy(rows).to(self.weight.device))
+            self._reset_optimizer_state(new_slot_ids)
+            self._id_of[new_slots] = unique[missing]
+            self._slot_of[unique[missing]] = new_slots
+            self._hits[new_slots] = 0
+            slots[missing] = new_slots
+        self._last_used[slots] = self._step
+        self._hits[slots] += 1
+        if torch.is_grad_enabled():
+            # the optimizer may update them from now on, and their gradients are kept by slot until it does
+            self._dirty[slots] = True
+            self._pinned[slots] = True
+        return slots
+
+    def end_step(self):
+        """Release the slots pinned by the lookups of the training step. Called when a registered optimizer steps."""
+        self._pinned[:] = False
+
+    def prefetch(self, ids):
+        """Hint that `ids` will be looked up soon: the rows not resident are read from disk in the background."""
+        ids = np.unique(np.asarray(ids.cpu() if torch.is_tensor(ids) else ids).reshape(-1))
+        ids = ids[self._slot_of[ids] < 0]
+        with self._lock:
+            ids = np.array([row_id for row_id in ids.tolist() if row_id not in self._staged], dtype=np.int64)
+            if len(ids) == 0:
+                return
+            future = self._executor.submit(self._table.__getitem__, ids)
+            self._prefetches.append((future, ids, set()))
+
+    def flush(self):
+        """Write every trained resident row back and wait until the file holds them."""
+        dirty = np.flatnonzero(self._dirty)
+        if len(dirty):
+            self._write(self._id_of[dirty], self.weight.detach()[torch.from_numpy(dirty).to(
+                self.weight.device)].cpu().numpy())
+            self._dirty[dirty] = False
+        for future in self._writes:
+            future.result()
+        self._writes = []
+        self._executor.submit(self._table.flush).result()
+
+    def register_optimizer(self, optimizer):
+        """Reset the state `optimizer` keeps for a slot whenever the slot gets another row. Accepts an optimizer or
+        an object with an ``optimizers`` list, such as ``SparseDenseOptimizer``. The step of an optimizer that trains
+        ``weight`` also calls ``end_step``."""
+        for optim in getattr(optimizer, "optimizers", [optimizer]):
+            if optim not in self._optimizers:
+                self._optimizers.append(optim)
+                if any(param is self.weight for group in optim.param_groups for param in group["params"]):
+                    self._step_hooks.append(optim.register_step_post_hook(lambda *args: self.end_step()))
+
+    def _free_slots(self, count, keep):
+        free = np.flatnonzero(self._id_of < 0)[:count]
+        need = count - len(free)
+        if need == 0:
+            return free
+        score = (self._hits if self.policy == "lfu" else self._last_used).astype(np.float64)
+        score[keep] = np.inf
+        score[free] = np.inf
+        score[self._pinned] = np.inf
+        if need > np.isfinite(score).sum():
+            raise ValueError("the training step looks up more distinct ids of %s than the capacity %d since the last "
+                             "optimizer step" % (self.path, self.capacity))
+        victims = np.argpartition(score, need - 1)[:need]
+        self._evict(victims)
+        return np.concatenate([free, victims])
+
+    def _evict(self, slots):
+        dirty = slots[self._dirty[slots]]
+        if len(dirty):
+            self._write(self._id_of[dirty], self.weight.detach()[torch.from_numpy(dirty).to(
+                self.weight.device)].cpu().numpy())
+        self._slot_of[self._id_of[slots]] = -1
+        self._id_of[slots] = -1
+        self._dirty[slots] = False
+
+    def _write(self, ids, rows):
+        with self._lock:
+            for i, row_id in enumerate(ids.tolist()):
+                self._pending[row_id] = (rows, i)
+                self._staged.pop(row_id, None)
+                for _, _, written in self._prefetches:
+                    written.add(row_id)
+        # raise the error of a failed write, and forget the finished ones
+        for future in self._writes:
+            if future.done():
+                future.result()
+        self._writes = [future for future in self._writes if not future.done()]
+        self._writes.append(self._executor.submit(self._write_rows, ids, rows))
+
+    def _write_rows(self, ids, rows):
+        self._table[ids] = rows
+        with self._lock:
+            for row_id in ids.tolist():
+                if self._pending.get(row_id, (None,))[0] is rows:
+                    del self._pending[row_id]
+
+    def _read_rows(self, ids):
+        rows = np.empty((len(ids), self.embedding_dim), dtype=TABLE_DTYPE)
+        from_disk = np.ones(len(ids), dtype=bool)
+        self._collect_prefetches()
+        with self._lock:
+            if self._pending or self._staged:
+                for i, row_id in enumerate(ids.tolist()):
+                    if row_id in self._pending:
+                        written, j = self._pending[row_id]
+                        rows[i] = written[j]
+                        from_disk[i] = False
+                    elif row_id in self._staged:
+                        rows[i] = self._staged.pop(row_id)
+                        from_disk[i] = False
+        if from_disk.any():
+            rows[from_disk] = self._table[ids[from_disk]]
+        return rows
+
+    def _read_through(self, unique):
+        slots = self._slot_of[unique]
+        resident = slots >= 0
+        out = torch.empty(len(unique), self.embedding_dim, device=self.weight.device)
+        out[torch.from_numpy(np.flatnonzero(resident)).to(out.device)] = self.weight[
+            torch.from_numpy(slots[resident]).to(out.device)]
+        out[torch.from_numpy(np.flatnonzero(~resident)).to(out.device)] = torch.from_numpy(
+            self._read_rows(unique[~resident])).to(out.device)
+        return out
+
+    def _collect_prefetches(self):
+        remaining = []
+        for future, ids, written in self._prefetches:
+            if not future.done():
+                remaining.append((future, ids, written))
+                continue
+            rows = future.result()
+            with self._lock:
+                for i, row_id in enumerate(ids.tolist()):
+                    if row_id not in written and self._slot_of[row_id] < 0:
+                        self._staged[row_id] = rows[i]
+        self._prefetches = remaining
+        with self._lock:
+            while len(self._staged) > self.capacity:
+                self._staged.popitem(last=False)
+
+    def _reset_optimizer_state(self, slots):
+        for optim in self._optimizers:
+            state = optim.state.get(self.weight)
+            if not state:
+                continue
+            for value in state.values():
+                if torch.is_tensor(value) and value.dim() > 0 and value.shape[0] == self.capacity:
+                    value.index_fill_(0, slots.to(value.device), 0)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(CachedEmbedding, self)._save_to_state_dict(destination, prefix, keep_vars)
+        # which row every slot holds: the weight alone is meaningless
+        destination[prefix + "slot_ids"] = torch.from_numpy(self._id_of.copy())
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        slot_ids = state_dict.get(prefix + "slot_ids")
+        if slot_ids is not None:
+            # keep the rows trained so far before the resident set is replaced
+            self.flush()
+        super(CachedEmbedding, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                           unexpected_keys, error_msgs)
+        if prefix + "slot_ids" in unexpected_keys:
+            unexpected_keys.remove(prefix + "slot_ids")
+        if slot_ids is None:
+            if strict:
+                missing_keys.append(prefix + "slot_ids")
+            return
+        self._slot_of[:] = -1
+        self._id_of[:] = slot_ids.cpu().numpy()
+        resident = np.flatnonzero(self._id_of >= 0)
+        self._slot_of[self._id_of[resident]] = resident
+        self._last_used[:] = 0
+        self._hits[:] = 0
+        # the loaded rows may differ from the file
+        self._dirty[:] = self._id_of >= 0
+        self._pinned[:] = False
+        with self._lock:
+            self._staged.clear()
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        for key in ("_table", "_executor", "_lock", "_pending", "_writes", "_staged", "_prefetches", "_optimizers",
+                    "_step_hooks"):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        super(CachedEmbedding, self).__setstate__(state)
+        self._open()
+
+    def extra_repr(self):
+        return "%d, %d, capacity=%d, policy=%s, path=%s" % (self.num_embeddings, self.embedding_dim, self.capacity,
+                                                             self.policy, self.path)
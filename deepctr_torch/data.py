@@ -0,0 +1,506 @@
+# -*- coding:utf-8 -*-
+"""
+Data structures used to feed the per-user Smooth-AUC training loop.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class UserInteractionIndex(object):
+    """CSR index of the training positives of every user.
+
+    Row ``r`` describes user ``user_ids[r]``, whose positive items are ``items[indptr[r]:indptr[r + 1]]``.
+    The arrays are built once and kept as (pinned, when CUDA is available) torch tensors, so looking up a
+    user's positives is a zero-copy slice.
+
+    :param user_ids: 1D array-like, the user id of every row.
+    :param indptr: 1D array-like of length ``len(user_ids) + 1``, the row offsets into ``items``.
+    :param items: 1D array-like, the positive item ids of all users concatenated row by row.
+    :param user_col: str, name of the user id feature in the model input.
+    :param item_col: str, name of the item id feature in the model input.
+    :param source_rows: 1D array-like or None, aligned with ``items``: the row of every positive in the table the
+        index was built from, where the other input features of the positive are found.
+    """
+
+    def __init__(self, user_ids, indptr, items, user_col="userInt", item_col="newsInt", source_rows=None):
+        self.user_ids = torch.from_numpy(np.ascontiguousarray(user_ids, dtype=np.int64))
+        self.indptr = torch.from_numpy(np.ascontiguousarray(indptr, dtype=np.int64))
+        self.items = torch.from_numpy(np.ascontiguousarray(items, dtype=np.int32))
+        self.source_rows = None if source_rows is None else torch.from_numpy(
+            np.ascontiguousarray(source_rows, dtype=np.int64))
+        self.user_col = user_col
+        self.item_col = item_col
+        if self.indptr.shape[0] != self.user_ids.shape[0] + 1:
+            raise ValueError("indptr must have len(user_ids) + 1 entries, got %d for %d users" % (
+                self.indptr.shape[0], self.user_ids.shape[0]))
+        if self.source_rows is not None and self.source_rows.shape != self.items.shape:
+            raise ValueError("source_rows must have one entry per item, got %d for %d items" % (
+                self.source_rows.shape[0], self.items.shape[0]))
+        if torch.cuda.is_available():
+            self.user_ids = self.user_ids.pin_memory()
+            self.indptr = self.indptr.pin_memory()
+            self.items = self.items.pin_memory()
+            if self.source_rows is not None:
+                self.source_rows = self.source_rows.pin_memory()
+
+    @classmethod
+    def from_user_list(cls, user_list, train_data, user_col="userInt", item_col="newsInt"):
+        """Build the index from the ``(user, start, end)`` tuples of ``train3.pickle`` and the rows of
+        ``train_data1.csv`` they point to.
+
+        :param user_list: list of ``(user, start, end)`` tuples, ``train_data[start:end]`` are the user's positives.
+        :param train_data: DataFrame (or 1D array of item ids) holding the training positives.
+        """
+        if hasattr(train_data, "columns"):
+            train_data = train_data[item_col].to_numpy()
+        item_values = np.asarray(train_data)
+        user_list = np.asarray(user_list, dtype=np.int64).reshape(-1, 3)
+        user_ids, starts, ends = user_list[:, 0], user_list[:, 1], user_list[:, 2]
+        lengths = ends - starts
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        # position of every positive in train_data, row by row
+        row_index = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1], dtype=np.int64)
+        return cls(user_ids, indptr, item_values[row_index], user_col=user_col, item_col=item_col,
+                   source_rows=row_index)
+
+    @classmethod
+    def from_interactions(cls, users, items, user_col="userInt", item_col="newsInt"):
+        """Build the index from parallel arrays of (user, item) positive pairs in any order.
+        Rows are ordered by user id; the item order of each user is preserved."""
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items)
+        order = np.argsort(users, kind="stable")
+        user_ids, lengths = np.unique(users[order], return_counts=True)
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        return cls(user_ids, indptr, items[order], user_col=user_col, item_col=item_col, source_rows=order)
+
+    def __len__(self):
+        return self.user_ids.shape[0]
+
+    @property
+    def lengths(self):
+        return self.indptr[1:] - self.indptr[:-1]
+
+    def positives(self, row):
+        """Return the positive items of row ``row`` as a view into ``items``."""
+        return self.items[self.indptr[row]:self.indptr[row + 1]]
+
+    def rows_of(self, user_ids):
+        """Map user ids to row numbers, ``-1`` for users without a row.
+
+        :param user_ids: 1D array-like of user ids.
+        :return: 1D LongTensor of row numbers.
+        """
+        user_ids = torch.as_tensor(np.asarray(user_ids), dtype=torch.int64).reshape(-1)
+        if len(self) == 0:
+            return torch.full_like(user_ids, -1)
+        order = torch.argsort(self.user_ids)
+        sorted_ids = self.user_ids[order]
+        pos = torch.searchsorted(sorted_ids, user_ids).clamp(max=len(self) - 1)
+        return torch.where(sorted_ids[pos] == user_ids, order[pos], torch.full_like(pos, -1))
+
+    def gather(self, rows):
+        """Gather the positives of several rows at once.
+
+        :param rows: 1D LongTensor of row numbers.
+        :return: ``(user_ids, items, lengths)``: the user id of every row, their positives concatenated in row
+            order (int64) and the number of positives of every row.
+        """
+        rows = torch.as_tensor(rows, dtype=torch.int64)
+        item_index, lengths = self._positions(rows)
+        return self.user_ids[rows], self.items[item_index].long(), lengths
+
+    def gather_source_rows(self, rows):
+        """``source_rows`` of the positives of several rows, in the order of ``gather``."""
+        if self.source_rows is None:
+            raise ValueError("the index was built without source rows")
+        item_index, _ = self._positions(torch.as_tensor(rows, dtype=torch.int64))
+        return self.source_rows[item_index]
+
+    def _positions(self, rows):
+        starts = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        offsets = torch.cumsum(lengths, dim=0) - lengths
+        item_index = torch.repeat_interleave(starts - offsets, lengths) + torch.arange(
+            int(lengths.sum()), dtype=torch.int64)
+        return item_index, lengths
+
+
+def build_alias_table(weights):
+    """Build Walker/Vose alias tables for drawing from a discrete distribution in O(1) per sample.
+
+    :param weights: 1D array of non-negative weights.
+    :return: ``(prob, alias)``: slot ``i`` is kept with probability ``prob[i]`` and replaced by ``alias[i]`` otherwise.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.ndim != 1 or len(weights) == 0 or weights.sum() <= 0:
+        raise ValueError("weights must be a non-empty 1D array with a positive sum")
+    n = len(weights)
+    prob = weights * n / weights.sum()
+    alias = np.arange(n, dtype=np.int64)
+    small = list(np.flatnonzero(prob < 1.0))
+    large = list(np.flatnonzero(prob >= 1.0))
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] = prob[l] + prob[s] - 1.0
+        if prob[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # whatever is left only differs from 1 by rounding error
+    prob[small + large] = 1.0
+    return prob, alias
+
+
+class NegativeSampler(object):
+    """Draws negative items for a batch of users of a ``UserInteractionIndex`` in one vectorised call.
+
+    Candidates are drawn for every negative slot of the batch at once. Slots that hit one of the user's positives
+    are found with a single ``searchsorted`` against the sorted ``(row, item)`` keys of the index, and only those
+    slots are redrawn.
+
+    :param interaction_index: ``UserInteractionIndex``, the positives to exclude.
+    :param num_items: int, items are drawn from ``[0, num_items)``.
+    :param mode: str, ``"uniform"`` or ``"popularity"`` (proportional to ``count ** popularity_power`` in the index).
+    :param neg_ratio: float, number of negatives drawn per positive of a user (at least one negative per user).
+    :param popularity_power: float, exponent applied to the item counts in ``"popularity"`` mode.
+    :param seed: int or None, seed of the sampler's own random generator.
+    :param max_rounds: int, give up after this many redraw rounds (e.g. a user owning almost every item).
+    :param item_counts: 1D array or None, item counts of the popularity distribution. Defaults to the counts in
+        `interaction_index`; pass the global counts when the index only holds a shard of the users.
+    """
+
+    def __init__(self, interaction_index, num_items, mode="uniform", neg_ratio=1, popularity_power=1.0, seed=None,
+                 max_rounds=100, item_counts=None):
+        if mode not in ("uniform", "popularity"):
+            raise ValueError("mode must be uniform or popularity, got %s" % mode)
+        if neg_ratio <= 0:
+            raise ValueError("neg_ratio must be positive, got %s" % neg_ratio)
+        self.index = interaction_index
+        self.num_items = num_items
+        self.mode = mode
+        self.neg_ratio = neg_ratio
+        self.max_rounds = max_rounds
+        self.rng = np.random.default_rng(seed)
+
+        indptr = interaction_index.indptr.numpy()
+        items = interaction_index.items.numpy().astype(np.int64)
+        self._lengths = np.diff(indptr)
+        self._key_base = max(num_items, int(items.max()) + 1 if len(items) else 0)
+        rows = np.repeat(np.arange(len(self._lengths), dtype=np.int64), self._lengths)
+        # rows are ascending, so sorting the keys only reorders items inside each row
+        self._keys = np.sort(rows * self._key_base + items)
+
+        if mode == "popularity":
+            if item_counts is None:
+                counts = np.bincount(items[items < num_items], minlength=num_items).astype(np.float64)
+            else:
+                counts = np.asarray(item_counts, dtype=np.float64)[:num_items]
+            self._prob, self._alias = build_alias_table(counts ** popularity_power)
+
+    def seed(self, seed):
+        self.rng = np.random.default_rng(seed)
+
+    def _draw(self, size):
+        if self.mode == "uniform":
+            return self.rng.integers(0, self.num_items, size=size, dtype=np.int64)
+        slot = self.rng.integers(0, self.num_items, size=size, dtype=np.int64)
+        keep = self.rng.random(size) < self._prob[slot]
+        return np.where(keep, slot, self._alias[slot])
+
+    def is_positive(self, rows, items):
+        """Vectorised membership test: whether ``items[k]`` is a positive of row ``rows[k]``."""
+        keys = np.asarray(rows, dtype=np.int64) * self._key_base + np.asarray(items, dtype=np.int64)
+        pos = np.searchsorted(self._keys, keys)
+        pos = np.minimum(pos, len(self._keys) - 1)
+        return self._keys[pos] == keys if len(self._keys) else np.zeros(len(keys), dtype=bool)
+
+    def sample(self, rows):
+        """Draw the negatives of a batch of index rows.
+
+        :param rows: 1D array-like of row numbers of the interaction index.
+        :return: ``(neg_items, neg_lengths)``: int64 tensors with the negatives of all rows concatenated in row
+            order, and the number of negatives of every row.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        neg_lengths = np.maximum(np.round(self._lengths[rows] * self.neg_ratio), 1).astype(np.int64)
+        slot_rows = np.repeat(rows, neg_lengths)
+        neg_items = self._draw(len(slot_rows))
+        todo = np.arange(len(slot_rows))
+        for _ in range(self.max_rounds):
+            todo = todo[self.is_positive(slot_rows[todo], neg_items[todo])]
+            if len(todo) == 0:
+                break
+            neg_items[todo] = self._draw(len(todo))
+        else:
+            raise RuntimeError("could not draw negatives for %d slots after %d rounds" % (len(todo), self.max_rounds))
+        return torch.from_numpy(neg_items), torch.from_numpy(neg_lengths)
+
+
+class SAUCBatchDataset(IterableDataset):
+    """Iterable dataset yielding fully materialised Smooth-AUC training batches.
+
+    Every item is one batch ``(user_ids, pos_items, pos_lengths, neg_items, neg_lengths)`` of int64 tensors, the
+    positives and negatives being concatenated user by user. Wrap it in a ``DataLoader(batch_size=None,
+    num_workers=n, pin_memory=True)`` so that batches are built in worker processes while the model trains.
+
+    With `source_rows`, every batch also carries ``(pos_rows, neg_rows)``: the ``source_rows`` of the positives,
+    and for every negative those of a positive of the same user (cycling through them), whose other input features
+    it reuses.
+
+    Batch ``b`` of epoch ``e`` is always built by worker ``b % num_workers`` with a negative sampling stream seeded
+    by ``(seed, e, b)``, and the ``DataLoader`` returns worker outputs round robin, so the batches of a run do not
+    depend on the number of workers.
+
+    :param interaction_index: ``UserInteractionIndex``, the users to iterate over.
+    :param neg_sampler: ``NegativeSampler`` built on `interaction_index`.
+    :param batch_size: int, number of users per batch.
+    :param shuffle: bool, whether to shuffle the users at every epoch.
+    :param seed: int or None, base seed of the epoch permutations and sampling streams. Drawn from `neg_sampler` if None.
+    :param source_rows: bool, whether to add the source rows of the positives and negatives to the batches.
+    """
+
+    def __init__(self, interaction_index, neg_sampler, batch_size, shuffle=True, seed=None, source_rows=False):
+        super(SAUCBatchDataset, self).__init__()
+        if source_rows and interaction_index.source_rows is None:
+            raise ValueError("the interaction index was built without source rows")
+        self.index = interaction_index
+        self.neg_sampler = neg_sampler
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.source_rows = source_rows
+        self.seed = int(neg_sampler.rng.integers(2 ** 63)) if seed is None else seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return (len(self.index) - 1) // self.batch_size + 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        if self.shuffle:
+            rows = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.index))
+        else:
+            rows = np.arange(len(self.index))
+        for batch_no in range(worker_id, len(self), num_workers):
+            batch_rows = rows[batch_no * self.batch_size:(batch_no + 1) * self.batch_size]
+            self.neg_sampler.seed([self.seed, self.epoch, batch_no])
+            user_ids, pos_items, pos_lengths = self.index.gather(torch.from_numpy(batch_rows))
+            neg_items, neg_lengths = self.neg_sampler.sample(batch_rows)
+            if self.source_rows:
+                pos_rows = self.index.gather_source_rows(torch.from_numpy(batch_rows))
+                yield user_ids, pos_items, pos_lengths, neg_items, neg_lengths, pos_rows, \
+                    _negative_source_rows(pos_rows, pos_lengths, neg_lengths)
+            else:
+                yield user_ids, pos_items, pos_lengths, neg_items, neg_lengths
+
+
+def _negative_source_rows(pos_rows, pos_lengths, neg_lengths):
+    # negative k of a user takes the row of its positive k modulo the number of positives
+    pos_offsets = torch.cumsum(pos_lengths, dim=0) - pos_lengths
+    neg_offsets = torch.cumsum(neg_lengths, dim=0) - neg_lengths
+    rank = torch.arange(int(neg_lengths.sum()), dtype=torch.int64) - torch.repeat_interleave(neg_offsets, neg_lengths)
+    slots = torch.repeat_interleave(pos_lengths.clamp(min=1), neg_lengths)
+    return pos_rows[torch.repeat_interleave(pos_offsets, neg_lengths) + rank % slots]
+
+
+SHARD_FORMAT_VERSION = 1
+# rough peak memory per positive while a shard is sorted, or held with the keys of its negative sampler
+BYTES_PER_INTERACTION = 32
+_PAIR_DTYPE = np.dtype([("user", "<i8"), ("item", "<i4")])
+
+
+class ShardedInteractionIndex(object):
+    """``UserInteractionIndex`` split into user-sorted shards on disk, for interaction logs larger than RAM.
+
+    Every user lives in exactly one shard, and every shard is small enough to be held in memory, together with its
+    negative sampler, within the budget given to ``write``. Shards are memory-mapped one at a time by
+    ``ShardedSAUCBatchDataset``, by each of its workers, so the budget applies per worker.
+
+    :param path: str, directory written by ``ShardedInteractionIndex.write``.
+    :param user_col: str, name of the user id feature in the model input.
+    :param item_col: str, name of the item id feature in the model input.
+    """
+
+    def __init__(self, path, user_col="userInt", item_col="newsInt"):
+        with open(os.path.join(path, "header.json")) as f:
+            self.header = json.load(f)
+        if self.header.get("version") != SHARD_FORMAT_VERSION:
+            raise ValueError("%s holds shards of format version %s, expected %d" % (
+                path, self.header.get("version"), SHARD_FORMAT_VERSION))
+        self.path = path
+        self.user_col = user_col
+        self.item_col = item_col
+        self.shard_rows = [shard["rows"] for shard in self.header["shards"]]
+
+    @classmethod
+    def write(cls, path, chunks, memory_budget=1 << 30, num_buckets=256, user_col="userInt", item_col="newsInt"):
+        """Partition a stream of (user, item) positives into user-sorted shards under `path`.
+
+        The stream is read once: every chunk is split by ``user % num_buckets`` and appended to bucket files on
+        disk. Consecutive buckets are then grouped into shards of at most ``memory_budget / BYTES_PER_INTERACTION``
+        positives and every shard is sorted by user in memory, so the whole log is never resident.
+
+        :param path: str, output directory.
+        :param chunks: iterable of ``(users, items)`` array pairs, or of DataFrames with `user_col` and `item_col`
+            columns (e.g. ``pd.read_csv(file, chunksize=n)``).
+        :param memory_budget: int, bytes available to hold one shard, in each data loading worker.
+        :param num_buckets: int, number of user hash buckets. A bucket larger than the budget becomes a shard of its
+            own, so raise it for very large logs.
+        :return: ``ShardedInteractionIndex``.
+        """
+        bucket_dir = os.path.join(path, "_buckets")
+        os.makedirs(bucket_dir, exist_ok=True)
+        bucket_sizes = np.zeros(num_buckets, dtype=np.int64)
+        item_counts = np.zeros(0, dtype=np.int64)
+        files = [open(os.path.join(bucket_dir, "%d.bin" % b), "wb") for b in range(num_buckets)]
+        try:
+            for chunk in chunks:
+                if hasattr(chunk, "columns"):
+                    chunk = (chunk[user_col].to_numpy(), chunk[item_col].to_numpy())
+                pairs = np.empty(len(chunk[0]), dtype=_PAIR_DTYPE)
+                pairs["user"], pairs["item"] = chunk
+                bucket = pairs["user"] % num_buckets
+                order = np.argsort(bucket, kind="stable")
+                pairs = pairs[order]
+                bounds = np.searchsorted(bucket[order], np.arange(num_buckets + 1))
+                for b in np.flatnonzero(np.diff(bounds)):
+                    pairs[bounds[b]:bounds[b + 1]].tofile(files[b])
+                bucket_sizes += np.diff(bounds)
+                counts = np.bincount(pairs["item"])
+                if len(counts) > len(item_counts):
+                    item_counts = np.pad(item_counts, (0, len(counts) - len(item_counts)))
+                item_counts[:len(counts)] += counts
+        finally:
+            for f in files:
+                f.close()
+
+        max_positives = max(1, memory_budget // BYTES_PER_INTERACTION)
+        groups, group, group_size = [], [], 0
+        for b in np.flatnonzero(bucket_sizes):
+            if group and group_size + bucket_sizes[b] > max_positives:
+                groups.append(group)
+                group, group_size = [], 0
+            group.append(b)
+            group_size += bucket_sizes[b]
+        if group:
+            groups.append(group)
+
+        shards = []
+        for shard_id, group in enumerate(groups):
+            pairs = np.concatenate([np.fromfile(os.path.join(bucket_dir, "%d.bin" % b), dtype=_PAIR_DTYPE)
+                                    for b in group])
+            pairs = pairs[np.argsort(pairs["user"], kind="stable")]
+            user_ids, lengths = np.unique(pairs["user"], return_counts=True)
+            indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            np.save(_shard_path(path, shard_id, "user_ids"), user_ids)
+            np.save(_shard_path(path, shard_id, "indptr"), indptr)
+            np.save(_shard_path(path, shard_id, "items"), np.ascontiguousarray(pairs["item"]))
+            shards.append({"rows": int(len(user_ids)), "positives": int(len(pairs))})
+            del pairs
+        shutil.rmtree(bucket_dir)
+
+        np.save(os.path.join(path, "item_counts.npy"), item_counts)
+        with open(os.path.join(path, "header.json"), "w") as f:
+            json.dump({"version": SHARD_FORMAT_VERSION, "memory_budget": memory_budget, "shards": shards}, f,
+                      indent=2)
+        return cls(path, user_col=user_col, item_col=item_col)
+
+    def __len__(self):
+        return sum(self.shard_rows)
+
+    @property
+    def num_shards(self):
+        return len(self.shard_rows)
+
+    @property
+    def item_counts(self):
+        """Number of positives of every item over all shards."""
+        return np.load(os.path.join(self.path, "item_counts.npy"))
+
+    def shard(self, shard_id):
+        """Shard `shard_id` as a ``UserInteractionIndex`` over memory-mapped arrays."""
+        arrays = [np.load(_shard_path(self.path, shard_id, name), mmap_mode="r")
+                  for name in ("user_ids", "indptr", "items")]
+        return UserInteractionIndex(*arrays, user_col=self.user_col, item_col=self.item_col)
+
+
+def _shard_path(path, shard_id, name):
+    return os.path.join(path, "shard_%05d.%s.npy" % (shard_id, name))
+
+
+class ShardedSAUCBatchDataset(IterableDataset):
+    """``SAUCBatchDataset`` over a ``ShardedInteractionIndex``, holding a single shard in memory at a time.
+
+    Every epoch visits the shards in a random order and the users of every shard in a random order. A
+    ``NegativeSampler`` is built for the shard being visited, with the item counts of the whole index. The shards
+    are dealt out to the workers, shard ``k`` of the epoch order going to worker ``k % num_workers``, so that no
+    shard is loaded and sampled twice; a worker holds one shard at a time, the budget of ``write`` applies per
+    worker. Batches are numbered and seeded across shards as in ``SAUCBatchDataset``, so their contents do not depend
+    on the number of workers, only the order in which the shards of different workers interleave does.
+
+    :param sharded_index: ``ShardedInteractionIndex``, the users to iterate over.
+    :param num_items: int, negatives are drawn from ``[0, num_items)``.
+    :param batch_size: int, number of users per batch. Batches do not cross shard boundaries.
+    :param shuffle: bool, whether to shuffle the shards and the users at every epoch.
+    :param seed: int or None, base seed of the epoch permutations and sampling streams.
+    :param sampler_kwargs: dict or None, extra keyword arguments of ``NegativeSampler`` (``mode``, ``neg_ratio``...).
+    """
+
+    def __init__(self, sharded_index, num_items, batch_size, shuffle=True, seed=None, sampler_kwargs=None):
+        super(ShardedSAUCBatchDataset, self).__init__()
+        self.index = sharded_index
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = int(np.random.default_rng().integers(2 ** 63)) if seed is None else seed
+        self.sampler_kwargs = dict(sampler_kwargs or {})
+        self.shard_batches = [(rows - 1) // batch_size + 1 if rows else 0 for rows in sharded_index.shard_rows]
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(self.shard_batches)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        if self.shuffle:
+            shard_order = np.random.default_rng([self.seed, self.epoch]).permutation(self.index.num_shards)
+        else:
+            shard_order = np.arange(self.index.num_shards)
+        item_counts = self.index.item_counts
+        first_batches = np.cumsum([0] + [self.shard_batches[shard_id] for shard_id in shard_order])
+        for order, shard_id in enumerate(shard_order):
+            first_batch = first_batches[order]
+            batch_nos = range(first_batch, first_batch + self.shard_batches[shard_id])
+            if order % num_workers == worker_id and batch_nos:
+                index = self.index.shard(shard_id)
+                neg_sampler = NegativeSampler(index, self.num_items, item_counts=item_counts, **self.sampler_kwargs)
+                if self.shuffle:
+                    rows = np.random.default_rng([self.seed, self.epoch, shard_id]).permutation(len(index))
+                else:
+                    rows = np.arange(len(index))
+                for batch_no in batch_nos:
+                    local = batch_no - first_batch
+                    batch_rows = rows[local * self.batch_size:(local + 1) * self.batch_size]
+                    neg_sampler.seed([self.seed, self.epoch, batch_no])
+                    user_ids, pos_items, pos_lengths = index.gather(torch.from_numpy(batch_rows))
+                    neg_items, neg_lengths = neg_sampler.sample(batch_rows)
+                    yield user_ids, pos_items, pos_lengths, neg_items, neg_lengths
+                del index, neg_sampler
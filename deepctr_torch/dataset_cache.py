@@ -0,0 +1,188 @@
+# -*- coding:utf-8 -*-
+"""
+Binary columnar cache of the SAUC datasets.
+
+The CSV files (``userInt, newsInt, label`` rows) and ``train3.pickle`` are parsed once into typed NumPy columns
+and per-user offset arrays, stored as ``.npy`` files under a directory named after a hash of the source contents.
+Later runs hash the sources, find the compiled directory and memory-map the columns instead of parsing them.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .data import UserInteractionIndex
+from .metrics import slate_offsets
+
+FORMAT_VERSION = 2
+HEADER_FILE = "header.json"
+COLUMNS = ("userInt", "newsInt", "label")
+DTYPES = {"userInt": np.int32, "newsInt": np.int32, "label": np.int8}
+DEFAULT_TABLES = {"train": "train_data1.csv", "val": "val_data.csv", "test": "test_data.csv"}
+DEFAULT_USER_LIST = "train3.pickle"
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Content hash of a file, read in chunks."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(datadir, tables=DEFAULT_TABLES, user_list=DEFAULT_USER_LIST):
+    """Key of the compiled dataset: the format version, the layout and the content of every source file."""
+    digest = hashlib.blake2b(digest_size=16)
+    layout = {"version": FORMAT_VERSION, "tables": tables, "user_list": user_list,
+              "dtypes": {col: np.dtype(dtype).str for col, dtype in DTYPES.items()}}
+    digest.update(json.dumps(layout, sort_keys=True).encode("utf-8"))
+    for name in sorted(tables):
+        digest.update(file_digest(os.path.join(datadir, tables[name])).encode("utf-8"))
+    if user_list is not None:
+        digest.update(file_digest(os.path.join(datadir, user_list)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def compile_dataset(datadir, cache_dir=None, tables=DEFAULT_TABLES, user_list=DEFAULT_USER_LIST, rebuild=False):
+    """Compile the dataset of `datadir` unless an up-to-date compiled copy exists, and return its directory.
+
+    :param datadir: str, directory of the source files.
+    :param cache_dir: str or None, where compiled datasets are kept. Defaults to ``<datadir>/_cache``.
+    :param tables: dict, table name -> CSV file name. The ``train`` table is the one `user_list` points into.
+    :param user_list: str or None, the pickle holding ``train_data3_user_list``, the ``(user, start, end)`` tuples
+        of the training positives. Compiled into the arrays of a ``UserInteractionIndex``.
+    :param rebuild: bool, compile even if an up-to-date copy exists.
+    :return: str, directory of the compiled dataset.
+    """
+    key = cache_key(datadir, tables, user_list)
+    cache_dir = os.path.join(datadir, "_cache") if cache_dir is None else cache_dir
+    target = os.path.join(cache_dir, key)
+    if not rebuild and _read_header(target, key) is not None:
+        return target
+
+    os.makedirs(cache_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=key + ".", dir=cache_dir)
+    stale_dir = None
+    try:
+        header = {"version": FORMAT_VERSION, "key": key, "tables": {}, "user_list": user_list}
+        frames = {}
+        for name, file_name in tables.items():
+            frame = pd.read_csv(os.path.join(datadir, file_name))
+            frame.columns = list(COLUMNS)
+            for col in COLUMNS:
+                np.save(_column_path(build_dir, name, col), _cast(frame[col].to_numpy(), DTYPES[col], file_name, col))
+            np.save(_column_path(build_dir, name, "offsets"), slate_offsets(frame["userInt"].to_numpy()))
+            header["tables"][name] = {"file": file_name, "rows": len(frame)}
+            frames[name] = frame
+        if user_list is not None:
+            train3 = pd.read_pickle(os.path.join(datadir, user_list))["train_data3_user_list"]
+            index = UserInteractionIndex.from_user_list(train3, frames["train"])
+            np.save(_column_path(build_dir, "index", "user_ids"), index.user_ids.numpy())
+            np.save(_column_path(build_dir, "index", "indptr"), index.indptr.numpy())
+            np.save(_column_path(build_dir, "index", "items"), index.items.numpy())
+            np.save(_column_path(build_dir, "index", "source_rows"), index.source_rows.numpy())
+        # the header is written last: a directory without it is an interrupted build
+        with open(os.path.join(build_dir, HEADER_FILE), "w") as f:
+            json.dump(header, f, indent=2, sort_keys=True)
+
+        if not rebuild and _read_header(target, key) is not None:
+            # another process published the same key in the meantime, and its readers may map the columns: keep it
+            return target
+        if os.path.isdir(target):
+            # move the outdated (or, with rebuild, replaced) copy aside in one rename instead of deleting its files
+            # in place; readers that mapped its columns keep them
+            stale_dir = tempfile.mkdtemp(prefix=key + ".stale.", dir=cache_dir)
+            try:
+                os.rename(target, stale_dir)
+            except OSError:
+                # moved by another process publishing the same key
+                pass
+        try:
+            os.rename(build_dir, target)
+        except OSError:
+            # another process published the same key in the meantime
+            if _read_header(target, key) is None:
+                raise
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        if stale_dir is not None:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+    return target
+
+
+def load_dataset(datadir, cache_dir=None, tables=DEFAULT_TABLES, user_list=DEFAULT_USER_LIST, mmap_mode="r"):
+    """Return the ``CompiledDataset`` of `datadir`, compiling it on the first call. See ``compile_dataset``."""
+    return CompiledDataset(compile_dataset(datadir, cache_dir, tables, user_list), mmap_mode=mmap_mode)
+
+
+class CompiledDataset(object):
+    """Memory-mapped view of a dataset compiled by ``compile_dataset``.
+
+    :param path: str, directory of the compiled dataset.
+    :param mmap_mode: str or None, passed to ``np.load``. None reads the columns into memory.
+    """
+
+    def __init__(self, path, mmap_mode="r"):
+        self.header = _read_header(path)
+        if self.header is None:
+            raise ValueError("%s is not a compiled dataset of format version %d" % (path, FORMAT_VERSION))
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    @property
+    def tables(self):
+        return list(self.header["tables"])
+
+    def column(self, table, col):
+        """Typed column `col` of `table`."""
+        if table not in self.header["tables"]:
+            raise KeyError("unknown table %s, expected one of %s" % (table, self.tables))
+        return np.load(_column_path(self.path, table, col), mmap_mode=self.mmap_mode)
+
+    def features(self, table, feature_names):
+        """Model input of `table` as a dict feature name -> column."""
+        return {name: self.column(table, name) for name in feature_names}
+
+    def labels(self, table):
+        return self.column(table, "label")
+
+    def offsets(self, table):
+        """CSR offsets of the consecutive rows of every user in `table`, as accepted by ``evaluate_personal``."""
+        return self.column(table, "offsets")
+
+    def interaction_index(self, user_col="userInt", item_col="newsInt"):
+        """``UserInteractionIndex`` of the training positives described by the user list, with the rows of the
+        ``train`` table they come from as ``source_rows``: ``fit_SAUC_Lambda`` reads the other input features of a
+        model from those rows of its ``train_data``."""
+        if self.header["user_list"] is None:
+            raise ValueError("the dataset was compiled without a user list")
+        arrays = [np.load(_column_path(self.path, "index", name)) for name in ("user_ids", "indptr", "items")]
+        return UserInteractionIndex(*arrays, user_col=user_col, item_col=item_col,
+                                    source_rows=np.load(_column_path(self.path, "index", "source_rows")))
+
+
+def _column_path(path, table, col):
+    return os.path.join(path, "%s.%s.npy" % (table, col))
+
+
+def _cast(values, dtype, file_name, col):
+    info = np.iinfo(dtype)
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        raise ValueError("column %s of %s does not fit in %s" % (col, file_name, np.dtype(dtype).name))
+    return values.astype(dtype)
+
+
+def _read_header(path, key=None):
+    try:
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get("version") != FORMAT_VERSION or (key is not None and header.get("key") != key):
+        return None
+    return header
@@ -9,7 +9,9 @@ from itertools import chain
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
+from torch.utils.data import Dataset
 
 from .layers.sequence import SequencePoolingLayer
 from .layers.utils import concat_fun
@@ -123,6 +125,176 @@ def build_input_features(feature_columns):
     return features
 
 
+def build_input_dtypes(feature_columns):
+    # Return OrderedDict: {feature_name: torch dtype}, int64 for ids and sequence lengths, float32 for dense values
+    dtypes = OrderedDict()
+    for feat in feature_columns:
+        if isinstance(feat, DenseFeat):
+            dtypes.setdefault(feat.name, torch.float32)
+        else:
+            dtypes.setdefault(feat.name, torch.int64)
+            if isinstance(feat, VarLenSparseFeat) and feat.length_name is not None:
+                dtypes.setdefault(feat.length_name, torch.int64)
+    return dtypes
+
+
+def build_typed_input(x, feature_index, input_dtypes):
+    """Convert per-feature input arrays into the structured model input.
+
+    Args:
+        x: dict {feature_name: array}, or list of arrays ordered as `feature_index`
+        feature_index: OrderedDict, {feature_name:(start, start+dimension)}
+        input_dtypes: OrderedDict, {feature_name: torch dtype}, see ``build_input_dtypes``
+    Return:
+        OrderedDict {feature_name: 2D tensor [n x dimension]}: ids stay int64, so they are never rounded through
+        float32, and dense values are float32. ``RaggedIds`` are kept as they are.
+    """
+    if isinstance(x, dict):
+        x = [x[feature] for feature in feature_index]
+    typed = OrderedDict()
+    for feature, values in zip(feature_index, x):
+        if isinstance(values, RaggedIds):
+            typed[feature] = values
+            continue
+        values = torch.as_tensor(np.asarray(values), dtype=input_dtypes.get(feature, torch.float32))
+        typed[feature] = values.unsqueeze(1) if values.dim() == 1 else values
+    return typed
+
+
+class RaggedIds(object):
+    """Ids of a multi-valued feature without padding: the ids of row ``i`` are ``values[offsets[i]:offsets[i + 1]]``.
+
+    Feed it, in a dict input, in place of the padded ``(n, maxlen)`` ids of a pooled ``VarLenSparseFeat``: the
+    rows are sliced, gathered and moved like the tensors of the other features, and pooled without padding.
+
+    Args:
+        values: 1D int array-like, the ids of all rows concatenated
+        offsets: 1D int array-like of length ``n + 1``, the row offsets into `values`
+    """
+
+    def __init__(self, values, offsets):
+        self.values = torch.as_tensor(values, dtype=torch.long)
+        self.offsets = torch.as_tensor(offsets, dtype=torch.long)
+
+    @classmethod
+    def from_lists(cls, rows):
+        """From a list of id lists, one per row."""
+        lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+        values = np.concatenate([np.asarray(row, dtype=np.int64).reshape(-1) for row in rows]) if len(rows) else []
+        return cls(values, np.concatenate([[0], np.cumsum(lengths)]))
+
+    @classmethod
+    def from_padded(cls, ids, lengths=None):
+        """Drop the padding of ``(n, maxlen)`` ids: the zeros, or the positions past `lengths` when given."""
+        ids = torch.as_tensor(np.asarray(ids)).long()
+        mask = _valid_positions(ids, None if lengths is None else torch.as_tensor(np.asarray(lengths)))
+        return cls(ids[mask], _lengths_to_offsets(mask.sum(dim=1)))
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def lengths(self):
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def __getitem__(self, index):
+        """The rows `index`: a slice of step 1, or an int array-like of row numbers."""
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("RaggedIds only slice with step 1")
+            offsets = self.offsets[start:max(start, stop) + 1]
+            return RaggedIds(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+        index = torch.as_tensor(index, dtype=torch.long, device=self.offsets.device)
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        offsets = _lengths_to_offsets(lengths)
+        # position in `values` of every id of the gathered rows
+        positions = torch.repeat_interleave(starts - offsets[:-1], lengths) + torch.arange(
+            int(offsets[-1]), device=offsets.device)
+        return RaggedIds(self.values[positions], offsets)
+
+    def to(self, device, non_blocking=False):
+        return RaggedIds(self.values.to(device, non_blocking=non_blocking),
+                         self.offsets.to(device, non_blocking=non_blocking))
+
+    def __repr__(self):
+        return "RaggedIds(rows=%d, ids=%d)" % (len(self), self.values.shape[0])
+
+
+class InputBatchDataset(Dataset):
+    """The rows of the tensors (or ``RaggedIds``) `inputs`, fetched a batch at a time: the item of a list of row
+    numbers is the tuple of their rows, gathered with one indexing per input. Load it with ``batch_size=None`` and
+    a ``BatchSampler``."""
+
+    def __init__(self, *inputs):
+        self.inputs = inputs
+
+    def __len__(self):
+        return len(self.inputs[0])
+
+    def __getitem__(self, rows):
+        rows = torch.as_tensor(rows, dtype=torch.long)
+        return tuple(value[rows] for value in self.inputs)
+
+
+def feature_input(X, feature_index, feature_name):
+    """Return the columns of `feature_name`: its tensor when `X` is a structured input (see
+    ``build_typed_input``), or its slice of the legacy 2D input matrix."""
+    if isinstance(X, dict):
+        value = X[feature_name]
+        return value.unsqueeze(1) if value.dim() == 1 else value
+    return X[:, feature_index[feature_name][0]:feature_index[feature_name][1]]
+
+
+class FeatureGroup(object):
+    """The columns of one list of feature columns, sorted out once.
+
+    Args:
+        feature_columns: list, e.g. ``dnn_feature_columns``
+        feature_index: OrderedDict, {feature_name:(start, start+dimension)}
+    """
+
+    def __init__(self, feature_columns, feature_index):
+        feature_columns = list(feature_columns) if feature_columns else []
+        self.sparse = [feat for feat in feature_columns if isinstance(feat, SparseFeat)]
+        self.dense = [feat for feat in feature_columns if isinstance(feat, DenseFeat)]
+        self.varlen = [feat for feat in feature_columns if isinstance(feat, VarLenSparseFeat)]
+        self.dense_slices = [slice(*feature_index[feat.name]) for feat in self.dense]
+        self.varlen_slices = [slice(*feature_index[feat.name]) for feat in self.varlen]
+        # every SparseFeat is one column of the packed input matrix, so a single index_select gathers them all
+        self.sparse_columns = torch.tensor([feature_index[feat.name][0] for feat in self.sparse], dtype=torch.long)
+        self._device_columns = {}
+
+    def sparse_ids(self, X):
+        """Ids of every sparse feature of the group, as int64 ``(batch_size, 1)`` tensors."""
+        if isinstance(X, dict):
+            return [feature_input(X, None, feat.name).long() for feat in self.sparse]
+        if len(self.sparse) == 0:
+            return []
+        columns = self._device_columns.get(X.device)
+        if columns is None:
+            columns = self._device_columns[X.device] = self.sparse_columns.to(X.device)
+        return list(X.index_select(1, columns).long().split(1, dim=1))
+
+    def dense_values(self, X):
+        """Values of every dense feature of the group, as float ``(batch_size, dimension)`` tensors."""
+        if isinstance(X, dict):
+            return [feature_input(X, None, feat.name).float() for feat in self.dense]
+        return [X[:, columns].float() for columns in self.dense_slices]
+
+    def varlen_ids(self, X):
+        """Padded ids of every ``VarLenSparseFeat`` of the group, as int64 ``(batch_size, maxlen)`` tensors."""
+        if isinstance(X, dict):
+            return [feature_input(X, None, feat.name).long() for feat in self.varlen]
+        return [X[:, columns].long() for columns in self.varlen_slices]
+
+
+def input_batch_size(X):
+    if isinstance(X, dict):
+        return len(next(iter(X.values())))
+    return X.shape[0]
+
+
 def combined_dnn_input(sparse_embedding_list, dense_value_list):
     if len(sparse_embedding_list) > 0 and len(dense_value_list) > 0:
         sparse_dnn_input = torch.flatten(
@@ -138,17 +310,73 @@ def combined_dnn_input(sparse_embedding_list, dense_value_list):
         raise NotImplementedError
 
 
+def _valid_positions(ids, lengths=None):
+    # the ids of a padded (n, maxlen) sequence: the nonzero ones, or the first `lengths` when given
+    if lengths is None:
+        return ids != 0
+    return torch.arange(ids.shape[1], device=ids.device) < lengths.reshape(-1, 1).to(ids.device)
+
+
+def _lengths_to_offsets(lengths):
+    return F.pad(torch.cumsum(lengths, dim=0), (1, 0))
+
+
+def pooled_varlen_embedding_list(X, embedding_dict, feature_index, varlen_sparse_feature_columns):
+    """Pool every ``VarLenSparseFeat`` of `varlen_sparse_feature_columns` with its combiner (sum, mean or max).
+
+    Only the real ids of a row are looked up: the padding of ``(n, maxlen)`` ids is dropped first (the zeros, or the
+    positions past the ``length_name`` feature), and ``RaggedIds`` inputs have none. An ``nn.Embedding`` table is
+    then read by a single ``embedding_bag``; other tables, tables whose lookups are hooked, and the max pooling of a
+    table with sparse gradients, which ``embedding_bag`` does not support, look the ids up and pool the rows. An
+    empty row pools to zeros.
+
+    Return:
+        list of ``(n, 1, embedding_dim)`` tensors, as ``get_varlen_pooling_list``
+    """
+    pooled_list = []
+    for feat in varlen_sparse_feature_columns:
+        value = X[feat.name] if isinstance(X, dict) else None
+        if isinstance(value, RaggedIds):
+            ids, offsets = value.values, value.offsets
+        else:
+            padded = feature_input(X, feature_index, feat.name).long()
+            lengths = None if feat.length_name is None else feature_input(X, feature_index, feat.length_name)
+            mask = _valid_positions(padded, lengths)
+            ids, offsets = padded[mask], _lengths_to_offsets(mask.sum(dim=1))
+        module = embedding_dict[feat.embedding_name]
+        if type(module) is nn.Embedding and not module._forward_hooks and not (
+                feat.combiner == "max" and module.sparse):
+            pooled = F.embedding_bag(ids, module.weight, offsets, mode=feat.combiner, sparse=module.sparse,
+                                     include_last_offset=True)
+        else:
+            pooled = _segment_pool(module(ids), offsets, feat.combiner)
+        pooled_list.append(pooled.unsqueeze(1))
+    return pooled_list
+
+
+def _segment_pool(rows, offsets, mode):
+    lengths = offsets[1:] - offsets[:-1]
+    segments = torch.repeat_interleave(torch.arange(lengths.shape[0], device=rows.device), lengths)
+    pooled = rows.new_zeros(lengths.shape[0], rows.shape[-1])
+    if mode == "max":
+        return pooled.scatter_reduce(0, segments.unsqueeze(1).expand_as(rows), rows, "amax", include_self=False)
+    pooled = pooled.index_add(0, segments, rows)
+    if mode == "mean":
+        pooled = pooled / lengths.clamp_min(1).unsqueeze(1).to(rows.dtype)
+    return pooled
+
+
 def get_varlen_pooling_list(embedding_dict, features, feature_index, varlen_sparse_feature_columns, device):
     varlen_sparse_embedding_list = []
     for feat in varlen_sparse_feature_columns:
         seq_emb = embedding_dict[feat.name]
         if feat.length_name is None:
-            seq_mask = features[:, feature_index[feat.name][0]:feature_index[feat.name][1]].long() != 0
+            seq_mask = feature_input(features, feature_index, feat.name).long() != 0
 
             emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=True, device=device)(
                 [seq_emb, seq_mask])
         else:
-            seq_length = features[:, feature_index[feat.length_name][0]:feature_index[feat.length_name][1]].long()
+            seq_length = feature_input(features, feature_index, feat.length_name).long()
             emb = SequencePoolingLayer(mode=feat.combiner, supports_masking=False, device=device)(
                 [seq_emb, seq_length])
         varlen_sparse_embedding_list.append(emb)
@@ -181,8 +409,171 @@ def create_embedding_matrix(feature_columns, init_std=0.0001, linear=False, spar
     return embedding_dict.to(device)
 
 
+class FusedEmbedding(nn.Module):
+    """The embedding tables of a model stored in one weight.
+
+    Table ``name`` occupies the rows ``[offsets[name], offsets[name] + vocabulary_size)``. The first ``embedding_dim``
+    columns hold the embeddings of the deep part and the last column the weights of the linear part, so the lookups
+    of every field, deep and linear, are one ``F.embedding`` call on the whole table (see ``gather``).
+
+    Args:
+        vocabulary_sizes: OrderedDict, {embedding_name: vocabulary_size}
+        embedding_dim: int, width of the deep embeddings
+    """
+
+    def __init__(self, vocabulary_sizes, embedding_dim):
+        super(FusedEmbedding, self).__init__()
+        self.embedding_dim = embedding_dim
+        self.vocabulary_sizes = OrderedDict(vocabulary_sizes)
+        self.offsets = OrderedDict()
+        start = 0
+        for name, vocabulary_size in self.vocabulary_sizes.items():
+            self.offsets[name] = start
+            start += vocabulary_size
+        self.weight = nn.Parameter(torch.zeros(start, embedding_dim + 1))
+        # as nn.Embedding.sparse: lookups give the weight a sparse gradient
+        self.sparse = False
+        # (name, linear, rows) of every lookup while a list, see BaseModel.set_embedding_regularization
+        self.lookups = None
+        self.field_names = []
+        self.field_tables = []
+        self.field_position = {}
+        self.register_buffer("field_offsets", torch.zeros(0, dtype=torch.long), persistent=False)
+        self.register_buffer("field_columns", torch.zeros(0, dtype=torch.long), persistent=False)
+        self._memo = None
+
+    def table(self, name=None, linear=False):
+        """View of the weight holding table `name`, deep (``(vocabulary_size, embedding_dim)``) or linear part.
+        None selects the part of every table."""
+        rows = self.weight if name is None else self.weight[
+                                                self.offsets[name]:self.offsets[name] + self.vocabulary_sizes[name]]
+        return rows[:, self.embedding_dim:] if linear else rows[:, :self.embedding_dim]
+
+    def lookup(self, ids, name, linear=False):
+        rows = F.embedding(ids + self.offsets[name], self.weight, sparse=self.sparse)
+        rows = rows[..., self.embedding_dim:] if linear else rows[..., :self.embedding_dim]
+        if self.lookups is not None and torch.is_grad_enabled():
+            self.lookups.append((name, linear, rows))
+        return rows
+
+    def set_fields(self, sparse_feature_columns, feature_index):
+        """Declare the SparseFeat fields fetched together by ``gather``."""
+        fields = OrderedDict()
+        for feat in sparse_feature_columns:
+            if feat.embedding_name in self.offsets and feat.name not in fields:
+                fields[feat.name] = feat
+        self.field_names = list(fields)
+        self.field_tables = [feat.embedding_name for feat in fields.values()]
+        self.field_position = {name: i for i, name in enumerate(self.field_names)}
+        device = self.weight.device
+        self.field_offsets = torch.tensor([self.offsets[feat.embedding_name] for feat in fields.values()],
+                                          dtype=torch.long, device=device)
+        self.field_columns = torch.tensor([feature_index[name][0] for name in self.field_names], dtype=torch.long,
+                                          device=device)
+        self.release()
+
+    def gather(self, X):
+        """Rows of every field of `X`, ``(batch_size, field_num, embedding_dim + 1)``, in a single lookup.
+
+        The result is reused by the other lookups of the same input until the weight changes or ``release`` is
+        called; the model releases it after every forward pass.
+        """
+        key = (self.weight._version, torch.is_grad_enabled())
+        if self._memo is not None and self._memo[0] is X and self._memo[1] == key:
+            return self._memo[2]
+        if isinstance(X, dict):
+            ids = torch.cat([feature_input(X, None, name).long() for name in self.field_names], dim=1)
+        else:
+            ids = X.index_select(1, self.field_columns).long()
+        rows = F.embedding(ids + self.field_offsets, self.weight, sparse=self.sparse)
+        if self.lookups is not None and torch.is_grad_enabled():
+            # both parts of every field at once
+            self.lookups.append((None, None, rows))
+        self._memo = (X, key, rows)
+        return rows
+
+    def release(self, *hook_args):
+        """Drop the batch kept by ``gather``. Also registered as forward (pre-)hook of the model."""
+        self._memo = None
+
+    def lookup_group(self, X, group, embedding_dict, linear=False):
+        """Embeddings of the sparse features of a ``FeatureGroup``, as ``input_from_feature_columns`` returns them.
+        Features outside the fused fields are looked up in `embedding_dict`."""
+        fields = None
+        if len(self.field_names):
+            rows = self.gather(X)
+            # one slice and one split, so that the backward pass does not build a gradient per field
+            fields = (rows[..., self.embedding_dim:] if linear else rows[..., :self.embedding_dim]).split(1, dim=1)
+        embedding_list = []
+        sparse_ids = None
+        for i, feat in enumerate(group.sparse):
+            position = self.field_position.get(feat.name)
+            if position is not None:
+                embedding_list.append(fields[position])
+            else:
+                if sparse_ids is None:
+                    sparse_ids = group.sparse_ids(X)
+                embedding_list.append(embedding_dict[feat.embedding_name](sparse_ids[i]))
+        return embedding_list
+
+
+class FusedEmbeddingView(nn.Module):
+    """Stand-in for the ``nn.Embedding`` of one table of a ``FusedEmbedding``, kept in the model's embedding dicts
+    so that the per-table lookups (varlen features, DIN/DIEN history) keep working after fusion. A `name` of None
+    stands for the deep or linear part of all tables at once."""
+
+    def __init__(self, store, name, linear=False):
+        super(FusedEmbeddingView, self).__init__()
+        # not a submodule: the store is registered once, on the model, and checkpointed there
+        self.__dict__["store"] = store
+        self.name = name
+        self.linear = linear
+        self.num_embeddings = store.weight.shape[0] if name is None else store.vocabulary_sizes[name]
+        self.embedding_dim = 1 if linear else store.embedding_dim
+
+    @property
+    def weight(self):
+        return self.store.table(self.name, self.linear)
+
+    def forward(self, ids):
+        return self.store.lookup(ids, self.name, self.linear)
+
+
+def fuse_embedding_matrix(embedding_dict, linear_embedding_dict):
+    """Copy the tables of `embedding_dict` and of the dim-1 `linear_embedding_dict` into one ``FusedEmbedding`` and
+    replace them in both dicts by ``FusedEmbeddingView``. Only the tables of the most common embedding width are
+    fused; the others stay ``nn.Embedding``.
+
+    :return: the ``FusedEmbedding``, or None if there is nothing to fuse.
+    """
+    dims = [module.embedding_dim for module in embedding_dict.values() if isinstance(module, nn.Embedding)]
+    if len(dims) == 0:
+        return None
+    embedding_dim = max(set(dims), key=dims.count)
+    deep_names = [name for name, module in embedding_dict.items() if
+                  isinstance(module, nn.Embedding) and module.embedding_dim == embedding_dim]
+    vocabulary_sizes = OrderedDict((name, embedding_dict[name].num_embeddings) for name in deep_names)
+    linear_names = []
+    for name, module in linear_embedding_dict.items():
+        if isinstance(module, nn.Embedding) and vocabulary_sizes.get(name, module.num_embeddings) == \
+                module.num_embeddings:
+            vocabulary_sizes[name] = module.num_embeddings
+            linear_names.append(name)
+
+    # a table found in only one of the dicts leaves the other part of its rows unused (zero)
+    store = FusedEmbedding(vocabulary_sizes, embedding_dim).to(embedding_dict[deep_names[0]].weight.device)
+    with torch.no_grad():
+        for name in deep_names:
+            store.table(name).copy_(embedding_dict[name].weight)
+            embedding_dict[name] = FusedEmbeddingView(store, name)
+        for name in linear_names:
+            store.table(name, linear=True).copy_(linear_embedding_dict[name].weight)
+            linear_embedding_dict[name] = FusedEmbeddingView(store, name, linear=True)
+    return store
+
+
 def embedding_lookup(X, sparse_embedding_dict, sparse_input_dict, sparse_feature_columns, return_feat_list=(),
-                     mask_feat_list=(), to_list=False):
+                     mask_feat_list=(), to_list=False, feature_group=None):
     """
         Args:
             X: input Tensor [batch_size x hidden_dim]
@@ -191,9 +582,14 @@ def embedding_lookup(X, sparse_embedding_dict, sparse_input_dict, sparse_feature
             sparse_feature_columns: list, sparse features
             return_feat_list: list, names of feature to be returned, defualt () -> return all features
             mask_feat_list, list, names of feature to be masked in hash transform
+            feature_group: the ``FeatureGroup`` of `sparse_feature_columns`, compiled by the model, or None. If
+                given, the ids are gathered through it, all at once, instead of feature by feature
         Return:
             group_embedding_dict: defaultdict(list)
     """
+    if feature_group is not None:
+        ids = dict(zip([feat.name for feat in feature_group.sparse], feature_group.sparse_ids(X)))
+        ids.update(zip([feat.name for feat in feature_group.varlen], feature_group.varlen_ids(X)))
     group_embedding_dict = defaultdict(list)
     for fc in sparse_feature_columns:
         feature_name = fc.name
@@ -202,8 +598,10 @@ def embedding_lookup(X, sparse_embedding_dict, sparse_input_dict, sparse_feature
             #
             # if fc.use_hash:
             #     raise NotImplementedError("hash function is not implemented in this version!")
-            lookup_idx = np.array(sparse_input_dict[feature_name])
-            input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].long()
+            if feature_group is not None:
+                input_tensor = ids[feature_name]
+            else:
+                input_tensor = feature_input(X, sparse_input_dict, feature_name).long()
             emb = sparse_embedding_dict[embedding_name](input_tensor)
             group_embedding_dict[fc.group_name].append(emb)
     if to_list:
@@ -223,7 +621,7 @@ def varlen_embedding_lookup(X, embedding_dict, sequence_input_dict, varlen_spars
         else:
             lookup_idx = sequence_input_dict[feature_name]
         varlen_embedding_vec_dict[feature_name] = embedding_dict[embedding_name](
-            X[:, lookup_idx[0]:lookup_idx[1]].long())  # (lookup_idx)
+            feature_input(X, sequence_input_dict, feature_name).long())  # (lookup_idx)
 
     return varlen_embedding_vec_dict
 
@@ -233,8 +631,7 @@ def get_dense_input(X, features, feature_columns):
         x, DenseFeat), feature_columns)) if feature_columns else []
     dense_input_list = []
     for fc in dense_feature_columns:
-        lookup_idx = np.array(features[fc.name])
-        input_tensor = X[:, lookup_idx[0]:lookup_idx[1]].float()
+        input_tensor = feature_input(X, features, fc.name).float()
         dense_input_list.append(input_tensor)
     return dense_input_list
 
@@ -242,5 +639,4 @@ def get_dense_input(X, features, feature_columns):
 def maxlen_lookup(X, sparse_input_dict, maxlen_column):
     if maxlen_column is None or len(maxlen_column)==0:
         raise ValueError('please add max length column for VarLenSparseFeat of DIN/DIEN input')
-    lookup_idx = np.array(sparse_input_dict[maxlen_column[0]])
-    return X[:, lookup_idx[0]:lookup_idx[1]].long()
+    return feature_input(X, sparse_input_dict, maxlen_column[0]).long()
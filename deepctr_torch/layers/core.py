@@ -49,19 +49,22 @@ class LocalActivationUnit(nn.Module):
         self.dense = nn.Linear(hidden_units[-1], 1)
 
     def forward(self, query, user_behavior):
+        attention_output = self.dnn(self.attention_input(query, user_behavior))
+
+        attention_score = self.dense(attention_output)  # [B, T, 1]
+
+        return attention_score
+
+    @staticmethod
+    def attention_input(query, user_behavior):
         # query ad            : size -> batch_size * 1 * embedding_size
         # user behavior       : size -> batch_size * time_seq_len * embedding_size
         user_behavior_len = user_behavior.size(1)
 
         queries = query.expand(-1, user_behavior_len, -1)
 
-        attention_input = torch.cat([queries, user_behavior, queries - user_behavior, queries * user_behavior],
-                                    dim=-1)  # as the source code, subtraction simulates verctors' difference
-        attention_output = self.dnn(attention_input)
-
-        attention_score = self.dense(attention_output)  # [B, T, 1]
-
-        return attention_score
+        return torch.cat([queries, user_behavior, queries - user_behavior, queries * user_behavior],
+                         dim=-1)  # as the source code, subtraction simulates verctors' difference
 
 
 class DNN(nn.Module):
@@ -118,11 +121,15 @@ class DNN(nn.Module):
         self.to(device)
 
     def forward(self, inputs):
-        deep_input = inputs
+        return self.forward_from_linear(self.linears[0](inputs))
 
+    def forward_from_linear(self, fc):
+        """Run the network given the output ``fc`` of the first linear layer, e.g. when that output is assembled
+        from precomputed partial products."""
         for i in range(len(self.linears)):
 
-            fc = self.linears[i](deep_input)
+            if i > 0:
+                fc = self.linears[i](deep_input)
 
             if self.use_bn:
                 fc = self.bn[i](fc)
@@ -3,12 +3,24 @@ import itertools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from ..layers.activation import activation_layer
 from ..layers.core import Conv2dSame
 from ..layers.sequence import KMaxPooling
 
 
+def pair_index(num_fields, device=None):
+    """``(2, num_fields * (num_fields - 1) / 2)`` tensor of the fields ``i < j`` of every pair, in the order of
+    ``itertools.combinations(range(num_fields), 2)``."""
+    return torch.triu_indices(num_fields, num_fields, offset=1, device=device)
+
+
+def stack_fields(inputs):
+    # a list of N (batch_size, 1, embedding_size) tensors, or their (batch_size, N, embedding_size) concatenation
+    return inputs if torch.is_tensor(inputs) else torch.cat(inputs, dim=1)
+
+
 class FM(nn.Module):
     """Factorization Machine models pairwise (order-2) feature interactions
      without linear term and bias.
@@ -135,25 +147,27 @@ Tongwen](https://arxiv.org/pdf/1905.09433.pdf)
                     nn.Linear(embedding_size, embedding_size, bias=False))
         else:
             raise NotImplementedError
+        self.register_buffer("pairs", pair_index(filed_size), persistent=False)
         self.to(device)
 
     def forward(self, inputs):
         if len(inputs.shape) != 3:
             raise ValueError(
                 "Unexpected inputs dimensions %d, expect to be 3 dimensions" % (len(inputs.shape)))
-        inputs = torch.split(inputs, 1, dim=1)
+        row, col = self.pairs
+        # field-major, so that the products of a field (or pair) with its weight are one matrix product
+        inputs = inputs.transpose(0, 1).contiguous()
         if self.bilinear_type == "all":
-            p = [torch.mul(self.bilinear(v_i), v_j)
-                 for v_i, v_j in itertools.combinations(inputs, 2)]
+            v_i = self.bilinear(inputs)[row]
         elif self.bilinear_type == "each":
-            p = [torch.mul(self.bilinear[i](inputs[i]), inputs[j])
-                 for i, j in itertools.combinations(range(len(inputs)), 2)]
+            weight = torch.stack([bilinear.weight for bilinear in self.bilinear])  # filed_size * out * in
+            v_i = torch.bmm(inputs, weight.transpose(1, 2))[row]
         elif self.bilinear_type == "interaction":
-            p = [torch.mul(bilinear(v[0]), v[1])
-                 for v, bilinear in zip(itertools.combinations(inputs, 2), self.bilinear)]
+            weight = torch.stack([bilinear.weight for bilinear in self.bilinear])  # pair * out * in
+            v_i = torch.bmm(inputs[row], weight.transpose(1, 2))
         else:
             raise NotImplementedError
-        return torch.cat(p, dim=1)
+        return (v_i * inputs[col]).transpose(0, 1)
 
 
 class CIN(nn.Module):
@@ -168,12 +182,15 @@ class CIN(nn.Module):
         - **activation** : activation function name used on feature maps.
         - **split_half** : bool.if set to False, half of the feature maps in each hidden will connect to output unit.
         - **seed** : A Python integer to use as random seed.
+        - **chunk_size** : Positive integer or None. If set, the ``(batch_size, hi * m, embedding_size)`` outer
+          product of every layer is built and convolved ``chunk_size`` rows at a time, and recomputed in the backward
+          pass instead of kept, so that memory stays bounded with many fields and large batches.
       References
         - [Lian J, Zhou X, Zhang F, et al. xDeepFM: Combining Explicit and Implicit Feature Interactions for Recommender Systems[J]. arXiv preprint arXiv:1803.05170, 2018.] (https://arxiv.org/pdf/1803.05170.pdf)
     """
 
     def __init__(self, field_size, layer_size=(128, 128), activation='relu', split_half=True, l2_reg=1e-5, seed=1024,
-                 device='cpu'):
+                 device='cpu', chunk_size=None):
         super(CIN, self).__init__()
         if len(layer_size) == 0:
             raise ValueError(
@@ -185,6 +202,7 @@ class CIN(nn.Module):
         self.activation = activation_layer(activation)
         self.l2_reg = l2_reg
         self.seed = seed
+        self.chunk_size = chunk_size
 
         self.conv1ds = nn.ModuleList()
         for i, size in enumerate(self.layer_size):
@@ -209,19 +227,16 @@ class CIN(nn.Module):
             raise ValueError(
                 "Unexpected inputs dimensions %d, expect to be 3 dimensions" % (len(inputs.shape)))
         batch_size = inputs.shape[0]
-        dim = inputs.shape[-1]
         hidden_nn_layers = [inputs]
         final_result = []
 
         for i, size in enumerate(self.layer_size):
-            # x^(k-1) * x^0
-            x = torch.einsum(
-                'bhd,bmd->bhmd', hidden_nn_layers[-1], hidden_nn_layers[0])
-            # x.shape = (batch_size , hi * m, dim)
-            x = x.reshape(
-                batch_size, hidden_nn_layers[-1].shape[1] * hidden_nn_layers[0].shape[1], dim)
-            # x.shape = (batch_size , hi, dim)
-            x = self.conv1ds[i](x)
+            if self.chunk_size is None or batch_size <= self.chunk_size:
+                x = self._interaction(i, hidden_nn_layers[-1], hidden_nn_layers[0])
+            else:
+                x = torch.cat([self._chunk_interaction(i, hidden, x0) for hidden, x0 in
+                               zip(torch.split(hidden_nn_layers[-1], self.chunk_size),
+                                   torch.split(hidden_nn_layers[0], self.chunk_size))])
 
             if self.activation is None or self.activation == 'linear':
                 curr_out = x
@@ -247,6 +262,20 @@ class CIN(nn.Module):
 
         return result
 
+    def _interaction(self, i, hidden, x0):
+        # x^(k-1) * x^0
+        x = torch.einsum('bhd,bmd->bhmd', hidden, x0)
+        # x.shape = (batch_size , hi * m, dim)
+        x = x.reshape(hidden.shape[0], hidden.shape[1] * x0.shape[1], x0.shape[-1])
+        # x.shape = (batch_size , hi, dim)
+        return self.conv1ds[i](x)
+
+    def _chunk_interaction(self, i, hidden, x0):
+        if torch.is_grad_enabled():
+            # keep only the inputs of the chunk for the backward pass, not its outer product
+            return checkpoint(self._interaction, i, hidden, x0, use_reentrant=False)
+        return self._interaction(i, hidden, x0)
+
 
 class AFMLayer(nn.Module):
     """Attentonal Factorization Machine models pairwise (order-2) feature
@@ -538,37 +567,34 @@ class InnerProductLayer(nn.Module):
     """InnerProduct Layer used in PNN that compute the element-wise
     product or inner product between feature vectors.
       Input shape
-        - a list of 3D tensor with shape: ``(batch_size,1,embedding_size)``.
+        - a list of 3D tensor with shape: ``(batch_size,1,embedding_size)``, or their concatenation
+        ``(batch_size,N,embedding_size)``.
       Output shape
         - 3D tensor with shape: ``(batch_size, N*(N-1)/2 ,1)`` if use reduce_sum. or 3D tensor with shape:
         ``(batch_size, N*(N-1)/2, embedding_size )`` if not use reduce_sum.
       Arguments
         - **reduce_sum**: bool. Whether return inner product or element-wise product
+        - **field_size** : Positive integer or None, N. If None, the pairs are indexed on the first call.
       References
             - [Qu Y, Cai H, Ren K, et al. Product-based neural networks for user response prediction[C]//
             Data Mining (ICDM), 2016 IEEE 16th International Conference on. IEEE, 2016: 1149-1154.]
             (https://arxiv.org/pdf/1611.00144.pdf)"""
 
-    def __init__(self, reduce_sum=True, device='cpu'):
+    def __init__(self, reduce_sum=True, device='cpu', field_size=None):
         super(InnerProductLayer, self).__init__()
         self.reduce_sum = reduce_sum
+        self.register_buffer("pairs", pair_index(field_size or 0), persistent=False)
         self.to(device)
 
     def forward(self, inputs):
 
-        embed_list = inputs
-        row = []
-        col = []
-        num_inputs = len(embed_list)
-
-        for i in range(num_inputs - 1):
-            for j in range(i + 1, num_inputs):
-                row.append(i)
-                col.append(j)
-        p = torch.cat([embed_list[idx]
-                       for idx in row], dim=1)  # batch num_pairs k
-        q = torch.cat([embed_list[idx]
-                       for idx in col], dim=1)
+        embeds = stack_fields(inputs)
+        num_inputs = embeds.shape[1]
+        if self.pairs.shape[1] != num_inputs * (num_inputs - 1) // 2:
+            self.pairs = pair_index(num_inputs, device=embeds.device)
+        row, col = self.pairs
+        p = embeds[:, row]  # batch num_pairs k
+        q = embeds[:, col]
 
         inner_product = p * q
         if self.reduce_sum:
@@ -581,7 +607,8 @@ class OutterProductLayer(nn.Module):
     """OutterProduct Layer used in PNN.This implemention is
     adapted from code that the author of the paper published on https://github.com/Atomu2014/product-nets.
       Input shape
-            - A list of N 3D tensor with shape: ``(batch_size,1,embedding_size)``.
+            - A list of N 3D tensor with shape: ``(batch_size,1,embedding_size)``, or their concatenation
+            ``(batch_size,N,embedding_size)``.
       Output shape
             - 2D tensor with shape:``(batch_size,N*(N-1)/2 )``.
       Arguments
@@ -610,54 +637,19 @@ class OutterProductLayer(nn.Module):
         elif self.kernel_type == 'num':
             self.kernel = nn.Parameter(torch.Tensor(num_pairs, 1))
         nn.init.xavier_uniform_(self.kernel)
+        self.register_buffer("pairs", pair_index(field_size), persistent=False)
 
         self.to(device)
 
     def forward(self, inputs):
-        embed_list = inputs
-        row = []
-        col = []
-        num_inputs = len(embed_list)
-        for i in range(num_inputs - 1):
-            for j in range(i + 1, num_inputs):
-                row.append(i)
-                col.append(j)
-        p = torch.cat([embed_list[idx]
-                       for idx in row], dim=1)  # batch num_pairs k
-        q = torch.cat([embed_list[idx] for idx in col], dim=1)
-
-        # -------------------------
-        if self.kernel_type == 'mat':
-            p.unsqueeze_(dim=1)
-            # k     k* pair* k
-            # batch * pair
-            kp = torch.sum(
+        embeds = stack_fields(inputs)
+        row, col = self.pairs
+        p = embeds[:, row]  # batch num_pairs k
+        q = embeds[:, col]
 
-                # batch * pair * k
-
-                torch.mul(
-
-                    # batch * pair * k
-
-                    torch.transpose(
-
-                        # batch * k * pair
-
-                        torch.sum(
-
-                            # batch * k * pair * k
-
-                            torch.mul(
-
-                                p, self.kernel),
-
-                            dim=-1),
-
-                        2, 1),
-
-                    q),
-
-                dim=-1)
+        if self.kernel_type == 'mat':
+            # kp[b, pair] = q[b, pair] . kernel[:, pair, :] . p[b, pair], without the batch * k * pair * k product
+            kp = torch.einsum("bpj,ipj,bpi->bp", p, self.kernel, q)
         else:
             # 1 * pair * (k or 1)
 
@@ -667,8 +659,6 @@ class OutterProductLayer(nn.Module):
 
             kp = torch.sum(p * q * k, dim=-1)
 
-            # p q # b * p * k
-
         return kp
 
 
@@ -2,7 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import PackedSequence
+from torch.utils.checkpoint import checkpoint
 
+from ..layers.activation import Dice
 from ..layers.core import LocalActivationUnit
 
 
@@ -43,8 +45,7 @@ class SequencePoolingLayer(nn.Module):
         matrix = torch.unsqueeze(lengths, dim=-1)
         mask = row_vector < matrix
 
-        mask.type(dtype)
-        return mask
+        return mask.type(dtype)
 
     def forward(self, seq_value_len_list):
         if self.supports_masking:
@@ -58,10 +59,7 @@ class SequencePoolingLayer(nn.Module):
                                        dtype=torch.float32)  # [B, 1, maxlen]
             mask = torch.transpose(mask, 1, 2)  # [B, maxlen, 1]
 
-        embedding_size = uiseq_embed_list.shape[-1]
-
-        mask = torch.repeat_interleave(mask, embedding_size, dim=2)  # [B, maxlen, E]
-
+        # [B, maxlen, 1], broadcast over the embedding
         if self.mode == 'max':
             hist = uiseq_embed_list - (1 - mask) * 1e9
             hist = torch.max(hist, dim=1, keepdim=True)[0]
@@ -89,16 +87,23 @@ class AttentionSequencePoolingLayer(nn.Module):
 
           - **supports_masking**:If True,the input need to support masking.
 
+          - **chunk_size**: positive integer or None. If set, the keys are taken ``chunk_size`` time steps at a
+            time: the attention net scores a chunk and is recomputed in the backward pass, so that its ``(batch_size,
+            T, 4 * embedding_size)`` input and hidden layers are never built for the whole history, and the chunk is
+            added to a running weighted sum (a running softmax with ``weight_normalization``). A training ``Dice``
+            normalizes with the statistics of all the steps, gathered by one more pass over the chunks per layer.
+
         References
           - [Zhou G, Zhu X, Song C, et al. Deep interest network for click-through rate prediction[C]//Proceedings of the 24th ACM SIGKDD International Conference on Knowledge Discovery & Data Mining. ACM, 2018: 1059-1068.](https://arxiv.org/pdf/1706.06978.pdf)
       """
 
     def __init__(self, att_hidden_units=(80, 40), att_activation='sigmoid', weight_normalization=False,
-                 return_score=False, supports_masking=False, embedding_dim=4, **kwargs):
+                 return_score=False, supports_masking=False, embedding_dim=4, chunk_size=None, **kwargs):
         super(AttentionSequencePoolingLayer, self).__init__()
         self.return_score = return_score
         self.weight_normalization = weight_normalization
         self.supports_masking = supports_masking
+        self.chunk_size = chunk_size
         self.local_att = LocalActivationUnit(hidden_units=att_hidden_units, embedding_dim=embedding_dim,
                                              activation=att_activation,
                                              dropout_rate=0, use_bn=False)
@@ -130,7 +135,15 @@ class AttentionSequencePoolingLayer(nn.Module):
             keys_masks = keys_masks < keys_length.view(-1, 1)  # 0, 1 mask
             keys_masks = keys_masks.unsqueeze(1)  # [B, 1, T]
 
-        attention_score = self.local_att(query, keys)  # [B, T, 1]
+        if self.chunk_size is None or max_length <= self.chunk_size:
+            attention_score = self.local_att(query, keys)  # [B, T, 1]
+        else:
+            chunks = torch.split(keys, self.chunk_size, dim=1)
+            stats = self._dice_statistics(query, chunks) if self._batch_statistics() else None
+            if not self.return_score:
+                return self._chunked_pooling(query, chunks, torch.split(keys_masks, self.chunk_size, dim=2), stats)
+            attention_score = torch.cat([self._checkpoint(self._score, query, chunk, stats) for chunk in chunks],
+                                        dim=1)
 
         outputs = torch.transpose(attention_score, 1, 2)  # [B, 1, T]
 
@@ -153,6 +166,96 @@ class AttentionSequencePoolingLayer(nn.Module):
 
         return outputs
 
+    def _batch_statistics(self):
+        return any(isinstance(module, nn.modules.batchnorm._BatchNorm) and module.training
+                   for module in self.local_att.modules())
+
+    @staticmethod
+    def _checkpoint(function, *args):
+        if torch.is_grad_enabled():
+            # keep only the keys of the chunk for the backward pass, not the activations of the attention net
+            return checkpoint(function, *args, use_reentrant=False)
+        return function(*args)
+
+    def _chunked_pooling(self, query, chunks, masks, stats):
+        outputs, total, top = 0, 0, None
+        for chunk, mask in zip(chunks, masks):
+            scores = torch.transpose(self._checkpoint(self._score, query, chunk, stats), 1, 2)  # [B, 1, t]
+            if not self.weight_normalization:
+                outputs = outputs + torch.matmul(torch.where(mask, scores, torch.zeros_like(scores)), chunk)
+                continue
+            scores = torch.where(mask, scores, torch.full_like(scores, -2 ** 32 + 1))
+            new_top = scores.max(dim=-1, keepdim=True)[0].detach()
+            if top is not None:
+                new_top = torch.max(top, new_top)
+                rescale = torch.exp(top - new_top)
+                outputs, total = outputs * rescale, total * rescale
+            weights = torch.exp(scores - new_top)
+            outputs = outputs + torch.matmul(weights, chunk)
+            total = total + weights.sum(dim=-1, keepdim=True)
+            top = new_top
+        if self.weight_normalization:
+            outputs = outputs / total
+        return outputs  # [B, 1, E]
+
+    def _score(self, query, keys, stats=None):
+        if stats is None:
+            return self.local_att(query, keys)
+        return self.local_att.dense(self._hidden(query, keys, stats))
+
+    def _hidden(self, query, keys, stats):
+        """Attention net up to the first layer without ``(mean, var)`` in `stats`, whose ``Dice`` normalizes with
+        them instead of the statistics of the chunk; returns the input of that ``Dice``, or the last hidden layer."""
+        dnn = self.local_att.dnn
+        hidden = self.local_att.attention_input(query, keys)
+        for i, linear in enumerate(dnn.linears):
+            hidden = linear(hidden)
+            if i == len(stats):
+                return hidden
+            dice = dnn.activation_layers[i]
+            mean, var = stats[i]
+            x_p = torch.sigmoid((hidden - mean) * torch.rsqrt(var + dice.bn.eps) * dice.bn.weight + dice.bn.bias)
+            alpha = dice.alpha.view(-1)
+            hidden = dnn.dropout(alpha * (1 - x_p) * hidden + x_p * hidden)
+        return hidden
+
+    def _moments(self, query, keys, stats):
+        hidden = self._hidden(query, keys, stats)
+        hidden = hidden.reshape(-1, hidden.size(-1))
+        var, mean = torch.var_mean(hidden, dim=0, unbiased=False)
+        return mean, var * hidden.size(0)
+
+    def _dice_statistics(self, query, chunks):
+        """The ``(mean, var)`` of every ``Dice`` of the attention net over all the chunks, each computed given those
+        of the layers below. Gradients flow through them as through a batch normalization of the whole history."""
+        dnn = self.local_att.dnn
+        if dnn.use_bn or not all(isinstance(act, Dice) for act in dnn.activation_layers):
+            raise NotImplementedError("chunk_size supports the batch normalization of Dice only")
+        stats = []
+        for dice in dnn.activation_layers:
+            count, mean, m2 = 0, 0, 0
+            for chunk in chunks:
+                # merge the moments of the chunks (Chan et al.)
+                chunk_mean, chunk_m2 = self._checkpoint(self._moments, query, chunk, tuple(stats))
+                n = chunk.size(0) * chunk.size(1)
+                delta = chunk_mean - mean
+                mean = mean + delta * (n / (count + n))
+                m2 = m2 + chunk_m2 + delta ** 2 * (count * n / (count + n))
+                count += n
+            stats.append((mean, m2 / count))
+            self._update_running_stats(dice.bn, mean.detach(), m2.detach() / max(count - 1, 1))
+        return stats
+
+    @staticmethod
+    def _update_running_stats(bn, mean, var):
+        if not bn.track_running_stats:
+            return
+        with torch.no_grad():
+            bn.num_batches_tracked += 1
+            momentum = 1. / float(bn.num_batches_tracked) if bn.momentum is None else bn.momentum
+            bn.running_mean.mul_(1 - momentum).add_(mean, alpha=momentum)
+            bn.running_var.mul_(1 - momentum).add_(var, alpha=momentum)
+
 
 class KMaxPooling(nn.Module):
     """K Max pooling that selects the k biggest value along the specific axis.
@@ -282,7 +385,39 @@ class AUGRUCell(nn.Module):
         return hy
 
 
+def attentional_gru(gi, hx, att_scores, batch_sizes, weight_hh, bias_hh, attentional_update):
+    """The time steps of ``AGRUCell`` (or of ``AUGRUCell`` if `attentional_update`) over packed data.
+
+    `gi` holds the input projections ``F.linear(inputs, weight_ih, bias_ih)`` of every step, computed at once; a step
+    only multiplies the hidden state. The states of all steps are returned, packed as the inputs.
+    """
+    # split once rather than slicing per step: the backward of every slice is a zero tensor of the full input
+    outputs = []
+    for gi_t, att_t in zip(gi.split(batch_sizes), att_scores.split(batch_sizes)):
+        hx = hx[:gi_t.size(0)]
+        gh = F.linear(hx, weight_hh, bias_hh)
+        i_r, i_z, i_n = gi_t.chunk(3, 1)
+        h_r, h_z, h_n = gh.chunk(3, 1)
+
+        reset_gate = torch.sigmoid(i_r + h_r)
+        new_state = torch.tanh(i_n + reset_gate * h_n)
+
+        update_gate = att_t.view(-1, 1)
+        if attentional_update:
+            update_gate = update_gate * torch.sigmoid(i_z + h_z)
+        hx = (1. - update_gate) * hx + update_gate * new_state
+        outputs.append(hx)
+    # likewise one copy at the end, assigning every step into a preallocated buffer copies the buffer per step
+    return torch.cat(outputs)
+
+
 class DynamicGRU(nn.Module):
+    """AGRU or AUGRU over a ``PackedSequence``, see ``AGRUCell`` and ``AUGRUCell``.
+
+    The input projections of all the time steps are computed by one matrix product, the steps then run in
+    ``attentional_gru``.
+    """
+
     def __init__(self, input_size, hidden_size, bias=True, gru_type='AGRU'):
         super(DynamicGRU, self).__init__()
         self.input_size = input_size
@@ -305,16 +440,7 @@ class DynamicGRU(nn.Module):
             hx = torch.zeros(max_batch_size, self.hidden_size,
                              dtype=inputs.dtype, device=inputs.device)
 
-        outputs = torch.zeros(inputs.size(0), self.hidden_size,
-                              dtype=inputs.dtype, device=inputs.device)
-
-        begin = 0
-        for batch in batch_sizes:
-            new_hx = self.rnn(
-                inputs[begin:begin + batch],
-                hx[0:batch],
-                att_scores[begin:begin + batch])
-            outputs[begin:begin + batch] = new_hx
-            hx = new_hx
-            begin += batch
+        gi = F.linear(inputs, self.rnn.weight_ih, self.rnn.bias_ih)
+        outputs = attentional_gru(gi, hx, att_scores, batch_sizes.tolist(), self.rnn.weight_hh, self.rnn.bias_hh,
+                                  isinstance(self.rnn, AUGRUCell))
         return PackedSequence(outputs, batch_sizes, sorted_indices, unsorted_indices)
@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+"""
+Vectorised per-user ranking metrics used by the personal evaluation of ``BaseModel``.
+"""
+import numpy as np
+
+
+def slate_offsets(user_ids):
+    """CSR offsets of the slates of a candidate list sorted by user: slate ``u`` is ``[offsets[u], offsets[u + 1])``.
+
+    :param user_ids: 1D array, the user of every candidate; the candidates of a user must be consecutive.
+    """
+    user_ids = np.asarray(user_ids).reshape(-1)
+    starts = np.flatnonzero(np.r_[True, user_ids[1:] != user_ids[:-1]]) if len(user_ids) else np.zeros(0, np.int64)
+    return np.r_[starts, len(user_ids)].astype(np.int64)
+
+
+def ranking_metrics(labels, scores, Ks=(2, 4, 6, 8, 10), ndcg_k=10):
+    """``segment_ranking_metrics`` for slates of a common length stored as rows of 2D arrays.
+
+    :param labels: 2D array ``(user_num, slate_len)``, relevance of every candidate (> 0 is a positive).
+    :param scores: 2D array ``(user_num, slate_len)``, predicted scores.
+    """
+    labels = np.asarray(labels)
+    user_num, slate_len = labels.shape
+    offsets = np.arange(user_num + 1, dtype=np.int64) * slate_len
+    return segment_ranking_metrics(labels.reshape(-1), np.asarray(scores).reshape(-1), offsets, Ks=Ks,
+                                   ndcg_k=ndcg_k)
+
+
+def segment_ranking_metrics(labels, scores, offsets, Ks=(2, 4, 6, 8, 10), ndcg_k=10):
+    """Compute AUC, MRR, Recall@K, MAP@K and NDCG@1..ndcg_k for every user at once.
+
+    The candidates of all users are stored flat, slate ``u`` being ``[offsets[u], offsets[u + 1])``, so slates may
+    have any length and any number of positives. The results agree with ``BaseModel.map_recall_at_k_multileveltobinary``
+    and ``BaseModel.normalized_discounted_cumulative_gain_matrix`` applied slate by slate, and the AUC counts, for
+    every positive, the negatives scored strictly lower.
+
+    :param labels: 1D array, relevance of every candidate (> 0 is a positive).
+    :param scores: 1D array, predicted scores.
+    :param offsets: 1D int array of length ``user_num + 1``, the CSR offsets of the slates. Slates must not be empty.
+    :param Ks: list of cut-offs for Recall@K and MAP@K.
+    :param ndcg_k: int, NDCG is returned for every cut-off in ``1..ndcg_k``.
+    :return: dict of per-user arrays: ``auc (U,)``, ``mrr (U,)``, ``recall (U, len(Ks))``, ``map (U, len(Ks))``,
+        ``ndcg (U, ndcg_k)``.
+    """
+    labels = np.asarray(labels, dtype=np.float64).reshape(-1)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    if offsets[0] != 0 or offsets[-1] != len(labels) or len(scores) != len(labels):
+        raise ValueError("offsets must start at 0 and end at len(labels) == len(scores)")
+    if np.any(lengths <= 0):
+        raise ValueError("every slate must contain at least one candidate")
+    user_num = len(lengths)
+    segment = np.repeat(np.arange(user_num), lengths)
+    position = np.arange(len(labels)) - starts[segment]  # 0-based position inside the slate
+
+    positive = labels > 0
+    pos_num = np.bincount(segment, weights=positive, minlength=user_num)
+    neg_num = lengths - pos_num
+
+    # AUC: ascending order inside every slate, ties share the negative count of the first element of their group
+    asc = np.lexsort((scores, segment))
+    asc_scores = scores[asc]
+    asc_neg = (~positive[asc]).astype(np.float64)
+    neg_below = _segment_cumsum(asc_neg, starts, segment) - asc_neg
+    group_start = position == 0
+    group_start[1:] |= asc_scores[1:] != asc_scores[:-1]
+    group_first = np.maximum.accumulate(np.where(group_start, np.arange(len(labels)), 0))
+    neg_strictly_below = neg_below[group_first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = np.bincount(segment, weights=neg_strictly_below * positive[asc], minlength=user_num) / (
+            pos_num * neg_num)
+
+    # ranking metrics: descending order inside every slate (the ascending order reversed)
+    desc = np.empty_like(asc)
+    desc[starts[segment] + lengths[segment] - 1 - position] = asc
+    ranked = positive[desc].astype(np.float64)
+    rank = position + 1
+    mrr = np.zeros(user_num)
+    np.maximum.at(mrr, segment, ranked / rank)
+    hits = _segment_cumsum(ranked, starts, segment)
+    precision_at_hits = _segment_cumsum(ranked * hits / rank, starts, segment)
+    recall = np.zeros((user_num, len(Ks)))
+    map_value = np.zeros((user_num, len(Ks)))
+    for i, k in enumerate(Ks):
+        cut_off = starts + np.minimum(k, lengths) - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            recall[:, i] = hits[cut_off] / pos_num
+            map_value[:, i] = np.where(hits[cut_off] > 0, precision_at_hits[cut_off] / np.maximum(hits[cut_off], 1),
+                                       0.)
+
+    # NDCG@1..ndcg_k with gains 2 ** label - 1; cut-offs beyond a slate keep the value of the whole slate
+    discount = 1. / np.log2(rank + 1)
+    dcg = _segment_cumsum((2 ** labels[desc] - 1) * discount, starts, segment)
+    ideal = np.lexsort((-labels, segment))
+    idcg = _segment_cumsum((2 ** labels[ideal] - 1) * discount, starts, segment)
+    ndcg = np.zeros((user_num, ndcg_k))
+    for k in range(1, ndcg_k + 1):
+        cut_off = starts + np.minimum(k, lengths) - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndcg[:, k - 1] = dcg[cut_off] / idcg[cut_off]
+
+    return {"auc": auc, "mrr": mrr, "recall": recall, "map": map_value, "ndcg": ndcg}
+
+
+def mean_over_users(metrics):
+    """Average the per-user arrays of ``segment_ranking_metrics`` over the users whose AUC, Recall and NDCG are all
+    defined, dropping the slates without a positive or without a negative.
+
+    :return: ``(means, dropped)``: dict of the averages (arrays for ``recall``, ``map`` and ``ndcg``) and the number
+        of users left out.
+    """
+    defined = np.isfinite(metrics["auc"]) & np.isfinite(metrics["recall"]).all(axis=1) & np.isfinite(
+        metrics["ndcg"]).all(axis=1)
+    if not defined.any():
+        raise ValueError("no slate holds both a positive and a negative")
+    return {name: values[defined].mean(axis=0) for name, values in metrics.items()}, int(np.sum(~defined))
+
+
+def _segment_cumsum(values, starts, segment):
+    # inclusive cumsum restarted at the beginning of every slate
+    cumsum = np.cumsum(values)
+    base = cumsum[starts] - values[starts]
+    return cumsum - base[segment]
@@ -7,6 +7,7 @@ Author:
 """
 from __future__ import print_function
 
+import os
 import pandas as pd
 import time
 import math
@@ -19,6 +20,7 @@ from sklearn.metrics import *
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import random
+from collections import OrderedDict, defaultdict
 import nni
 
 try:
@@ -26,11 +28,17 @@ try:
 except ImportError:
     from tensorflow.python.keras._impl.keras.callbacks import CallbackList
 
-from ..inputs import build_input_features, SparseFeat, DenseFeat, VarLenSparseFeat, get_varlen_pooling_list, \
-    create_embedding_matrix, varlen_embedding_lookup
+from ..inputs import build_input_features, SparseFeat, DenseFeat, VarLenSparseFeat, pooled_varlen_embedding_list, \
+    create_embedding_matrix, build_input_dtypes, build_typed_input, feature_input, InputBatchDataset, \
+    input_batch_size, FeatureGroup, FusedEmbedding, FusedEmbeddingView, fuse_embedding_matrix
 from ..layers import PredictionLayer
 from ..layers.utils import slice_arrays
 from ..callbacks import History
+from ..data import UserInteractionIndex, NegativeSampler, SAUCBatchDataset, ShardedInteractionIndex, \
+    ShardedSAUCBatchDataset
+from ..metrics import ranking_metrics, segment_ranking_metrics, mean_over_users
+from ..cached_embedding import CachedEmbedding
+from ..quantized_embedding import QuantizedEmbedding
 
 
 
@@ -38,7 +46,6 @@ class SmoothAUCLossLambda(nn.Module):
 
     def __init__(self):
         super(SmoothAUCLossLambda, self).__init__()
-        self.sigmoid = torch.nn.Sigmoid()
 
     def forward(self, sui, suj, tau=0.02):
         '''
@@ -51,22 +58,165 @@ class SmoothAUCLossLambda(nn.Module):
         assert len(sui.shape) == 2 and sui.shape[1] == 1, f"sui.shape=={sui.shape}"
         assert len(suj.shape) == 2 and suj.shape[0] == 1, f"sui.shape=={suj.shape}"
 
-        residual = sui - suj
-        pos_neg_mat = self.sigmoid(residual / tau)
-
-        lambda_weight = self.posrank(sui, suj).detach()
-
-        return 1 - torch.mean(torch.mul(pos_neg_mat, lambda_weight)), - torch.sum(torch.mul(pos_neg_mat, lambda_weight)), 1 - torch.sum(pos_neg_mat) / (sui.shape[0] * suj.shape[1])
+        mean_loss, sum_loss, sauc_loss = self.segment_forward(
+            sui, suj, torch.tensor([sui.shape[0]]), torch.tensor([suj.shape[1]]), tau=tau)
+        return mean_loss[0], sum_loss[0], sauc_loss[0]
         # return 1 - torch.sum(torch.mul(pos_neg_mat, lambda_weight))
 
-    def posrank(self, sui, suj):
-        sui = sui.reshape(-1)
-        suj = suj.reshape(-1)
-        data = torch.cat([sui, suj])
-        _, idx = data.sort(descending=False)
-        _, rank = idx.sort()  # 再对索引升序排列，得到其索引作为排名rank
-        k = len(sui)
-        return torch.abs(rank[:k].reshape(-1, 1) - rank[k:].reshape(1, -1)) / (len(sui) * len(suj))
+    def segment_forward(self, pos_pred, neg_pred, pos_lengths, neg_lengths, tau=0.02, tile_size=None):
+        '''
+        一个batch内所有用户的 weighted_sauc loss 计算，与逐用户调用 forward 的结果一致
+        pos_pred: torch.tensor(total_pos_num,)  按用户连续排列
+        neg_pred: torch.tensor(total_neg_num,)  按用户连续排列
+        pos_lengths / neg_lengths: torch.LongTensor(user_num,)  每个用户的正/负样本数
+        tile_size: None 时每块只受填充比例限制；否则每块（含填充）不超过 tile_size 个 pair，流式计算，
+                   峰值显存与 P×N 无关
+        return: 三个 torch.tensor(user_num,)，依次对应 forward 的三个返回值
+        '''
+        pos_pred = pos_pred.reshape(-1)
+        neg_pred = neg_pred.reshape(-1)
+        pos_lengths = pos_lengths.to(pos_pred.device)
+        neg_lengths = neg_lengths.to(neg_pred.device)
+        assert pos_pred.shape[0] == int(pos_lengths.sum()), f"pos_pred.shape=={pos_pred.shape}"
+        assert neg_pred.shape[0] == int(neg_lengths.sum()), f"neg_pred.shape=={neg_pred.shape}"
+
+        # 按长度相近分块，只在块内填充：开销与 sum(P×N) 同阶，而非 U×max(P)×max(N)
+        pairs = PairSegments(pos_lengths, neg_lengths, tile_size)
+        pos_rank, neg_rank = self.segment_rank(pos_pred, neg_pred, pairs)  # 只需排序，O((P+N)log(P+N))
+
+        # 前向一次得到两个 pair 求和，反向只保存分数向量并逐块重算 sigmoid
+        gap_sum, pair_sum = SmoothAUCLambdaFunction.apply(pos_pred, neg_pred, pos_rank, neg_rank, pairs, tau)
+
+        pair_num = pairs.pair_lengths.to(gap_sum.dtype)
+        weighted_sum = gap_sum / pair_num
+        return 1 - weighted_sum / pair_num, - weighted_sum, 1 - pair_sum / pair_num
+
+    def segment_rank(self, pos_pred, neg_pred, pairs):
+        # 每个用户的正样本在前、负样本在后连成一段；先按分数、再按用户稳定排序，段内的先后即该用户内的排名
+        # （同分时正样本在前，与单用户排序一致）。排名只在同一用户内相减，不必减去段的起点
+        users = torch.arange(pairs.pos_lengths.shape[0], device=pos_pred.device)
+        pos_user = torch.repeat_interleave(users, pairs.pos_lengths)
+        neg_user = torch.repeat_interleave(users, pairs.neg_lengths)
+        pos_at = torch.arange(pos_pred.shape[0], device=pos_pred.device) + pairs.neg_starts[pos_user]
+        neg_at = torch.arange(neg_pred.shape[0], device=neg_pred.device) + (pairs.pos_starts + pairs.pos_lengths)[
+            neg_user]
+        data = pos_pred.new_empty(pos_pred.shape[0] + neg_pred.shape[0])
+        data[pos_at] = pos_pred.detach()
+        data[neg_at] = neg_pred.detach()
+        data_user = torch.empty_like(data, dtype=torch.long)
+        data_user[pos_at] = pos_user
+        data_user[neg_at] = neg_user
+        _, idx = data.sort(stable=True)
+        _, by_user = data_user[idx].sort(stable=True)
+        rank = torch.empty_like(idx)
+        rank[idx[by_user]] = torch.arange(idx.shape[0], device=idx.device)
+        return rank[pos_at], rank[neg_at]
+
+
+class PairSegments(object):
+    """The (pos, neg) pairs of the consecutive per-user segments of a batch, in blocks of users of similar lengths.
+
+    Users are sorted by length and grouped while padding a block to ``[users, max(P), max(N)]`` at most doubles its
+    real pairs, so every pass costs about ``sum(P * N)``, not ``user_num * max(P) * max(N)``. With `tile_size` a block
+    also holds at most that many pairs, and a user with more pairs is cut into tiles of its own.
+
+    :param pos_lengths: 1D LongTensor, the number of positives of every user.
+    :param neg_lengths: 1D LongTensor, the number of negatives of every user.
+    :param tile_size: int or None, the most pairs in a block, padding included.
+    """
+
+    def __init__(self, pos_lengths, neg_lengths, tile_size=None):
+        self.pos_lengths = pos_lengths
+        self.neg_lengths = neg_lengths
+        self.pos_starts = torch.cumsum(pos_lengths, 0) - pos_lengths
+        self.neg_starts = torch.cumsum(neg_lengths, 0) - neg_lengths
+        self.pair_lengths = pos_lengths * neg_lengths
+        self.blocks = []  # (users, positions of the positives, positions of the negatives)
+        pos_host, neg_host = pos_lengths.tolist(), neg_lengths.tolist()
+        order = sorted((u for u in range(len(pos_host)) if pos_host[u] * neg_host[u] > 0),
+                       key=lambda u: (pos_host[u], neg_host[u]), reverse=True)
+        block, pos_max, neg_max, real = [], 0, 0, 0
+        for u in order:
+            pos_num, neg_num = pos_host[u], neg_host[u]
+            padded = (len(block) + 1) * max(pos_max, pos_num) * max(neg_max, neg_num)
+            if block and (padded > 2 * (real + pos_num * neg_num) or tile_size is not None and padded > tile_size):
+                self._add_block(block, pos_max, neg_max, tile_size)
+                block, pos_max, neg_max, real = [], 0, 0, 0
+            block.append(u)
+            pos_max, neg_max, real = max(pos_max, pos_num), max(neg_max, neg_num), real + pos_num * neg_num
+        if block:
+            self._add_block(block, pos_max, neg_max, tile_size)
+
+    def _add_block(self, users, pos_max, neg_max, tile_size):
+        device = self.pos_lengths.device
+        pos_tile, neg_tile = pos_max, neg_max
+        if tile_size is not None and pos_max * neg_max > tile_size:
+            # a single user: tiles of about sqrt(tile_size) x sqrt(tile_size) of its own pairs
+            neg_tile = max(1, min(neg_max, int(math.sqrt(tile_size))))
+            pos_tile = max(1, tile_size // neg_tile)
+        users = torch.tensor(users, device=device)
+        for i in range(0, pos_max, pos_tile):
+            for j in range(0, neg_max, neg_tile):
+                self.blocks.append((users, torch.arange(i, min(i + pos_tile, pos_max), device=device),
+                                    torch.arange(j, min(j + neg_tile, neg_max), device=device)))
+
+    @staticmethod
+    def gather(starts, lengths, users, positions):
+        """Indices ``[users, positions]`` into the flat vector of the segments, 0 where padded, and the valid mask."""
+        mask = positions.unsqueeze(0) < lengths[users].unsqueeze(1)
+        return (starts[users].unsqueeze(1) + positions.unsqueeze(0)) * mask, mask
+
+
+class SmoothAUCLambdaFunction(torch.autograd.Function):
+    """Fused rank-gap weighted sigmoid pairwise sums.
+
+    For the flat scores ``pos_pred`` / ``neg_pred`` of the users of ``pairs`` (a ``PairSegments``) returns, per user,
+    ``sum(s_ij * |rank_i - rank_j|)`` and ``sum(s_ij)`` over its pairs, with ``s_ij = sigmoid((pos_i - neg_j) /
+    tau)``. No pair matrix is kept for backward: only the score vectors and ranks are saved and ``s * (1 - s) / tau``
+    is recomputed block by block, so both passes hold at most one block of pairs.
+    """
+
+    @staticmethod
+    def forward(ctx, pos_pred, neg_pred, pos_rank, neg_rank, pairs, tau):
+        ctx.save_for_backward(pos_pred, neg_pred, pos_rank, neg_rank)
+        ctx.pairs = pairs
+        ctx.tau = tau
+        gap_sum = pos_pred.new_zeros(pairs.pos_lengths.shape[0])
+        pair_sum = pos_pred.new_zeros(pairs.pos_lengths.shape[0])
+        for users, pos_index, neg_index, pos_neg_mat, rank_gap in _pair_blocks(pos_pred, neg_pred, pos_rank,
+                                                                                neg_rank, pairs, tau):
+            gap_sum.index_add_(0, users, torch.sum(pos_neg_mat * rank_gap, dim=(1, 2)))
+            pair_sum.index_add_(0, users, torch.sum(pos_neg_mat, dim=(1, 2)))
+        return gap_sum, pair_sum
+
+    @staticmethod
+    def backward(ctx, grad_gap_sum, grad_pair_sum):
+        pos_pred, neg_pred, pos_rank, neg_rank = ctx.saved_tensors
+        grad_pos = torch.zeros_like(pos_pred) if ctx.needs_input_grad[0] else None
+        grad_neg = torch.zeros_like(neg_pred) if ctx.needs_input_grad[1] else None
+        for users, pos_index, neg_index, pos_neg_mat, rank_gap in _pair_blocks(pos_pred, neg_pred, pos_rank,
+                                                                                neg_rank, ctx.pairs, ctx.tau):
+            # d s_ij / d pos_i = - d s_ij / d neg_j = s_ij * (1 - s_ij) / tau；填充处 s_ij 为 0，梯度也为 0
+            grad_mat = pos_neg_mat * (1 - pos_neg_mat) / ctx.tau * (
+                    grad_gap_sum[users].view(-1, 1, 1) * rank_gap + grad_pair_sum[users].view(-1, 1, 1))
+            if grad_pos is not None:
+                grad_pos.index_add_(0, pos_index.reshape(-1), torch.sum(grad_mat, dim=2).reshape(-1))
+            if grad_neg is not None:
+                grad_neg.index_add_(0, neg_index.reshape(-1), -torch.sum(grad_mat, dim=1).reshape(-1))
+        return grad_pos, grad_neg, None, None, None, None
+
+
+def _pair_blocks(pos_pred, neg_pred, pos_rank, neg_rank, pairs, tau):
+    for users, pos_positions, neg_positions in pairs.blocks:
+        pos_index, pos_mask = pairs.gather(pairs.pos_starts, pairs.pos_lengths, users, pos_positions)  # [U, P]
+        neg_index, neg_mask = pairs.gather(pairs.neg_starts, pairs.neg_lengths, users, neg_positions)  # [U, N]
+        # 无效 pair 的 sigmoid 置 0，其梯度 s(1-s) 也随之为 0
+        pair_mask = pos_mask.unsqueeze(2) & neg_mask.unsqueeze(1)
+        pos_neg_mat = torch.sigmoid((pos_pred[pos_index].unsqueeze(2) - neg_pred[neg_index].unsqueeze(1)) / tau)
+        pos_neg_mat = pos_neg_mat * pair_mask
+        rank_gap = torch.abs(pos_rank[pos_index].unsqueeze(2) - neg_rank[neg_index].unsqueeze(1))
+        rank_gap = rank_gap.to(pos_neg_mat.dtype)
+        yield users, pos_index, neg_index, pos_neg_mat, rank_gap
 
 
 
@@ -82,6 +232,9 @@ class Linear(nn.Module):
 
         self.varlen_sparse_feature_columns = list(
             filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if len(feature_columns) else []
+        self.feature_group = FeatureGroup(feature_columns, feature_index)
+        # set by BaseModel.fuse_embeddings
+        self.fused_embedding = None
 
         self.embedding_dict = create_embedding_matrix(feature_columns, init_std, linear=True, sparse=False,
                                                       device=device)
@@ -101,21 +254,21 @@ class Linear(nn.Module):
 
     def forward(self, X, sparse_feat_refine_weight=None):
 
-        sparse_embedding_list = [self.embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()
-        ) for feat in self.sparse_feature_columns]
+        group = self.feature_group
+        if self.fused_embedding is not None:
+            sparse_embedding_list = self.fused_embedding.lookup_group(X, group, self.embedding_dict, linear=True)
+        else:
+            sparse_embedding_list = [self.embedding_dict[feat.embedding_name](ids) for feat, ids in
+                                     zip(group.sparse, group.sparse_ids(X))]
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
-                            self.dense_feature_columns]
+        dense_value_list = group.dense_values(X)
 
-        sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
-                                                      self.varlen_sparse_feature_columns)
-        varlen_embedding_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                        self.varlen_sparse_feature_columns, self.device)
+        varlen_embedding_list = pooled_varlen_embedding_list(X, self.embedding_dict, self.feature_index,
+                                                             self.varlen_sparse_feature_columns)
 
         sparse_embedding_list += varlen_embedding_list
 
-        linear_logit = torch.zeros([X.shape[0], 1]).to(sparse_embedding_list[0].device)
+        linear_logit = torch.zeros([input_batch_size(X), 1]).to(sparse_embedding_list[0].device)
         if len(sparse_embedding_list) > 0:
             sparse_embedding_cat = torch.cat(sparse_embedding_list, dim=-1)
             if sparse_feat_refine_weight is not None:
@@ -131,6 +284,50 @@ class Linear(nn.Module):
         return linear_logit
 
 
+def _with_next(iterable):
+    # (item, next item or None), so that the next batch can be announced before the current one is trained on
+    iterator = iter(iterable)
+    current = next(iterator, None)
+    while current is not None:
+        upcoming = next(iterator, None)
+        yield current, upcoming
+        current = upcoming
+
+
+def _scaled_sums(tensors, scale, ord):
+    # sum(scale * |w|) (ord 1) or sum(scale * w ** 2) (ord 2) of every weight, the elementwise work in fused kernels
+    # where available; the same operations as term by term, so the same numbers and gradients
+    if hasattr(torch, "_foreach_pow"):
+        values = torch._foreach_abs(tensors) if ord == 1 else torch._foreach_pow(tensors, 2)
+        return [value.sum() for value in torch._foreach_mul(values, scale)]
+    return [torch.sum(scale * (torch.abs(tensor) if ord == 1 else torch.square(tensor))) for tensor in tensors]
+
+
+class SparseDenseOptimizer(object):
+    """Pair of optimizers stepped together: a sparse one over the embedding tables and a dense one over the other
+    parameters. Either may be None."""
+
+    def __init__(self, sparse_optim, dense_optim):
+        self.sparse_optim = sparse_optim
+        self.dense_optim = dense_optim
+        self.optimizers = [optim for optim in (sparse_optim, dense_optim) if optim is not None]
+
+    def zero_grad(self, set_to_none=True):
+        for optim in self.optimizers:
+            optim.zero_grad(set_to_none=set_to_none)
+
+    def step(self):
+        for optim in self.optimizers:
+            optim.step()
+
+    def state_dict(self):
+        return [optim.state_dict() for optim in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optim, state_dict in zip(self.optimizers, state_dicts):
+            optim.load_state_dict(state_dict)
+
+
 class BaseModel(nn.Module):
     def __init__(self, linear_feature_columns, dnn_feature_columns, lr=0.01, l2_reg_linear=1e-5, l2_reg_embedding=1e-5,
                  init_std=0.0001, seed=1024, task='binary', device='cpu', gpus=None):
@@ -152,6 +349,20 @@ class BaseModel(nn.Module):
                 "`gpus[0]` should be the same gpu with `device`")
 
         self.feature_index = build_input_features(linear_feature_columns + dnn_feature_columns)
+        # ids are fed as int64 and dense values as float32, see build_typed_input
+        self.input_dtypes = build_input_dtypes(linear_feature_columns + dnn_feature_columns)
+        # the lookups of dnn_feature_columns resolved once instead of on every forward, see input_from_feature_columns
+        self.dnn_feature_group = FeatureGroup(dnn_feature_columns, self.feature_index)
+        # optional single-table embedding store, see fuse_embeddings
+        self.fused_embedding = None
+        # sparse gradients for the embedding tables, see set_sparse_embedding
+        self.sparse_embedding = False
+        self._sparse_tables = set()
+        # how the embedding tables are regularized, see set_embedding_regularization
+        self.embedding_regularization = "full"
+        self._batch_lookups = []
+        self._lookup_hooks = []
+        self._regularization_plan = None
         # 下面只为深度模块要用到的特征列，进行。。。
         self.embedding_dict = create_embedding_matrix(dnn_feature_columns, init_std, sparse=False, device=device)
         #         nn.ModuleDict(
@@ -174,9 +385,10 @@ class BaseModel(nn.Module):
         self._is_graph_network = True  # used for ModelCheckpoint in tf2
         self._ckpt_saved_epoch = False  # used for EarlyStopping in tf1.14
         self.history = History()
+        self.interaction_index = None
 
     def fit(self, x=None, y=None, batch_size=None, epochs=1, verbose=1, initial_epoch=0, validation_split=0.,
-            validation_data=None, shuffle=True, callbacks=None):
+            validation_data=None, shuffle=True, callbacks=None, validation_slate_offsets=None):
         """
 
         :param x: Numpy array of training data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).If input layers in the model are named, you can also pass a
@@ -190,6 +402,7 @@ class BaseModel(nn.Module):
         :param validation_data: tuple `(x_val, y_val)` or tuple `(x_val, y_val, val_sample_weights)` on which to evaluate the loss and any model metrics at the end of each epoch. The model will not be trained on this data. `validation_data` will override `validation_split`.
         :param shuffle: Boolean. Whether to shuffle the order of the batches at the beginning of each epoch.
         :param callbacks: List of `deepctr_torch.callbacks.Callback` instances. List of callbacks to apply during training and validation (if ). See [callbacks](https://tensorflow.google.cn/api_docs/python/tf/keras/callbacks). Now available: `EarlyStopping` , `ModelCheckpoint`
+        :param validation_slate_offsets: 1D int array or `None`. CSR offsets of the users' slates in `validation_data`, see ``evaluate_personal``. If `None`, the validation data is made of 101-row slates, positive first.
 
         :return: A `History` object. Its `History.history` attribute is a record of training loss values and metrics values at successive epochs, as well as validation loss values and validation metrics values (if applicable).
         """
@@ -229,14 +442,9 @@ class BaseModel(nn.Module):
         else:
             val_x = []
             val_y = []
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        train_tensor_data = Data.TensorDataset(
-            torch.from_numpy(
-                np.concatenate(x, axis=-1)),
-            torch.from_numpy(y))
+        x = build_typed_input(x, self.feature_index, self.input_dtypes)
+        # a batch is gathered with one indexing per input instead of collated row by row
+        train_tensor_data = InputBatchDataset(*x.values(), torch.from_numpy(np.asarray(y)))
         if batch_size is None:
             batch_size = 256
 
@@ -251,8 +459,10 @@ class BaseModel(nn.Module):
         else:
             print(self.device)
 
+        sampler = Data.RandomSampler(train_tensor_data) if shuffle else Data.SequentialSampler(train_tensor_data)
         train_loader = DataLoader(
-            dataset=train_tensor_data, shuffle=shuffle, batch_size=batch_size)
+            dataset=train_tensor_data, sampler=Data.BatchSampler(sampler, batch_size, drop_last=False),
+            batch_size=None)
 
         sample_num = len(train_tensor_data)
         steps_per_epoch = (sample_num - 1) // batch_size + 1
@@ -280,9 +490,9 @@ class BaseModel(nn.Module):
             # myloss_set = []
             try:
                 with tqdm(enumerate(train_loader), disable=verbose != 1) as t:
-                    for _, (x_train, y_train) in t:
-                        x = x_train.to(self.device).float()
-                        y = y_train.to(self.device).float()
+                    for _, batch in t:
+                        x = {feature: value.to(self.device) for feature, value in zip(self.feature_index, batch[:-1])}
+                        y = batch[-1].to(self.device).float()
 
                         y_pred = model(x).squeeze()
 
@@ -326,7 +536,7 @@ class BaseModel(nn.Module):
 
             if do_validation:
                 # eval_result = self.evaluate(val_x, val_y, batch_size)
-                eval_result = self.evaluate_personal(val_x, val_y, batch_size)
+                eval_result = self.evaluate_personal(val_x, val_y, batch_size, slate_offsets=validation_slate_offsets)
                 for name, result in eval_result.items():
                     epoch_logs["val_" + name] = result
             # verbose
@@ -347,6 +557,8 @@ class BaseModel(nn.Module):
                     for name in self.metrics:
                         eval_str += " - " + "val_" + name + \
                                     ": {0: .4f}".format(epoch_logs["val_" + name])
+                    if epoch_logs.get("val_dropped_users"):
+                        eval_str += " - val_dropped_users: {0}".format(epoch_logs["val_dropped_users"])
                 print(eval_str)
             callbacks.on_epoch_end(epoch, epoch_logs)
             if self.stop_training:
@@ -357,12 +569,13 @@ class BaseModel(nn.Module):
         return self.history
 
     def fit_SAUC_Lambda(self, logger, x=None, train_data=None, batch_size=None, epochs=1, verbose=1, initial_epoch=0, validation_split=0.,
-            validation_data=None, shuffle=True, callbacks=None, tau=0.02, items_data=None, items_num=16980,lr=0.01):
+            validation_data=None, shuffle=True, callbacks=None, tau=0.02, items_data=None, items_num=16980,lr=0.01,
+            neg_sampler=None, num_workers=0, prefetch_factor=2, pair_tile_size=1 << 17, validation_slate_offsets=None,
+            sparse_embedding=False, sparse_optimizer="sparse_adam", embedding_regularization=None, sampler_kwargs=None):
         """
-                train_data: DataFrame
-        :param x: Numpy array of training data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).If input layers in the model are named, you can also pass a
-            dictionary mapping input names to Numpy arrays.
-        :param y: Numpy array of target (label) data (if the model has a single output), or list of Numpy arrays (if the model has multiple outputs).
+
+        :param x: ``UserInteractionIndex`` holding every user's training positives, or the list of ``(user, start, end)`` tuples of ``train3.pickle`` (the index is then built from ``train_data``), or a ``ShardedInteractionIndex`` for logs larger than memory, whose shards are then loaded one at a time.
+        :param train_data: DataFrame (or dict of columns) of the training positives ``(userInt, newsInt, label, ...)``. Needed when `x` is a list of tuples, and when the model has input features besides the user and the item: these are gathered from the rows of `train_data` the positives come from (``x.source_rows``), and a negative takes those of a positive of the same user.
         :param batch_size: Integer or `None`. Number of samples per gradient update. If unspecified, `batch_size` will default to 256.
         :param epochs: Integer. Number of epochs to train the model. An epoch is an iteration over the entire `x` and `y` data provided. Note that in conjunction with `initial_epoch`, `epochs` is to be understood as "final epoch". The model is not trained for a number of iterations given by `epochs`, but merely until the epoch of index `epochs` is reached.
         :param verbose: Integer. 0, 1, or 2. Verbosity mode. 0 = silent, 1 = progress bar, 2 = one line per epoch.
@@ -371,13 +584,37 @@ class BaseModel(nn.Module):
         :param validation_data: tuple `(x_val, y_val)` or tuple `(x_val, y_val, val_sample_weights)` on which to evaluate the loss and any model metrics at the end of each epoch. The model will not be trained on this data. `validation_data` will override `validation_split`.
         :param shuffle: Boolean. Whether to shuffle the order of the batches at the beginning of each epoch.
         :param callbacks: List of `deepctr_torch.callbacks.Callback` instances. List of callbacks to apply during training and validation (if ). See [callbacks](https://tensorflow.google.cn/api_docs/python/tf/keras/callbacks). Now available: `EarlyStopping` , `ModelCheckpoint`
+        :param validation_slate_offsets: 1D int array or `None`. CSR offsets of the users' slates in `validation_data`, see ``evaluate_personal``. If `None`, the validation data is made of 101-row slates, positive first.
+        :param items_num: Integer. Negatives are drawn from ``[0, items_num)`` when `neg_sampler` is None.
+        :param neg_sampler: ``NegativeSampler`` built on `x`. If None, a uniform one-negative-per-positive sampler seeded from the global `random` state is used. Not used with a ``ShardedInteractionIndex``, see `sampler_kwargs`.
+        :param num_workers: Integer. Number of worker processes building batches (positives and negatives) ahead of the training step. 0 builds them on the main thread.
+        :param prefetch_factor: Integer. Number of batches each worker keeps ready in advance.
+        :param pair_tile_size: Integer or `None`. The pairwise loss is streamed over tiles of at most this many (pos, neg) pairs, padding included, which caps the loss memory for users with thousands of interactions. `None` puts no bound on a block of users of similar lengths, which is built at once.
+        :param sparse_embedding: Boolean. If True, the embedding tables get sparse gradients holding only the rows of the batch, and are updated by `sparse_optimizer` while the other parameters keep a dense Adam, so the cost of a step follows the rows touched and not the vocabulary sizes. The full-table L1/L2 terms of the embedding tables are then skipped, see ``set_sparse_embedding``.
+        :param sparse_optimizer: String. ``"sparse_adam"`` or ``"adagrad"``, the optimizer of the embedding tables when `sparse_embedding` is True.
+        :param embedding_regularization: String or `None`. ``"full"`` or ``"batch"``, see ``set_embedding_regularization``. `None` picks ``"batch"`` with `sparse_embedding` and ``"full"`` otherwise.
+        :param sampler_kwargs: dict or `None`. With a ``ShardedInteractionIndex``, keyword arguments (``mode``, ``neg_ratio``...) of the ``NegativeSampler`` built for every shard.
 
         :return: A `History` object. Its `History.history` attribute is a record of training loss values and metrics values at successive epochs, as well as validation loss values and validation metrics values (if applicable).
         """
         if isinstance(x, dict):
             x = [x[feature] for feature in self.feature_index]
 
-        train_data_pos: pd.DataFrame  # (sample_num x (uid, iid, label=1))
+        if not isinstance(x, (UserInteractionIndex, ShardedInteractionIndex)):
+            x = UserInteractionIndex.from_user_list(x, train_data)
+        if isinstance(x, ShardedInteractionIndex) and neg_sampler is not None:
+            raise ValueError("a ShardedInteractionIndex builds a NegativeSampler per shard, pass sampler_kwargs "
+                             "instead of neg_sampler")
+        if isinstance(x, UserInteractionIndex):
+            # 记录训练正样本，recommend 默认据此过滤已交互物品
+            self.interaction_index = x
+            if neg_sampler is None:
+                neg_sampler = NegativeSampler(x, items_num, seed=random.getrandbits(32))
+        # 用户、物品以外的输入特征按正样本在 train_data 中的行取出
+        side_input = self.side_feature_input(train_data, x.user_col, x.item_col)
+        if side_input is not None and not (isinstance(x, UserInteractionIndex) and x.source_rows is not None):
+            raise ValueError("the input features %s are read from the rows of train_data, which needs a "
+                             "UserInteractionIndex with source_rows" % list(side_input))
 
         do_validation = False
         if validation_data:
@@ -408,7 +645,23 @@ class BaseModel(nn.Module):
         model = self.train()
         loss_func = self.loss_func
         # optim = self.optim
-        optim = torch.optim.Adam(self.parameters(), lr=lr)
+        self.set_sparse_embedding(sparse_embedding)
+        if embedding_regularization is None:
+            embedding_regularization = "batch" if sparse_embedding else "full"
+        self.set_embedding_regularization(embedding_regularization)
+        if sparse_embedding:
+            # 稀疏梯度：每步只更新本 batch 用到的 embedding 行
+            optim = self._get_sparse_optim(sparse_optimizer, lr)
+            if embedding_regularization == "full" and any(
+                    (l1 > 0 or l2 > 0) and any(self._is_sparse_table(w) for w in weight_list)
+                    for weight_list, l1, l2 in self.regularization_weight):
+                logger.warning("sparse_embedding: the L1/L2 terms of the embedding tables are not applied, "
+                               "use embedding_regularization='batch'")
+        else:
+            optim = torch.optim.Adam(self.parameters(), lr=lr)
+        cached_tables = [module for module in self.modules() if isinstance(module, CachedEmbedding)]
+        for module in cached_tables:
+            module.register_optimizer(optim)
 
         if self.gpus:
             logger.warning('parallel running on these gpus:', self.gpus)
@@ -417,10 +670,20 @@ class BaseModel(nn.Module):
         else:
             logger.warning(self.device)
 
-        train_loader = DataLoader(dataset=x, shuffle=shuffle, batch_size=batch_size)
+        if isinstance(x, ShardedInteractionIndex):
+            # 数据大于内存：逐个载入用户分片，每个分片单独建立负采样器
+            train_dataset = ShardedSAUCBatchDataset(x, items_num, batch_size, shuffle=shuffle,
+                                                    seed=random.getrandbits(32), sampler_kwargs=sampler_kwargs)
+        else:
+            train_dataset = SAUCBatchDataset(x, neg_sampler, batch_size, shuffle=shuffle,
+                                             source_rows=side_input is not None)
+        loader_kwargs = {"num_workers": num_workers, "pin_memory": "cuda" in str(self.device)}
+        if num_workers > 0:
+            loader_kwargs["prefetch_factor"] = prefetch_factor
+        train_loader = DataLoader(dataset=train_dataset, batch_size=None, **loader_kwargs)
 
         sample_num = len(x)
-        steps_per_epoch = (sample_num - 1) // batch_size + 1
+        steps_per_epoch = len(train_dataset)
 
         # configure callbacks
         callbacks = (callbacks or []) + [self.history]  # add history callback
@@ -446,46 +709,41 @@ class BaseModel(nn.Module):
             total_loss_epoch = 0
             total_sauc_loss = 0
             train_result = {}
+            train_dataset.set_epoch(epoch)
             try:
-                with tqdm(enumerate(train_loader), disable=verbose == 1) as t:
-                    for _, (u, start, end) in t:
-                        mean_loss, sum_loss = 0.0, 0.0
-                        u = u.numpy()
-                        start = start.numpy()
-                        end = end.numpy()
-                        if len(u) == 0:
-                            continue
-                        for i in range(len(u)):
-                            pos_data = train_data.iloc[start[i]: end[i], :]  # userInt newsInt label
-                            u_pos = set(pos_data.newsInt.values)
-                            neg_data = pd.DataFrame(pos_data, copy=True)
-                            neg_data.label = 0
-                            neg_data.reset_index(drop=True, inplace=True)
-                            idx = 0
-                            for _ in range(len(u_pos)):
-                                while True:
-                                    neg_idx = random.randint(0, items_num - 1)
-                                    if neg_idx not in u_pos:
-                                        neg_data.loc[idx, "newsInt"] = neg_idx
-                                        idx += 1
-                                        break
-
-                            x_pos = torch.tensor(pos_data.drop(columns="label").astype(float).to_numpy()).to(self.device).float()
-                            x_neg = torch.tensor(neg_data.drop(columns="label").astype(float).to_numpy()).to(self.device).float()
-
-                            pos_pred = model(x_pos)
-                            neg_pred = model(x_neg)
-                            mean_loss_single, sum_loss_single, sauc_loss = loss_func(pos_pred, neg_pred, tau=tau)
-                            mean_loss += mean_loss_single
-                            sum_loss += sum_loss_single
-                            total_sauc_loss += sauc_loss.item()
-                        mean_loss /= len(u)
-                        sum_loss /= len(u)
+                batches = _with_next(train_loader) if cached_tables else ((batch, None) for batch in train_loader)
+                with tqdm(enumerate(batches), total=steps_per_epoch, disable=verbose == 1) as t:
+                    for _, (batch, upcoming) in t:
+                        user_ids, pos_items, pos_lengths, neg_items, neg_lengths = batch[:5]
+                        if upcoming is not None:
+                            # 磁盘上的 embedding 表：下一个 batch 的行在后台提前读入
+                            self.prefetch_embeddings({x.user_col: upcoming[0],
+                                                      x.item_col: torch.cat([upcoming[1], upcoming[3]])})
+                        user_ids = user_ids.to(self.device, non_blocking=True)
+                        pos_items = pos_items.to(self.device, non_blocking=True)
+                        neg_items = neg_items.to(self.device, non_blocking=True)
+                        pos_lengths = pos_lengths.to(self.device, non_blocking=True)
+                        neg_lengths = neg_lengths.to(self.device, non_blocking=True)
+
+                        # 整个batch的正负样本拼接后只做一次前向，再按用户分段计算 loss
+                        x_batch = self.user_item_input(
+                            torch.cat([torch.repeat_interleave(user_ids, pos_lengths),
+                                       torch.repeat_interleave(user_ids, neg_lengths)]),
+                            torch.cat([pos_items, neg_items]), x.user_col, x.item_col,
+                            side_input=side_input, side_rows=torch.cat(batch[5:]) if side_input is not None else None)
+                        y_pred = model(x_batch).reshape(-1)
+                        pos_num = int(pos_lengths.sum())
+                        mean_loss, sum_loss, sauc_loss = loss_func.segment_forward(
+                            y_pred[:pos_num], y_pred[pos_num:], pos_lengths, neg_lengths, tau=tau,
+                            tile_size=pair_tile_size)
+                        mean_loss = mean_loss.mean()
+                        sum_loss = sum_loss.mean()
+                        total_sauc_loss += sauc_loss.sum().item()
                         # assert loss <= 1, f"smooth auc loss 必定小于1， 但是这里loss={loss}, len(u)={len(u)}"
                         optim.zero_grad()
                         reg_loss = self.get_regularization_loss()
                         total_loss = sum_loss + reg_loss + self.aux_loss
-                        total_sauc_loss /= len(u)
+                        total_sauc_loss /= len(user_ids)
                         # total_loss = loss
 
                         # nni.report_intermediate_result(total_loss.item())
@@ -515,7 +773,7 @@ class BaseModel(nn.Module):
 
             if do_validation:
                 # eval_result = self.evaluate(val_x, val_y, batch_size)
-                eval_result = self.evaluate_personal(val_x, val_y)
+                eval_result = self.evaluate_personal(val_x, val_y, slate_offsets=validation_slate_offsets)
                 for name, result in eval_result.items():
                     epoch_logs["val_" + name] = result
             # verbose
@@ -533,6 +791,8 @@ class BaseModel(nn.Module):
                 if do_validation:
                     for name in self.metrics:
                         eval_str += " - " + "val_" + name + ": {0: .4f}".format(epoch_logs["val_" + name])
+                    if epoch_logs.get("val_dropped_users"):
+                        eval_str += " - val_dropped_users: {0}".format(epoch_logs["val_dropped_users"])
 
                 # for idx, (name, parameter) in enumerate(model.named_parameters()):
                 #     logger.warning(name, ":", parameter)
@@ -549,6 +809,7 @@ class BaseModel(nn.Module):
                 break
 
         callbacks.on_train_end()
+        self.flush_embeddings()
 
         return self.history, best_val_score, best_model_params
 
@@ -567,40 +828,43 @@ class BaseModel(nn.Module):
             eval_result[name] = metric_fun(y, pred_ans)
         return eval_result
 
-    def evaluate_personal(self, x, y, batch_size=101):
+    def evaluate_personal(self, x, y, batch_size=101 * 256, slate_offsets=None):
         """
 
         :param x: Numpy array of test data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).
         :param y: Numpy array of target (label) data (if the model has a single output), or list of Numpy arrays (if the model has multiple outputs).
-        :param batch_size: Integer or `None`. Number of samples per evaluation step. If unspecified, `batch_size` will default to 256.
-        :return: Dict contains metric names and metric values.
+        :param batch_size: Integer or `None`. Number of samples per evaluation step. Slates of 101 rows are scored together, so any value works; defaults to 101 * 256 (256 users).
+        :param slate_offsets: 1D int array or `None`. CSR offsets of the users' slates, user ``u`` owning rows ``[slate_offsets[u], slate_offsets[u + 1])``; slates may have any length and any number of positives (see ``deepctr_torch.metrics.slate_offsets``). If `None`, every 101 consecutive rows are one user's slate, positive first.
+        :return: Dict contains metric names and metric values. The personal metrics average the users whose slate holds both a positive and a negative, ``dropped_users`` counts the others.
         """
-        i = 0
-        while i < len(y):
-            assert y[i] == 1
-            assert np.sum(y[i:i + 101]) == 1
-            i += 101
-        pred_ans, auc_personal = self.predict_personal(x, batch_size)
+        if slate_offsets is None:
+            slates = np.asarray(y).reshape(-1, 101)
+            assert np.all(slates[:, 0] == 1)
+            assert np.all(np.sum(slates, axis=1) == 1)
+        pred_ans = self.predict(x, batch_size)
+        means, dropped_users = mean_over_users(self._personal_metrics(pred_ans, y, slate_offsets))
         eval_result = {}
         for name, metric_fun in self.metrics.items():
             if name == "auc_personal":
                 continue
             eval_result[name] = metric_fun(y, pred_ans)
-        eval_result["auc_personal"] = np.mean(auc_personal)
+        eval_result["auc_personal"] = means["auc"]
+        eval_result["dropped_users"] = dropped_users
         return eval_result
 
-    def test_personal(self, x, y, batch_size=101):
+    def test_personal(self, x, y, batch_size=101 * 256, slate_offsets=None):
         """
         :param x: Numpy array of test data (if the model has a single input), or list of Numpy arrays (if the model has multiple inputs).
         :param y: Numpy array of target (label) data (if the model has a single output), or list of Numpy arrays (if the model has multiple outputs).
-        :param batch_size: Integer or `None`. Number of samples per evaluation step. If unspecified, `batch_size` will default to 256.
-        :return: Dict contains metric names and metric values.
+        :param batch_size: Integer or `None`. Number of samples per evaluation step. Slates of 101 rows are scored together, so any value works; defaults to 101 * 256 (256 users).
+        :param slate_offsets: 1D int array or `None`. CSR offsets of the users' slates, see ``evaluate_personal``.
+        :return: Dict contains metric names and metric values, averaged over users as in ``evaluate_personal``.
         """
-        i = 0
-        while i < len(y):
-            assert y[i] == 1
-            i += 101
-        pred_ans, auc_personal, map, mrr, NDCG, recall = self.test_predict_personal(x, batch_size)
+        if slate_offsets is None:
+            assert np.all(np.asarray(y).reshape(-1, 101)[:, 0] == 1)
+        pred_ans = self.predict(x, batch_size)
+        means, dropped_users = mean_over_users(self._personal_metrics(pred_ans, y, slate_offsets))
+        auc_personal, map, mrr, NDCG, recall = means["auc"], means["map"], means["mrr"], means["ndcg"], means["recall"]
         eval_result = {}
         for name, metric_fun in self.metrics.items():
             if name == "auc_personal":
@@ -611,6 +875,7 @@ class BaseModel(nn.Module):
         eval_result["map 2 4 6 8 10"] = map
         eval_result["NDCG"] = NDCG
         eval_result["recall 2 4 6 8 10"] = recall
+        eval_result["dropped_users"] = dropped_users
         return eval_result
 
     def predict(self, x, batch_size=256):
@@ -621,101 +886,60 @@ class BaseModel(nn.Module):
         :return: Numpy array(s) of predictions.
         """
         model = self.eval()
-        if isinstance(x, dict):
-            x = [x[feature] for feature in self.feature_index]
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
+        # slice the tensors directly: a DataLoader over a TensorDataset indexes and collates row by row
+        x_all = build_typed_input(x, self.feature_index, self.input_dtypes)
 
         pred_ans = []
         with torch.no_grad():
-            for _, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
+            for start in range(0, input_batch_size(x_all), batch_size):
+                x = {feature: value[start:start + batch_size].to(self.device) for feature, value in x_all.items()}
 
                 y_pred = model(x).cpu().data.numpy()  # .squeeze()
                 pred_ans.append(y_pred)
 
         return np.concatenate(pred_ans).astype("float64")
 
-    def predict_personal(self, x, batch_size=101):
+    def predict_personal(self, x, batch_size=101 * 256, y=None, slate_offsets=None):
         """
 
-        :param x: The input data, as a Numpy array (or list of Numpy arrays if the model has multiple inputs).
-        :param batch_size: Integer. If unspecified, it will default to 256.
-        :return: Numpy array(s) of predictions.
+        :param x: The input data, as a Numpy array (or list of Numpy arrays if the model has multiple inputs). Every 101 consecutive rows are one user's slate, positive first, unless `slate_offsets` is given.
+        :param batch_size: Integer. Number of rows scored per forward pass.
+        :param y: Numpy array of labels, required with `slate_offsets`.
+        :param slate_offsets: 1D int array or `None`. CSR offsets of the users' slates, see ``evaluate_personal``.
+        :return: Numpy array(s) of predictions and the AUC of every user, NaN for a slate without a positive or without a negative.
         """
-        model = self.eval()
-        if isinstance(x, dict):
-            x = [x[feature] for feature in self.feature_index]
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
-
-        pred_ans = []
-        auc_personal = []
-        with torch.no_grad():
-            for _, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
-
-                y_pred = model(x).cpu().data.numpy()  # .squeeze()
-                pred_ans.append(y_pred)
-                count = np.sum([y_pred[1:] < y_pred[0]])
-                assert count <= 100
-                auc_personal.append(count/100)
-        return np.concatenate(pred_ans).astype("float64"), auc_personal
-
+        pred_ans = self.predict(x, batch_size)
+        return pred_ans, self._personal_metrics(pred_ans, y, slate_offsets)["auc"]
 
-    def test_predict_personal(self, x, batch_size=101):
+    def test_predict_personal(self, x, batch_size=101 * 256, y=None, slate_offsets=None):
         """
 
-        :param x: The input data, as a Numpy array (or list of Numpy arrays if the model has multiple inputs).
-        :param batch_size: Integer. If unspecified, it will default to 256.
-        :return: Numpy array(s) of predictions.
+        :param x: The input data, as a Numpy array (or list of Numpy arrays if the model has multiple inputs). Every 101 consecutive rows are one user's slate, positive first, unless `slate_offsets` is given.
+        :param batch_size: Integer. Number of rows scored per forward pass.
+        :param y: Numpy array of labels, required with `slate_offsets`.
+        :param slate_offsets: 1D int array or `None`. CSR offsets of the users' slates, see ``evaluate_personal``.
+        :return: Numpy array(s) of predictions and the user-averaged AUC, MAP@[2, 4, 6, 8, 10], MRR, NDCG@[1..10] and Recall@[2, 4, 6, 8, 10], over the users whose metrics are defined (see ``evaluate_personal``).
         """
-        model = self.eval()
-        if isinstance(x, dict):
-            x = [x[feature] for feature in self.feature_index]
-        for i in range(len(x)):
-            if len(x[i].shape) == 1:
-                x[i] = np.expand_dims(x[i], axis=1)
-
-        tensor_data = Data.TensorDataset(
-            torch.from_numpy(np.concatenate(x, axis=-1)))
-        test_loader = DataLoader(
-            dataset=tensor_data, shuffle=False, batch_size=batch_size)
-
-        pred_ans = []
-        auc_personal = []
-        map = []
-        mrr = []
-        NDCG = []
-        recall = []
-        with torch.no_grad():
-            for _, x_test in enumerate(test_loader):
-                x = x_test[0].to(self.device).float()
+        pred_ans = self.predict(x, batch_size)
+        result, _ = mean_over_users(
+            self._personal_metrics(pred_ans, y, slate_offsets, Ks=[2, 4, 6, 8, 10], ndcg_k=10))
+        return pred_ans, result["auc"], result["map"], result["mrr"], result["ndcg"], result["recall"]
+
+    def _personal_metrics(self, pred_ans, y, slate_offsets, Ks=(2, 4, 6, 8, 10), ndcg_k=10):
+        if slate_offsets is None:
+            scores = pred_ans.reshape(-1, 101)
+            return ranking_metrics(self._slate_labels(len(scores)), scores, Ks=Ks, ndcg_k=ndcg_k)
+        if y is None:
+            raise ValueError("y is required to evaluate slates given by slate_offsets")
+        return segment_ranking_metrics(np.asarray(y).reshape(-1), pred_ans.reshape(-1), slate_offsets, Ks=Ks,
+                                       ndcg_k=ndcg_k)
+
+    def _slate_labels(self, user_num):
+        # 每个用户 101 个候选：第一个为正样本，其余 100 个为负样本
+        labels = np.zeros((user_num, 101))
+        labels[:, 0] = 1
+        return labels
 
-                y_pred = model(x).cpu().data.numpy()  # .squeeze()
-                pred_ans.append(y_pred)
-                count = np.sum([y_pred[1:] < y_pred[0]])
-                assert count <= 100
-                auc_personal.append(count/100)
-                temp = self.map_recall_at_k_multileveltobinary(np.array([1] + [0]*100), y_pred.reshape(-1), [2, 4, 6, 8, 10])
-                recall.append(temp[0])
-                map.append(temp[1])
-                mrr.append(temp[2])
-                NDCG.append(self.normalized_discounted_cumulative_gain_matrix(np.array([1] + [0]*100), y_pred.reshape(-1), 10))
-        return np.concatenate(pred_ans).astype("float64"), np.mean(auc_personal), np.mean(map, axis=0), np.mean(mrr), np.mean(NDCG, axis=0), np.mean(recall, axis=0)
-        # return np.concatenate(pred_ans).astype("float64"), np.mean(auc_personal)
     def AP_MRR(self, binary_gt, y_pred):
         pred_rank = y_pred.argsort()[::-1]
         binary_gt_rank = np.array([binary_gt[pred_rank[i]] for i in range(len(pred_rank))])
@@ -771,34 +995,365 @@ class BaseModel(nn.Module):
             idcg_matrix[r - 1] = sum(idcg_list[:min(r, len(label))])
         return idcg_matrix
 
-    def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
+    def user_item_input(self, user_ids, item_ids, user_col="userInt", item_col="newsInt", side_input=None,
+                        side_rows=None):
+        """Build the model input for (user, item) pairs.
+
+        :param user_ids: 1D tensor of user ids.
+        :param item_ids: 1D tensor of item ids, aligned with `user_ids`.
+        :param side_input: structured input of the other input features, see ``side_feature_input``. If `None`,
+            the user and the item must be the only input features.
+        :param side_rows: 1D LongTensor, aligned with `user_ids`: the row of `side_input` of every pair.
+        :return: structured model input, ``{user_col: user_ids, item_col: item_ids}`` as int64 ``(n, 1)`` tensors,
+            and the rows `side_rows` of `side_input`.
+        """
+        if side_input is None:
+            self.user_item_features(user_col, item_col)
+            side_input = {}
+        X = {user_col: user_ids.long().reshape(-1, 1), item_col: item_ids.long().reshape(-1, 1)}
+        if side_input:
+            side_rows = side_rows.to(next(iter(side_input.values())).device)
+            X.update((feature, value[side_rows].to(self.device, non_blocking=True))
+                     for feature, value in side_input.items())
+        return OrderedDict((feature, X[feature]) for feature in self.feature_index)
+
+    def side_feature_input(self, data, user_col="userInt", item_col="newsInt"):
+        """Structured input of the features other than the user and the item, read from the columns of `data`.
+
+        :param data: DataFrame or dict of columns holding every input feature, or `None`.
+        :return: OrderedDict {feature_name: 2D tensor} on the CPU, or `None` if the model has no other input.
+        """
+        side_index = OrderedDict((feature, index) for feature, index in self.feature_index.items()
+                                 if feature not in (user_col, item_col))
+        if not side_index:
+            return None
+        if data is None:
+            raise ValueError("the input features %s are read from train_data, which was not given" % list(side_index))
+        return build_typed_input({feature: data[feature] for feature in side_index}, side_index, self.input_dtypes)
+
+    def user_item_features(self, user_col="userInt", item_col="newsInt"):
+        """Return the ``SparseFeat`` of the user and of the item feature, checking that they are the only inputs."""
+        if set(self.feature_index) != {user_col, item_col}:
+            raise ValueError("only models whose inputs are exactly `%s` and `%s` are supported, got %s" % (
+                user_col, item_col, list(self.feature_index)))
+        columns = {feat.name: feat for feat in self.linear_model.sparse_feature_columns + list(
+            filter(lambda x: isinstance(x, SparseFeat), self.dnn_feature_columns))}
+        if user_col not in columns or item_col not in columns:
+            raise ValueError("`%s` and `%s` must be SparseFeat" % (user_col, item_col))
+        return columns[user_col], columns[item_col]
+
+    def score_all_items(self, user_ids, item_ids=None, user_col="userInt", item_col="newsInt", batch_size=1 << 18):
+        """Score every user of `user_ids` against every item of `item_ids`.
+
+        This generic version runs the whole model on every (user, item) pair; models whose item side can be
+        precomputed (e.g. ``DeepFM``) override it.
+
+        :param user_ids: 1D array-like of user ids.
+        :param item_ids: 1D array-like of item ids. If `None`, the whole catalog ``[0, vocabulary_size)`` of `item_col`.
+        :param batch_size: Integer. Approximate number of (user, item) pairs scored per forward pass.
+        :return: 2D tensor ``(len(user_ids), len(item_ids))`` of predictions on ``self.device``.
+        """
+        model = self.eval()
+        user_feat, item_feat = self.user_item_features(user_col, item_col)
+        user_ids = torch.as_tensor(user_ids, dtype=torch.int64, device=self.device).reshape(-1)
+        if item_ids is None:
+            item_ids = torch.arange(item_feat.vocabulary_size, device=self.device)
+        item_ids = torch.as_tensor(item_ids, dtype=torch.int64, device=self.device).reshape(-1)
+        step = max(1, batch_size // max(len(item_ids), 1))
+
+        scores = []
+        with torch.no_grad():
+            for start in range(0, len(user_ids), step):
+                users = user_ids[start:start + step]
+                X = self.user_item_input(torch.repeat_interleave(users, len(item_ids)), item_ids.repeat(len(users)),
+                                         user_col, item_col)
+                scores.append(model(X).reshape(len(users), len(item_ids)))
+        return torch.cat(scores) if scores else torch.zeros((0, len(item_ids)), device=self.device)
+
+    def recommend(self, user_ids, k, exclude_seen=True, interaction_index=None, user_col="userInt",
+                  item_col="newsInt", item_chunk=4096, user_batch=4096, batch_size=1 << 18):
+        """Top-K items of every user over the whole catalog.
+
+        The catalog is scored ``item_chunk`` items at a time with ``score_all_items`` and merged into a running
+        top-K with ``torch.topk``, so memory stays at ``O(user_batch * (k + item_chunk))`` whatever the catalog size.
+
+        :param user_ids: 1D array-like of user ids.
+        :param k: Integer. Number of items returned per user.
+        :param exclude_seen: Boolean. Whether to drop the users' training positives from the candidates.
+        :param interaction_index: ``UserInteractionIndex`` of the positives to exclude. Defaults to the index the
+            model was last trained on by ``fit_SAUC_Lambda``.
+        :param item_chunk: Integer. Number of items scored per step.
+        :param user_batch: Integer. Number of users ranked together.
+        :param batch_size: Integer. Passed to ``score_all_items``.
+        :return: ``(items, scores)``: Numpy arrays ``(len(user_ids), k)`` sorted by decreasing score. Slots left
+            empty (fewer than `k` candidates) hold item ``-1`` and score ``-inf``.
+        """
+        _, item_feat = self.user_item_features(user_col, item_col)
+        item_num = item_feat.vocabulary_size
+        user_ids = torch.as_tensor(np.asarray(user_ids), dtype=torch.int64).reshape(-1)
+        if exclude_seen:
+            interaction_index = interaction_index if interaction_index is not None else self.interaction_index
+            if interaction_index is None:
+                raise ValueError("exclude_seen needs an interaction_index, or a model trained by fit_SAUC_Lambda")
+            rows = interaction_index.rows_of(user_ids)
+
+        top_items, top_scores = [], []
+        for start in range(0, len(user_ids), user_batch):
+            users = user_ids[start:start + user_batch]
+            best_scores = torch.full((len(users), k), -np.inf, device=self.device)
+            best_items = torch.full((len(users), k), -1, dtype=torch.int64, device=self.device)
+            if exclude_seen:
+                batch_rows = rows[start:start + user_batch]
+                known = torch.nonzero(batch_rows >= 0).reshape(-1)
+                _, seen_items, seen_lengths = interaction_index.gather(batch_rows[known])
+                seen_users = torch.repeat_interleave(known, seen_lengths).to(self.device)
+                seen_items = seen_items.to(self.device)
+            for item_start in range(0, item_num, item_chunk):
+                item_ids = torch.arange(item_start, min(item_start + item_chunk, item_num), device=self.device)
+                scores = self.score_all_items(users, item_ids, user_col, item_col, batch_size).reshape(
+                    len(users), -1)
+                if exclude_seen:
+                    in_chunk = (seen_items >= item_start) & (seen_items < item_start + len(item_ids))
+                    scores[seen_users[in_chunk], seen_items[in_chunk] - item_start] = -np.inf
+                merged_scores = torch.cat([best_scores, scores], dim=1)
+                merged_items = torch.cat([best_items, item_ids.expand(len(users), -1)], dim=1)
+                best_scores, index = torch.topk(merged_scores, k, dim=1)
+                best_items = torch.gather(merged_items, 1, index)
+            best_items[torch.isinf(best_scores) & (best_scores < 0)] = -1
+            top_items.append(best_items.cpu().numpy())
+            top_scores.append(best_scores.cpu().numpy())
+        if not top_items:
+            return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+        return np.concatenate(top_items), np.concatenate(top_scores)
 
-        sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        dense_feature_columns = list(
-            filter(lambda x: isinstance(x, DenseFeat), feature_columns)) if len(feature_columns) else []
+    def input_from_feature_columns(self, X, feature_columns, embedding_dict, support_dense=True):
 
-        varlen_sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, VarLenSparseFeat), feature_columns)) if feature_columns else []
+        if feature_columns is self.dnn_feature_columns:
+            group = self.dnn_feature_group
+        else:
+            group = FeatureGroup(feature_columns, self.feature_index)
 
-        if not support_dense and len(dense_feature_columns) > 0:
+        if not support_dense and len(group.dense) > 0:
             raise ValueError(
                 "DenseFeat is not supported in dnn_feature_columns")
 
-        sparse_embedding_list = [embedding_dict[feat.embedding_name](
-            X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]].long()
-        ) for feat in sparse_feature_columns]
+        if self.fused_embedding is not None and embedding_dict is self.embedding_dict:
+            sparse_embedding_list = self.fused_embedding.lookup_group(X, group, embedding_dict)
+        else:
+            sparse_embedding_list = [embedding_dict[feat.embedding_name](ids) for feat, ids in
+                                     zip(group.sparse, group.sparse_ids(X))]
 
-        sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
-                                                      varlen_sparse_feature_columns)
-        varlen_sparse_embedding_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                               varlen_sparse_feature_columns, self.device)
+        varlen_sparse_embedding_list = pooled_varlen_embedding_list(X, self.embedding_dict, self.feature_index,
+                                                                    group.varlen)
 
-        dense_value_list = [X[:, self.feature_index[feat.name][0]:self.feature_index[feat.name][1]] for feat in
-                            dense_feature_columns]
+        dense_value_list = group.dense_values(X)
 
         return sparse_embedding_list + varlen_sparse_embedding_list, dense_value_list
 
+    def fuse_embeddings(self):
+        """Move the embedding tables of the model and the weights of its linear part into one ``FusedEmbedding``.
+
+        Every SparseFeat field is then fetched, for the deep and the linear part alike, by a single lookup per
+        forward pass, and the tables form one contiguous weight (``fused_embedding.weight`` in the state dict).
+        The model computes the same function as before. Build the optimizer after calling this method.
+
+        :return: the model itself.
+        """
+        if self.fused_embedding is not None:
+            return self
+        tables = {id(module.weight): (embedding_dict, name) for embedding_dict in
+                  (self.embedding_dict, self.linear_model.embedding_dict) for name, module in embedding_dict.items()}
+        store = fuse_embedding_matrix(self.embedding_dict, self.linear_model.embedding_dict)
+        if store is None:
+            return self
+        self.fused_embedding = store
+        self.linear_model.__dict__["fused_embedding"] = store
+        sparse_feature_columns = self.linear_model.feature_group.sparse + list(
+            filter(lambda x: isinstance(x, SparseFeat), self.dnn_feature_columns))
+        store.set_fields(sparse_feature_columns, self.feature_index)
+
+        # the regularization now applies to the fused weight. The rows a part does not use are zero, so a list
+        # holding every table of a part is regularized on the whole part with one term
+        part_sizes = {False: 0, True: 0}
+        for embedding_dict in (self.embedding_dict, self.linear_model.embedding_dict):
+            for module in embedding_dict.values():
+                if isinstance(module, FusedEmbeddingView):
+                    part_sizes[module.linear] += 1
+
+        def fused(weight_list):
+            kept, parts = [], {False: [], True: []}
+            for w in weight_list:
+                module = None
+                if id(w) in tables:
+                    embedding_dict, name = tables[id(w)]
+                    module = embedding_dict[name]
+                if isinstance(module, FusedEmbeddingView):
+                    parts[module.linear].append(module)
+                else:
+                    kept.append(w)
+            for linear, views in parts.items():
+                if len(views) and len(views) == part_sizes[linear]:
+                    kept.append(FusedEmbeddingView(store, None, linear))
+                else:
+                    kept.extend(views)
+            return kept
+
+        self.regularization_weight = [(fused(weight_list), l1, l2)
+                                      for weight_list, l1, l2 in self.regularization_weight]
+
+        # a gathered batch is only reused inside one forward pass
+        self.register_forward_pre_hook(store.release)
+        self.register_forward_hook(store.release)
+        # the tables were replaced: hook the new ones
+        self.set_sparse_embedding(self.sparse_embedding)
+        self.set_embedding_regularization(self.embedding_regularization)
+        return self
+
+    def cache_embeddings(self, directory, capacity, names=None, policy="lru"):
+        """Move embedding tables of ``embedding_dict`` to disk, keeping `capacity` hot rows each on the device.
+
+        Every table is written to ``<directory>/<embedding_name>.npy`` and replaced by a ``CachedEmbedding`` over
+        that file. ``fit_SAUC_Lambda`` then announces every batch one step ahead (``prefetch_embeddings``) and
+        writes the trained rows back when it ends; call ``flush_embeddings`` before copying the files otherwise.
+
+        :param directory: str, where the tables are written.
+        :param capacity: int, resident rows per table, at least the distinct ids of a training batch.
+        :param names: list of embedding names, or None for every table with more than `capacity` rows.
+        :param policy: str, ``"lru"`` or ``"lfu"``, see ``CachedEmbedding``.
+        :return: the model itself.
+        """
+        os.makedirs(directory, exist_ok=True)
+        replaced = {}
+        for name, module in list(self.embedding_dict.items()):
+            if not isinstance(module, nn.Embedding) or (
+                    module.num_embeddings <= capacity if names is None else name not in names):
+                continue
+            cached = CachedEmbedding.from_embedding(module, os.path.join(directory, name + ".npy"), capacity,
+                                                    policy=policy)
+            replaced[id(module.weight)] = cached.weight
+            self.embedding_dict[name] = cached
+        # the regularization follows the resident rows
+        self._replace_regularized(replaced)
+        self.set_sparse_embedding(self.sparse_embedding)
+        self.set_embedding_regularization(self.embedding_regularization)
+        return self
+
+    def quantize_embeddings(self, dtype="int8", names=None):
+        """Store the ``nn.Embedding`` tables of the model in `dtype`, see ``QuantizedEmbedding``.
+
+        ``"bf16"`` halves the tables and keeps them trainable. ``"fp16"`` and ``"int8"`` freeze them, for evaluating
+        and serving a trained model: ``"int8"`` stores a byte per value plus a scale and bias per row, so the
+        one-value rows of the linear part are stored in ``"fp16"`` instead. Fused and cached tables are left as
+        they are. Load checkpoints of the quantized model into a model quantized the same way.
+
+        :param dtype: str, ``"bf16"``, ``"fp16"`` or ``"int8"``.
+        :param names: list of embedding names, or None for every table.
+        :return: the model itself.
+        """
+        replaced = {}
+        for embedding_dict in (self.embedding_dict, self.linear_model.embedding_dict):
+            for name, module in list(embedding_dict.items()):
+                if not isinstance(module, nn.Embedding) or (names is not None and name not in names):
+                    continue
+                table_dtype = "fp16" if dtype == "int8" and module.embedding_dim == 1 else dtype
+                quantized = QuantizedEmbedding.from_embedding(module, table_dtype)
+                replaced[id(module.weight)] = quantized.weight if quantized.trainable else None
+                embedding_dict[name] = quantized
+        # frozen tables are no longer regularized
+        self._replace_regularized(replaced)
+        self.set_sparse_embedding(self.sparse_embedding)
+        self.set_embedding_regularization(self.embedding_regularization)
+        return self
+
+    def _replace_regularized(self, replaced):
+        """Swap the weights of ``regularization_weight`` by id, ``replaced`` mapping to the new weight or to None
+        to drop it."""
+        def replace(w):
+            if isinstance(w, tuple):
+                new = replaced.get(id(w[1]), w[1])
+                return None if new is None else (w[0], new)
+            return replaced.get(id(w), w)
+
+        self.regularization_weight = [
+            ([new for new in map(replace, weight_list) if new is not None], l1, l2)
+            for weight_list, l1, l2 in self.regularization_weight]
+
+    def prefetch_embeddings(self, x):
+        """Announce the ids of an upcoming batch, a dict feature name -> ids, to the ``CachedEmbedding`` tables."""
+        for feat in self.dnn_feature_group.sparse:
+            module = self.embedding_dict[feat.embedding_name]
+            if isinstance(module, CachedEmbedding) and feat.name in x:
+                module.prefetch(x[feat.name])
+
+    def flush_embeddings(self):
+        """Write the trained rows of every ``CachedEmbedding`` back to its file."""
+        for module in self.modules():
+            if isinstance(module, CachedEmbedding):
+                module.flush()
+
+    def embedding_parameters(self):
+        """Weights of the embedding tables: every ``nn.Embedding`` of the model, the ``FusedEmbedding``, the
+        resident rows of the ``CachedEmbedding`` tables and the trainable ``QuantizedEmbedding`` tables."""
+        return [module.weight for module in self.modules() if
+                isinstance(module, (nn.Embedding, FusedEmbedding, CachedEmbedding)) or
+                isinstance(module, QuantizedEmbedding) and module.trainable]
+
+    def set_sparse_embedding(self, sparse=True):
+        """Make the lookups of every embedding table give it sparse gradients (only the rows of the batch), or dense
+        ones again.
+
+        Sparse gradients need an optimizer that accepts them, see ``_get_sparse_optim``. A full-table L1/L2 term
+        would give the tables dense gradients, so ``get_regularization_loss`` leaves the embedding tables out
+        while the model is sparse.
+        """
+        for module in self.modules():
+            if isinstance(module, (nn.Embedding, FusedEmbedding, CachedEmbedding, QuantizedEmbedding)):
+                module.sparse = sparse
+        self.sparse_embedding = sparse
+        self._sparse_tables = set(id(weight) for weight in self.embedding_parameters()) if sparse else set()
+        return self
+
+    def set_embedding_regularization(self, mode="full"):
+        """Choose how ``get_regularization_loss`` applies the L1/L2 terms of the embedding tables.
+
+        ``"full"`` penalizes the whole tables on every step. ``"batch"`` penalizes only the rows looked up by the
+        last forward pass, once per lookup, so that frequent ids are penalized more, as usual for CTR embeddings:
+        the cost then follows the batch instead of the vocabulary, and the gradients of the tables stay sparse.
+        """
+        if mode not in ("full", "batch"):
+            raise ValueError("embedding_regularization must be 'full' or 'batch'")
+        for handle in self._lookup_hooks:
+            handle.remove()
+        self._lookup_hooks = []
+        self._batch_lookups = []
+        self.embedding_regularization = mode
+        self._regularization_plan = None
+        if self.fused_embedding is not None:
+            self.fused_embedding.lookups = [] if mode == "batch" else None
+        if mode == "batch":
+            for module in self.modules():
+                if isinstance(module, (nn.Embedding, CachedEmbedding)) or (
+                        isinstance(module, QuantizedEmbedding) and module.trainable):
+                    self._lookup_hooks.append(module.register_forward_hook(self._record_lookup))
+            self._lookup_hooks.append(self.register_forward_pre_hook(self._clear_lookups))
+        return self
+
+    def _record_lookup(self, module, inputs, output):
+        if torch.is_grad_enabled():
+            self._batch_lookups.append((module.weight, output))
+
+    def _clear_lookups(self, module, inputs):
+        self._batch_lookups = []
+        if self.fused_embedding is not None and self.fused_embedding.lookups is not None:
+            self.fused_embedding.lookups = []
+
+    def _is_sparse_table(self, w):
+        if isinstance(w, tuple):
+            w = w[1]
+        elif isinstance(w, FusedEmbeddingView):
+            w = w.store.weight
+        return id(w) in self._sparse_tables
+
     def compute_input_dim(self, feature_columns, include_sparse=True, include_dense=True, feature_group=False):
         sparse_feature_columns = list(
             filter(lambda x: isinstance(x, (SparseFeat, VarLenSparseFeat)), feature_columns)) if len(
@@ -830,23 +1385,89 @@ class BaseModel(nn.Module):
         self.regularization_weight.append((weight_list, l1, l2))
 
     def get_regularization_loss(self, ):
+        weight_groups, table_coefficients, fused_coefficients = self._get_regularization_plan()
         total_reg_loss = torch.zeros((1,), device=self.device)
-        for weight_list, l1, l2 in self.regularization_weight:
-            for w in weight_list:
-                if isinstance(w, tuple):
-                    parameter = w[1]  # named_parameters
-                else:
-                    parameter = w
+        # the weights sharing a coefficient pair are reduced together, and their terms added weight by weight in the
+        # order of regularization_weight
+        for l1, l2, weight_list in weight_groups:
+            parameters = [w.weight if isinstance(w, FusedEmbeddingView) else w for w in weight_list]
+            l1_terms = _scaled_sums(parameters, l1, 1) if l1 > 0 else None
+            l2_terms = _scaled_sums(parameters, l2, 2) if l2 > 0 else None
+            for i in range(len(parameters)):
+                if l1_terms is not None:
+                    total_reg_loss += l1_terms[i]
+                if l2_terms is not None:
+                    total_reg_loss += l2_terms[i]
+
+        if self.embedding_regularization == "batch":
+            for weight, rows in self._batch_lookups:
+                l1, l2 = table_coefficients.get(id(weight), (0., 0.))
                 if l1 > 0:
-                    total_reg_loss += torch.sum(l1 * torch.abs(parameter))
+                    total_reg_loss += l1 * rows.abs().sum()
                 if l2 > 0:
-                    try:
-                        total_reg_loss += torch.sum(l2 * torch.square(parameter))
-                    except AttributeError:
-                        total_reg_loss += torch.sum(l2 * parameter * parameter)
+                    total_reg_loss += l2 * rows.square().sum()
+            if self.fused_embedding is not None and fused_coefficients is not None:
+                l1_fields, l2_fields, l1_tables, l2_tables = fused_coefficients
+                for name, linear, rows in self.fused_embedding.lookups:
+                    if name is None:
+                        # gathered fields: one coefficient per field and part
+                        total_reg_loss += (l1_fields * rows.abs()).sum() + (l2_fields * rows.square()).sum()
+                    else:
+                        total_reg_loss += l1_tables[name, linear] * rows.abs().sum() + \
+                                          l2_tables[name, linear] * rows.square().sum()
 
         return total_reg_loss
 
+    def _get_regularization_plan(self):
+        """Sort the weights of ``regularization_weight`` once: runs of dense weights with the same coefficients, and
+        the coefficients of the embedding tables when they are penalized per lookup."""
+        key = (id(self.regularization_weight), len(self.regularization_weight), self.embedding_regularization,
+               self.sparse_embedding, None if self.fused_embedding is None else self.fused_embedding.weight.device)
+        if self._regularization_plan is not None and self._regularization_plan[0] == key:
+            return self._regularization_plan[1]
+
+        batch = self.embedding_regularization == "batch"
+        table_ids = set(id(weight) for weight in self.embedding_parameters())
+        weight_groups = []  # (l1, l2, weights)
+        table_coefficients = defaultdict(lambda: [0., 0.])
+        fused_tables = defaultdict(lambda: [0., 0.])
+        for weight_list, l1, l2 in self.regularization_weight:
+            if l1 <= 0 and l2 <= 0:
+                continue
+            for w in weight_list:
+                if isinstance(w, tuple):
+                    w = w[1]  # named_parameters
+                table = id(w.store.weight) if isinstance(w, FusedEmbeddingView) else id(w)
+                if table in table_ids and (batch or self.sparse_embedding):
+                    # not a full-table term: per lookup ("batch"), or skipped (sparse gradients)
+                    if batch:
+                        coefficients = fused_tables[w.name, w.linear] if isinstance(w, FusedEmbeddingView) \
+                            else table_coefficients[table]
+                        coefficients[0] += l1
+                        coefficients[1] += l2
+                    continue
+                if not weight_groups or weight_groups[-1][:2] != (l1, l2):
+                    weight_groups.append((l1, l2, []))
+                weight_groups[-1][2].append(w)
+
+        fused_coefficients = None
+        store = self.fused_embedding
+        if batch and store is not None:
+            # the coefficients of a table sum those given to the table and those given to its whole part
+            tables = {(name, linear): [fused_tables[None, linear][i] + fused_tables[name, linear][i] for i in (0, 1)]
+                      for name in store.offsets for linear in (False, True)}
+            fields = torch.zeros(2, len(store.field_tables), store.embedding_dim + 1, device=store.weight.device)
+            for position, name in enumerate(store.field_tables):
+                for i in (0, 1):
+                    fields[i, position, :store.embedding_dim] = tables[name, False][i]
+                    fields[i, position, store.embedding_dim:] = tables[name, True][i]
+            fused_coefficients = (fields[0], fields[1], {k: v[0] for k, v in tables.items()},
+                                  {k: v[1] for k, v in tables.items()})
+
+        plan = (weight_groups, dict(table_coefficients), fused_coefficients)
+        self._regularization_plan = (key, plan)
+        return plan
+
     def add_auxiliary_loss(self, aux_loss, alpha):
         self.aux_loss = aux_loss * alpha
 
@@ -880,6 +1501,21 @@ class BaseModel(nn.Module):
             optim = optimizer
         return optim
 
+    def _get_sparse_optim(self, optimizer, lr):
+        """``SparseDenseOptimizer`` updating the embedding tables with `optimizer` (``"sparse_adam"`` or
+        ``"adagrad"``, both accept sparse gradients) and the other parameters with Adam."""
+        tables = self.embedding_parameters()
+        table_ids = set(id(weight) for weight in tables)
+        dense_params = [p for p in self.parameters() if id(p) not in table_ids]
+        if optimizer == "sparse_adam":
+            sparse_optim = torch.optim.SparseAdam(tables, lr=lr)
+        elif optimizer == "adagrad":
+            sparse_optim = torch.optim.Adagrad(tables, lr=lr)
+        else:
+            raise NotImplementedError
+        dense_optim = torch.optim.Adam(dense_params, lr=lr) if len(dense_params) else None
+        return SparseDenseOptimizer(sparse_optim, dense_optim)
+
     def _get_loss_func(self, loss):
         if isinstance(loss, str):
             if loss == "binary_crossentropy":
@@ -9,7 +9,7 @@ import torch
 import torch.nn as nn
 
 from .basemodel import BaseModel
-from ..inputs import combined_dnn_input
+from ..inputs import combined_dnn_input, SparseFeat
 from ..layers import FM, DNN
 
 
@@ -94,3 +94,79 @@ class DeepFM(BaseModel):
         y_pred = self.out(logit)
 
         return y_pred
+
+    def score_all_items(self, user_ids, item_ids=None, user_col="userInt", item_col="newsInt", batch_size=1 << 18):
+        """Score every user of `user_ids` against every item of `item_ids` without building the pairwise input.
+
+        With only a user and an item feature, the linear part is ``w_u + w_i``, the FM part is ``<e_u, e_i>`` and
+        the first DNN layer is ``W_u e_u + W_i e_i + b``. The item terms are computed once for the whole catalog and
+        cached until the parameters change, the user terms once per call, so only the DNN layers after the first
+        one run per (user, item) pair.
+
+        :param user_ids: 1D array-like of user ids.
+        :param item_ids: 1D array-like of item ids. If `None`, the whole catalog ``[0, vocabulary_size)`` of `item_col`.
+        :param batch_size: Integer. Approximate number of (user, item) pairs pushed through the DNN at once.
+        :return: 2D tensor ``(len(user_ids), len(item_ids))`` of predictions on ``self.device``.
+        """
+        self.eval()
+        user_feat, item_feat = self.user_item_features(user_col, item_col)
+        user_ids = torch.as_tensor(user_ids, dtype=torch.int64, device=self.device).reshape(-1)
+        item_logit, item_emb, item_hidden = self._item_side_cache(user_feat, item_feat)
+        if item_ids is not None:
+            item_ids = torch.as_tensor(item_ids, dtype=torch.int64, device=self.device).reshape(-1)
+            item_logit = item_logit[item_ids]
+            item_emb = item_emb[item_ids] if item_emb is not None else None
+            item_hidden = item_hidden[item_ids] if item_hidden is not None else None
+        item_num = item_logit.shape[0]
+
+        with torch.no_grad():
+            user_logit, user_emb, user_hidden = self._side_terms(user_feat, user_ids)
+            step = max(1, batch_size // max(item_num, 1)) if self.use_dnn else max(len(user_ids), 1)
+            scores = []
+            for start in range(0, len(user_ids), step):
+                end = start + step
+                logit = user_logit[start:end, None] + item_logit[None, :]
+                if self.use_fm and user_emb is not None and item_emb is not None:
+                    logit = logit + torch.matmul(user_emb[start:end], item_emb.t())
+                if self.use_dnn:
+                    hidden = (user_hidden[start:end, None, :] + item_hidden[None, :, :]).reshape(
+                        -1, item_hidden.shape[-1])
+                    logit = logit + self.dnn_linear(self.dnn.forward_from_linear(hidden)).reshape(-1, item_num)
+                scores.append(self.out(logit))
+        return torch.cat(scores) if scores else torch.zeros((0, item_num), device=self.device)
+
+    def _item_side_cache(self, user_feat, item_feat):
+        # 物品侧的线性权重、embedding 以及 DNN 第一层的物品分量，参数未更新时直接复用
+        params = list(self.parameters())
+        key = (user_feat.name, item_feat.name, tuple((p.data_ptr(), p._version) for p in params))
+        if getattr(self, "_item_cache_key", None) != key:
+            with torch.no_grad():
+                items = torch.arange(item_feat.vocabulary_size, device=self.device)
+                item_logit, item_emb, item_hidden = self._side_terms(item_feat, items)
+                if self.use_dnn:
+                    item_hidden = item_hidden + self.dnn.linears[0].bias
+            self._item_cache = (item_logit, item_emb, item_hidden)
+            self._item_cache_key = key
+        return self._item_cache
+
+    def _side_terms(self, feat, ids):
+        # 单侧（用户或物品）的线性项、embedding 以及它在 DNN 第一层中的贡献
+        logit = torch.zeros(ids.shape[0], device=self.device)
+        for linear_feat in self.linear_model.sparse_feature_columns:
+            if linear_feat.name == feat.name:
+                logit = logit + self.linear_model.embedding_dict[linear_feat.embedding_name](ids)[:, 0]
+        dnn_sparse = list(filter(lambda x: isinstance(x, SparseFeat), self.dnn_feature_columns))
+        if feat.name not in [dnn_feat.name for dnn_feat in dnn_sparse]:
+            hidden = torch.zeros((ids.shape[0], self.dnn.linears[0].out_features),
+                                 device=self.device) if self.use_dnn else None
+            return logit, None, hidden
+        emb = self.embedding_dict[feat.embedding_name](ids)
+        hidden = None
+        if self.use_dnn:
+            offset = 0
+            for dnn_feat in dnn_sparse:
+                if dnn_feat.name == feat.name:
+                    break
+                offset += dnn_feat.embedding_dim
+            hidden = torch.matmul(emb, self.dnn.linears[0].weight[:, offset:offset + feat.embedding_dim].t())
+        return logit, emb, hidden
@@ -104,41 +104,27 @@ class DIEN(BaseModel):
         return y_pred
 
     def _get_emb(self, X):
-        # history feature columns : pos, neg
-        history_feature_columns = []
-        neg_history_feature_columns = []
-        sparse_varlen_feature_columns = []
-        history_fc_names = list(map(lambda x: "hist_" + x, self.item_features))
-        neg_history_fc_names = list(map(lambda x: "neg_" + x, history_fc_names))
-        for fc in self.varlen_sparse_feature_columns:
-            feature_name = fc.name
-            if feature_name in history_fc_names:
-                history_feature_columns.append(fc)
-            elif feature_name in neg_history_fc_names:
-                neg_history_feature_columns.append(fc)
-            else:
-                sparse_varlen_feature_columns.append(fc)
-
         # convert input to emb
         features = self.feature_index
         query_emb_list = embedding_lookup(X, self.embedding_dict, features, self.sparse_feature_columns,
-                                          return_feat_list=self.item_features, to_list=True)
+                                          return_feat_list=self.item_features, to_list=True,
+                                          feature_group=self.sparse_feature_group)
         # [batch_size, dim]
         query_emb = torch.squeeze(concat_fun(query_emb_list), 1)
 
-        keys_emb_list = embedding_lookup(X, self.embedding_dict, features, history_feature_columns,
-                                         return_feat_list=history_fc_names, to_list=True)
+        keys_emb_list = embedding_lookup(X, self.embedding_dict, features, self.history_feature_columns,
+                                         return_feat_list=self.history_fc_names, to_list=True,
+                                         feature_group=self.history_feature_group)
         # [batch_size, max_len, dim]
         keys_emb = concat_fun(keys_emb_list)
 
-        keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
-                                    feat.length_name is not None]
         # [batch_size]
-        keys_length = torch.squeeze(maxlen_lookup(X, features, keys_length_feature_name), 1)
+        keys_length = torch.squeeze(maxlen_lookup(X, features, self.keys_length_feature_name), 1)
 
         if self.use_negsampling:
-            neg_keys_emb_list = embedding_lookup(X, self.embedding_dict, features, neg_history_feature_columns,
-                                                 return_feat_list=neg_history_fc_names, to_list=True)
+            neg_keys_emb_list = embedding_lookup(X, self.embedding_dict, features, self.neg_history_feature_columns,
+                                                 return_feat_list=self.neg_history_fc_names, to_list=True,
+                                                 feature_group=self.neg_history_feature_group)
             neg_keys_emb = concat_fun(neg_keys_emb_list)
         else:
             neg_keys_emb = None
@@ -156,6 +142,20 @@ class DIEN(BaseModel):
             filter(lambda x: isinstance(x, VarLenSparseFeat),
                    self.dnn_feature_columns)) if len(self.dnn_feature_columns) else []
 
+        # history feature columns : pos, neg
+        self.history_fc_names = list(map(lambda x: "hist_" + x, self.item_features))
+        self.neg_history_fc_names = list(map(lambda x: "neg_" + x, self.history_fc_names))
+        self.history_feature_columns = [fc for fc in self.varlen_sparse_feature_columns if
+                                        fc.name in self.history_fc_names]
+        self.neg_history_feature_columns = [fc for fc in self.varlen_sparse_feature_columns if
+                                            fc.name in self.neg_history_fc_names]
+        self.keys_length_feature_name = [feat.length_name for feat in self.varlen_sparse_feature_columns if
+                                         feat.length_name is not None]
+        # the ids of the query, the histories and the deep input are looked up through groups compiled once
+        self.sparse_feature_group = FeatureGroup(self.sparse_feature_columns, self.feature_index)
+        self.history_feature_group = FeatureGroup(self.history_feature_columns, self.feature_index)
+        self.neg_history_feature_group = FeatureGroup(self.neg_history_feature_columns, self.feature_index)
+
     def _compute_interest_dim(self):
         interest_dim = 0
         for feat in self.sparse_feature_columns:
@@ -173,7 +173,8 @@ class DIEN(BaseModel):
 
     def _get_deep_input_emb(self, X):
         dnn_input_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
-                                              mask_feat_list=self.item_features, to_list=True)
+                                              mask_feat_list=self.item_features, to_list=True,
+                                              feature_group=self.sparse_feature_group)
         dnn_input_emb = concat_fun(dnn_input_emb_list)
         return dnn_input_emb.squeeze(1)
 
@@ -31,6 +31,7 @@ class DIN(BaseModel):
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
     :param gpus: list of int or torch.device for multiple gpus. If None, run on `device`. `gpus[0]` should be the same gpu with `device`.
+    :param att_chunk_size: positive integer or None. If set, the attention net scores the behavior sequence this many steps at a time and recomputes them in the backward pass, pooling the history with a running weighted sum, so that long histories fit in memory without truncating ``maxlen``. A training ``Dice`` still normalizes with the statistics of the whole history.
     :return:  A PyTorch model instance.
 
     """
@@ -39,7 +40,7 @@ class DIN(BaseModel):
                  dnn_hidden_units=(256, 128), dnn_activation='relu', att_hidden_size=(64, 16),
                  att_activation='Dice', att_weight_normalization=False, l2_reg_dnn=0.0,
                  l2_reg_embedding=1e-6, dnn_dropout=0, init_std=0.0001,
-                 seed=1024, task='binary', device='cpu', gpus=None):
+                 seed=1024, task='binary', device='cpu', gpus=None, att_chunk_size=None):
         super(DIN, self).__init__([], dnn_feature_columns, l2_reg_linear=0, l2_reg_embedding=l2_reg_embedding,
                                   init_std=init_std, seed=seed, task=task, device=device, gpus=gpus)
 
@@ -61,6 +62,10 @@ class DIN(BaseModel):
             else:
                 self.sparse_varlen_feature_columns.append(fc)
 
+        # the ids of the query, the history and the deep input are looked up through groups compiled once
+        self.sparse_feature_group = FeatureGroup(self.sparse_feature_columns, self.feature_index)
+        self.history_feature_group = FeatureGroup(self.history_feature_columns, self.feature_index)
+
         att_emb_dim = self._compute_interest_dim()
 
         self.attention = AttentionSequencePoolingLayer(att_hidden_units=att_hidden_size,
@@ -68,7 +73,8 @@ class DIN(BaseModel):
                                                        att_activation=att_activation,
                                                        return_score=False,
                                                        supports_masking=False,
-                                                       weight_normalization=att_weight_normalization)
+                                                       weight_normalization=att_weight_normalization,
+                                                       chunk_size=att_chunk_size)
 
         self.dnn = DNN(inputs_dim=self.compute_input_dim(dnn_feature_columns),
                        hidden_units=dnn_hidden_units,
@@ -85,17 +91,16 @@ class DIN(BaseModel):
 
         # sequence pooling part
         query_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
-                                          return_feat_list=self.history_feature_list, to_list=True)
+                                          return_feat_list=self.history_feature_list, to_list=True,
+                                          feature_group=self.sparse_feature_group)
         keys_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.history_feature_columns,
-                                         return_feat_list=self.history_fc_names, to_list=True)
+                                         return_feat_list=self.history_fc_names, to_list=True,
+                                         feature_group=self.history_feature_group)
         dnn_input_emb_list = embedding_lookup(X, self.embedding_dict, self.feature_index, self.sparse_feature_columns,
-                                              to_list=True)
-
-        sequence_embed_dict = varlen_embedding_lookup(X, self.embedding_dict, self.feature_index,
-                                                      self.sparse_varlen_feature_columns)
+                                              to_list=True, feature_group=self.sparse_feature_group)
 
-        sequence_embed_list = get_varlen_pooling_list(sequence_embed_dict, X, self.feature_index,
-                                                      self.sparse_varlen_feature_columns, self.device)
+        sequence_embed_list = pooled_varlen_embedding_list(X, self.embedding_dict, self.feature_index,
+                                                           self.sparse_varlen_feature_columns)
 
         dnn_input_emb_list += sequence_embed_list
         deep_input_emb = torch.cat(dnn_input_emb_list, dim=-1)
@@ -5,33 +5,56 @@ Author:
 Reference:
     [1] Yang Y, Xu B, Shen F, et al. Operation-aware Neural Networks for User Response Prediction[J]. arXiv preprint arXiv:1904.12579, 2019. （https://arxiv.org/pdf/1904.12579）
 """
+import itertools
 
 from .basemodel import *
 from ..inputs import combined_dnn_input
 from ..layers import DNN
+from ..layers.interaction import pair_index
 
 
-class Interac(nn.Module):
-    def __init__(self, first_size, second_size, emb_size, init_std, sparse=False):
-        super(Interac, self).__init__()
-        self.emb1 = nn.Embedding(first_size, emb_size, sparse=sparse)
-        self.emb2 = nn.Embedding(second_size, emb_size, sparse=sparse)
-        self.__init_weight(init_std)
+class OperationAwareEmbedding(nn.Module):
+    """The second order embeddings of ONN, every field pair in one table.
 
-    def __init_weight(self, init_std):
-        nn.init.normal_(self.emb1.weight, mean=0, std=init_std)
+    Pair ``(i, j)`` of the fields has two embeddings, of the ids of ``i`` and of ``j``, whose product is the pair's
+    cross vector. They are blocks of a single ``nn.Embedding``, so all the pairs are looked up at once.
 
-    def forward(self, first, second):
-        """
-        input:
-            x batch_size * 2
-        output:
-            y batch_size * emb_size
-        """
-        first_emb = self.emb1(first)
-        second_emb = self.emb2(second)
-        y = first_emb * second_emb  # core code
-        return y
+    Input shape
+        - 2D tensor with shape: ``(batch_size, field_size)``, the ids of the fields.
+    Output shape
+        - 3D tensor with shape: ``(batch_size, field_size * (field_size - 1) / 2, emb_size)``.
+    """
+
+    def __init__(self, vocabulary_sizes, emb_size, init_std, sparse=False):
+        super(OperationAwareEmbedding, self).__init__()
+        pairs = pair_index(len(vocabulary_sizes))
+        # block 2p holds the ids of the first field of pair p, block 2p + 1 those of the second one
+        block_sizes = torch.tensor(vocabulary_sizes, dtype=torch.long)[pairs.t().reshape(-1)]
+        self.embedding = nn.Embedding(int(block_sizes.sum()), emb_size, sparse=sparse,
+                                      _weight=torch.empty(int(block_sizes.sum()), emb_size))
+        self.register_buffer("fields", pairs.t().reshape(-1), persistent=False)
+        self.register_buffer("offsets", F.pad(torch.cumsum(block_sizes, dim=0)[:-1], (1, 0)), persistent=False)
+        self.__init_weight(block_sizes.tolist(), init_std)
+
+    def __init_weight(self, block_sizes, init_std):
+        # as a pair of nn.Embedding each, the first one then drawn again from N(0, init_std)
+        with torch.no_grad():
+            blocks = torch.split(self.embedding.weight, block_sizes)
+            for first, second in zip(blocks[::2], blocks[1::2]):
+                nn.init.normal_(first)
+                nn.init.normal_(second)
+                nn.init.normal_(first, mean=0, std=init_std)
+
+    def forward(self, ids):
+        # pair-major, so that consecutive lookups stay within one block of the table
+        ids = (ids[:, self.fields] + self.offsets).t()
+        if self.embedding.sparse or self.embedding._forward_hooks:
+            emb = self.embedding(ids)
+        else:
+            # the backward of index_select accumulates with index_add, faster than the one of a dense embedding
+            emb = self.embedding.weight.index_select(0, ids.reshape(-1)).view(*ids.shape, -1)
+        # 2 pair * batch_size * emb_size
+        return (emb[0::2] * emb[1::2]).transpose(0, 1)  # core code
 
 
 class ONN(BaseModel):
@@ -66,11 +89,11 @@ class ONN(BaseModel):
 
         # second order part
         embedding_size = self.embedding_size
-        self.second_order_embedding_dict = self.__create_second_order_embedding_matrix(
+        self.second_order_embedding = self.__create_second_order_embedding_matrix(
             dnn_feature_columns, embedding_size=embedding_size, sparse=False).to(device)
 
         # add regularization for second_order_embedding
-        self.add_regularization_weight(self.second_order_embedding_dict.parameters(), l2=l2_reg_embedding)
+        self.add_regularization_weight(self.second_order_embedding.parameters(), l2=l2_reg_embedding)
 
         dim = self.__compute_nffm_dnn_dim(
             feature_columns=dnn_feature_columns, embedding_size=embedding_size)
@@ -95,54 +118,45 @@ class ONN(BaseModel):
         return int(len(sparse_feature_columns) * (len(sparse_feature_columns) - 1) / 2 * embedding_size +
                    sum(map(lambda x: x.dimension, dense_feature_columns)))
 
-    def __input_from_second_order_column(self, X, feature_columns, second_order_embedding_dict):
+    def __input_from_second_order_column(self, X, feature_group, second_order_embedding):
         '''
         :param X: same as input_from_feature_columns
-        :param feature_columns: same as input_from_feature_columns
-        :param second_order_embedding_dict: ex: {'A1+A2': Interac model} created by function create_second_order_embedding_matrix
-        :return:
+        :param feature_group: FeatureGroup of the feature columns, e.g. ``dnn_feature_group``
+        :param second_order_embedding: OperationAwareEmbedding created by function create_second_order_embedding_matrix
+        :return: list holding the ``(batch_size, pair_num, embedding_size)`` cross vectors of every field pair
         '''
-        sparse_feature_columns = list(
-            filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        second_order_embedding_list = []
-        for first_index in range(len(sparse_feature_columns) - 1):
-            for second_index in range(first_index + 1, len(sparse_feature_columns)):
-                first_name = sparse_feature_columns[first_index].embedding_name
-                second_name = sparse_feature_columns[second_index].embedding_name
-                second_order_embedding_list.append(
-                    second_order_embedding_dict[first_name + "+" + second_name](
-                        X[:, self.feature_index[first_name][0]
-                             :self.feature_index[first_name][1]].long(),
-                        X[:, self.feature_index[second_name][0]
-                             :self.feature_index[second_name][1]].long()
-                    )
-                )
-        return second_order_embedding_list
+        sparse_ids = feature_group.sparse_ids(X)
+        if len(sparse_ids) < 2:
+            return []
+        return [second_order_embedding(torch.cat(sparse_ids, dim=1))]
 
     def __create_second_order_embedding_matrix(self, feature_columns, embedding_size, init_std=0.0001, sparse=False):
 
         sparse_feature_columns = list(
             filter(lambda x: isinstance(x, SparseFeat), feature_columns)) if len(feature_columns) else []
-        temp_dict = {}
-        for first_index in range(len(sparse_feature_columns) - 1):
-            for second_index in range(first_index + 1, len(sparse_feature_columns)):
-                first_name = sparse_feature_columns[first_index].embedding_name
-                second_name = sparse_feature_columns[second_index].embedding_name
-                temp_dict[first_name + "+" + second_name] = Interac(sparse_feature_columns[first_index].vocabulary_size,
-                                                                    sparse_feature_columns[
-                                                                        second_index].vocabulary_size,
-                                                                    emb_size=embedding_size,
-                                                                    init_std=init_std,
-                                                                    sparse=sparse)
-        return nn.ModuleDict(temp_dict)
+        return OperationAwareEmbedding([feat.vocabulary_size for feat in sparse_feature_columns],
+                                       emb_size=embedding_size, init_std=init_std, sparse=sparse)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints holding one Interac module per field pair: second_order_embedding_dict.<A>+<B>.emb1/emb2
+        old_prefix = prefix + "second_order_embedding_dict."
+        if any(key.startswith(old_prefix) for key in state_dict):
+            names = [feat.embedding_name for feat in
+                     filter(lambda x: isinstance(x, SparseFeat), self.dnn_feature_columns)]
+            blocks = []
+            for first, second in itertools.combinations(names, 2):
+                for emb in ("emb1", "emb2"):
+                    blocks.append(state_dict.pop("%s%s+%s.%s.weight" % (old_prefix, first, second, emb)))
+            state_dict[prefix + "second_order_embedding.embedding.weight"] = torch.cat(blocks)
+        super(ONN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, X):
 
         sparse_embedding_list, dense_value_list = self.input_from_feature_columns(X, self.dnn_feature_columns,
                                                               self.embedding_dict)
         linear_logit = self.linear_model(X)
-        spare_second_order_embedding_list = self.__input_from_second_order_column(X, self.dnn_feature_columns,
-                                                                                  self.second_order_embedding_dict)
+        spare_second_order_embedding_list = self.__input_from_second_order_column(X, self.dnn_feature_group,
+                                                                                  self.second_order_embedding)
         dnn_input = combined_dnn_input(
             spare_second_order_embedding_list, sparse_embedding_list)
         dnn_output = self.dnn(dnn_input)
@@ -56,7 +56,7 @@ class PNN(BaseModel):
 
         if self.use_inner:
             product_out_dim += num_pairs
-            self.innerproduct = InnerProductLayer(device=device)
+            self.innerproduct = InnerProductLayer(device=device, field_size=num_inputs)
 
         if self.use_outter:
             product_out_dim += num_pairs
@@ -79,15 +79,15 @@ class PNN(BaseModel):
 
         sparse_embedding_list, dense_value_list = self.input_from_feature_columns(X, self.dnn_feature_columns,
                                                                                   self.embedding_dict)
-        linear_signal = torch.flatten(
-            concat_fun(sparse_embedding_list), start_dim=1)
+        embeds = concat_fun(sparse_embedding_list, axis=1)  # batch * field * k
+        linear_signal = torch.flatten(embeds, start_dim=1)
 
         if self.use_inner:
             inner_product = torch.flatten(
-                self.innerproduct(sparse_embedding_list), start_dim=1)
+                self.innerproduct(embeds), start_dim=1)
 
         if self.use_outter:
-            outer_product = self.outterproduct(sparse_embedding_list)
+            outer_product = self.outterproduct(embeds)
 
         if self.use_outter and self.use_inner:
             product_layer = torch.cat(
@@ -35,6 +35,7 @@ class xDeepFM(BaseModel):
     :param task: str, ``"binary"`` for  binary logloss or  ``"regression"`` for regression loss
     :param device: str, ``"cpu"`` or ``"cuda:0"``
     :param gpus: list of int or torch.device for multiple gpus. If None, run on `device`. `gpus[0]` should be the same gpu with `device`.
+    :param cin_chunk_size: positive integer or None. If set, CIN computes its feature interactions this many samples at a time and recomputes them in the backward pass, bounding its memory with many fields and large batches.
     :return: A PyTorch model instance.
 
     """
@@ -42,7 +43,7 @@ class xDeepFM(BaseModel):
     def __init__(self, linear_feature_columns, dnn_feature_columns, dnn_hidden_units=(256, 256),
                  cin_layer_size=(256, 128,), cin_split_half=True, cin_activation='relu', l2_reg_linear=0.00001,
                  l2_reg_embedding=0.00001, l2_reg_dnn=0, l2_reg_cin=0, init_std=0.0001, seed=1024, dnn_dropout=0,
-                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None):
+                 dnn_activation='relu', dnn_use_bn=False, task='binary', device='cpu', gpus=None, cin_chunk_size=None):
 
         super(xDeepFM, self).__init__(linear_feature_columns, dnn_feature_columns, l2_reg_linear=l2_reg_linear,
                                       l2_reg_embedding=l2_reg_embedding, init_std=init_std, seed=seed, task=task,
@@ -69,7 +70,7 @@ class xDeepFM(BaseModel):
             else:
                 self.featuremap_num = sum(cin_layer_size)
             self.cin = CIN(field_num, cin_layer_size,
-                           cin_activation, cin_split_half, l2_reg_cin, seed, device=device)
+                           cin_activation, cin_split_half, l2_reg_cin, seed, device=device, chunk_size=cin_chunk_size)
             self.cin_linear = nn.Linear(self.featuremap_num, 1, bias=False).to(device)
             self.add_regularization_weight(filter(lambda x: 'weight' in x[0], self.cin.named_parameters()),
                                            l2=l2_reg_cin)
@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+"""
+Embedding tables stored in fewer bits than float32.
+
+A ``QuantizedEmbedding`` keeps its rows in bfloat16, float16 or 8-bit codes and dequantizes the looked-up rows to
+float32, so that the layers behind it are unchanged. ``bf16`` tables remain trainable; ``fp16`` and ``int8`` tables
+are frozen and meant for evaluation and serving of a trained model.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+STORAGE_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "int8": torch.uint8}
+
+
+def quantize_rowwise(weight):
+    """8-bit codes of a 2D float tensor with a float16 scale and bias per row: ``row ~= codes * scale + bias``.
+
+    :return: uint8 tensor of the shape of `weight`, and float16 tensor of shape ``(rows, 2)`` holding scale and bias.
+    """
+    weight = weight.detach().float()
+    low = weight.min(dim=1).values
+    high = weight.max(dim=1).values
+    scale_bias = torch.stack([(high - low) / 255, low], dim=1).half()
+    # encode against the rounded scale and bias, the ones decoding uses. A constant row has scale 0 and is its bias
+    scale, bias = scale_bias.float().unbind(dim=1)
+    codes = ((weight - bias[:, None]) / scale.clamp_min(torch.finfo(torch.float32).tiny)[:, None]).round_()
+    return codes.clamp_(0, 255).to(torch.uint8), scale_bias
+
+
+def dequantize_rowwise(codes, scale_bias):
+    """float32 rows of ``quantize_rowwise`` output; `codes` and `scale_bias` may carry leading lookup dimensions."""
+    scale_bias = scale_bias.float()
+    return torch.addcmul(scale_bias[..., 1:], codes.float(), scale_bias[..., :1])
+
+
+class QuantizedEmbedding(nn.Module):
+    """Drop-in for ``nn.Embedding`` in ``embedding_dict`` storing its rows in `dtype`.
+
+    ``"bf16"`` keeps a bfloat16 ``weight`` parameter, trained as usual (bfloat16 has the range of float32, so the
+    optimizers work unchanged). ``"fp16"`` keeps a float16 ``weight`` buffer and ``"int8"`` uint8 ``codes`` with a
+    float16 scale and bias per row (``scale_bias``); both are frozen, Adam's epsilon alone underflows in float16.
+
+    Args:
+        num_embeddings: int, number of rows
+        embedding_dim: int, width of the rows
+        dtype: str, ``"bf16"``, ``"fp16"`` or ``"int8"``
+        sparse: bool, as ``nn.Embedding.sparse``, used by ``"bf16"`` tables
+        device: str, device of the table
+    """
+
+    def __init__(self, num_embeddings, embedding_dim, dtype="int8", sparse=False, device="cpu"):
+        super(QuantizedEmbedding, self).__init__()
+        if dtype not in STORAGE_DTYPES:
+            raise ValueError("dtype must be one of %s" % list(STORAGE_DTYPES))
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.dtype = dtype
+        self.sparse = sparse
+        shape = (num_embeddings, embedding_dim)
+        if dtype == "bf16":
+            self.weight = nn.Parameter(torch.zeros(shape, dtype=torch.bfloat16, device=device))
+        elif dtype == "fp16":
+            self.register_buffer("weight", torch.zeros(shape, dtype=torch.float16, device=device))
+        else:
+            self.register_buffer("codes", torch.zeros(shape, dtype=torch.uint8, device=device))
+            self.register_buffer("scale_bias", torch.zeros(num_embeddings, 2, dtype=torch.float16, device=device))
+
+    @classmethod
+    def from_embedding(cls, embedding, dtype="int8"):
+        """Quantized copy of the weights of an ``nn.Embedding``."""
+        weight = embedding.weight.detach()
+        module = cls(weight.shape[0], weight.shape[1], dtype=dtype, sparse=embedding.sparse, device=weight.device)
+        module.load_weight(weight)
+        return module
+
+    @property
+    def trainable(self):
+        return self.dtype == "bf16"
+
+    def load_weight(self, weight):
+        """Quantize the float rows `weight` into the table."""
+        with torch.no_grad():
+            if self.dtype == "int8":
+                codes, scale_bias = quantize_rowwise(weight)
+                self.codes.copy_(codes)
+                self.scale_bias.copy_(scale_bias)
+            else:
+                self.weight.copy_(weight)
+
+    def dequantize(self):
+        """The whole table in float32."""
+        if self.dtype == "int8":
+            return dequantize_rowwise(self.codes, self.scale_bias)
+        return self.weight.float()
+
+    def forward(self, ids):
+        if self.dtype == "int8":
+            return dequantize_rowwise(F.embedding(ids, self.codes), F.embedding(ids, self.scale_bias))
+        return F.embedding(ids, self.weight, sparse=self.sparse and self.trainable).float()
+
+    def extra_repr(self):
+        return "%d, %d, dtype=%s" % (self.num_embeddings, self.embedding_dim, self.dtype)
@@ -1,3 +1,5 @@
+import copy
+import io
 import logging
 import random
 from time import time
@@ -13,11 +15,30 @@ from utils import logCof
 # from models import MF, SmoothAUCLoss, BPR
 from deepctr_torch.inputs import SparseFeat, DenseFeat, get_feature_names
 from deepctr_torch.models import DeepFM
+from deepctr_torch.data import NegativeSampler
+from deepctr_torch.dataset_cache import load_dataset
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "4"
 current_time = datetime.now().strftime('%Y%m%d%H%M%S')
 
 
+def checkpoint_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def quantization_parity(model, dataset, feature_names, dtype, eval_result):
+    # 量化 embedding 后在测试集上重新评估，和 fp32 的结果逐项对比
+    quantized = copy.deepcopy(model).quantize_embeddings(dtype)
+    quantized_result = quantized.test_personal(dataset.features("test", feature_names), dataset.labels("test"))
+    for name, values in quantized_result.items():
+        logger.warning("%s %s: %s (fp32 %s)" % (dtype, name, values, eval_result[name]))
+    logger.warning("checkpoint size: fp32 %d bytes, %s %d bytes" % (checkpoint_size(model), dtype,
+                                                                    checkpoint_size(quantized)))
+    return quantized
+
+
 def main(args):
     # items_data = pd.read_csv(os.path.join(args["datadir"], "items_info.csv"))
 
@@ -47,23 +68,32 @@ def main(args):
                    dnn_use_bn=True,
                    # use_fm=False,
                    )
+    if args["fuse_embeddings"]:
+        # 所有 embedding 表（含线性部分）合成一张表，每次前向只做一次查表
+        model.fuse_embeddings()
+    if args["embedding_cache_dir"]:
+        # 超大的 embedding 表放在磁盘上，设备上只保留热点行
+        model.cache_embeddings(args["embedding_cache_dir"], args["embedding_cache_capacity"])
     model.compile('smooth_auc_loss_lambda', metrics=["binary_crossentropy", 'auc_personal'])
+    # csv/pickle 只在第一次运行时解析，之后直接 memory-map 编译好的二进制列
+    dataset = load_dataset(args["datadir"], cache_dir=args["cache_dir"])
 
     if not args["only_test"]:
 
-        train_data = pd.read_csv(os.path.join(args["datadir"], "train_data1.csv"))
-        val_data = pd.read_csv(os.path.join(args["datadir"], "val_data.csv"))
-        train3 = pd.read_pickle(os.path.join(args["datadir"], "train3.pickle"))["train_data3_user_list"]
-        train_data.columns = ["userInt", "newsInt", "label"]
-        val_data.columns = ["userInt", "newsInt", "label"]
+        train_index = dataset.interaction_index()
+        neg_sampler = NegativeSampler(train_index, args["items_num"], mode=args["neg_mode"], neg_ratio=args["neg_ratio"],
+                                      seed=args["seed"])
 
         callback = EarlyStopping(monitor="val_auc_personal", patience=10, verbose=1, mode="max") # patience=10
         logger.warning("*****************************        Start Training     ******************************")
-        history, best_val_score, best_model_params = model.fit_SAUC_Lambda(logger, train3, train_data[[name for name in feature_names] + ["label"]],
+        history, best_val_score, best_model_params = model.fit_SAUC_Lambda(logger, train_index,
                                               batch_size=args["batch_size"], epochs=args["epochs"], verbose=1,
-                                              validation_data=[{name: val_data.drop(columns=["label"])[name] for name in feature_names}, val_data.label.values],
+                                              validation_data=[dataset.features("val", feature_names), dataset.labels("val")],
                                               callbacks=[callback],
-                                              shuffle=True, tau=args["tau"], lr=args["lr"])
+                                              shuffle=True, tau=args["tau"], lr=args["lr"], neg_sampler=neg_sampler,
+                                              num_workers=args["num_workers"], pair_tile_size=args["pair_tile_size"],
+                                              sparse_embedding=args["sparse_embedding"],
+                                              embedding_regularization=args["embedding_regularization"])
         nni.report_final_result(best_val_score)
         # save model
         dirname = os.path.dirname(os.path.abspath(args["model_path"]))
@@ -72,22 +102,24 @@ def main(args):
         torch.save(best_model_params, os.path.join(dirname, model_name))
         # print("*****************************        Start Testing     ******************************")
         logger.warning("*****************************        Start Testing     ******************************")
-        test_data = pd.read_csv(os.path.join(args["datadir"], "test_data.csv"))
-        test_data.columns = ["userInt", "newsInt", "label"]
-        eval_result = model.test_personal({name: test_data.drop(columns=["label"])[name] for name in feature_names}, test_data.label.values)
+        eval_result = model.test_personal(dataset.features("test", feature_names), dataset.labels("test"))
         for name, values in eval_result.items():
             # print(name, values)
             logger.warning(name + ' ' + str(values))
+        if args["embedding_dtype"]:
+            quantized = quantization_parity(model, dataset, feature_names, args["embedding_dtype"], eval_result)
+            torch.save(quantized.state_dict(),
+                       os.path.join(dirname, model_name[:-len(".pt")] + "_" + args["embedding_dtype"] + ".pt"))
     else:
         print('**'*30 + 'Loading best model from local' + '**'*30)
         test_model_name = "CiteULike_DeepFM_SAUC_20220927173548_tau_0.02_0.900003.pt"
-        test_data = pd.read_csv(os.path.join(args["datadir"], "test_data.csv"))
-        test_data.columns = ["userInt", "newsInt", "label"]
         model_dict = model.load_state_dict(torch.load(os.path.join("../saved_models", test_model_name)))
         print("test on model:   ", test_model_name)
-        eval_result = model.test_personal({name: test_data.drop(columns=["label"])[name] for name in feature_names}, test_data.label.values)
+        eval_result = model.test_personal(dataset.features("test", feature_names), dataset.labels("test"))
         for name, values in eval_result.items():
             print(name, values)
+        if args["embedding_dtype"]:
+            quantization_parity(model, dataset, feature_names, args["embedding_dtype"], eval_result)
 
 
 def get_default_parameters():
@@ -114,11 +146,24 @@ if __name__ == '__main__':
             "current_time": current_time,
             "project_name": "CiteULike_DeepFM_SAUC_Lambda",
             "datadir": "/data/lfyuan/Datasets/CiteULike/",
+            "cache_dir": None,
             "dataset": 'CiteULike',
             "seed": 0,
             "cuda": 0,
             "tau": 0.1,
+            # negative sampling
+            "items_num": 16980,
+            "neg_mode": "uniform",
+            "neg_ratio": 1,
+            "num_workers": 2,
+            # 每块 pair 数上限（含填充），None 时块的大小不设上限
+            "pair_tile_size": 1 << 17,
             # train
+            "fuse_embeddings": False,
+            "sparse_embedding": False,
+            "embedding_regularization": None,
+            "embedding_cache_dir": None,
+            "embedding_cache_capacity": 1000000,
             "lr": 0.005,
             "dropout": 0.9,
             "batch_size": 2000,
@@ -126,7 +171,9 @@ if __name__ == '__main__':
             # save
             "model_path": "../saved_models/xxx.pt",
             # test
-            "only_test": False
+            "only_test": False,
+            # "bf16"/"fp16"/"int8": 测试后把 embedding 量化，对比 fp32 的指标并另存量化后的模型
+            "embedding_dtype": None
         }
 
     # device = "cpu"
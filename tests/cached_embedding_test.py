@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import torch
+
+from deepctr_torch.cached_embedding import CachedEmbedding
+
+# (query ids, history ids) of three training steps, each looking the table up twice as DIN does
+STEPS = [([0, 1], [0, 1]), ([2, 3], [4, 5]), ([6, 7], [0, 1])]
+
+
+def train(embedding, steps=STEPS):
+    optim = torch.optim.SGD(embedding.parameters(), lr=1.)
+    if isinstance(embedding, CachedEmbedding):
+        embedding.register_optimizer(optim)
+    for query, history in steps:
+        optim.zero_grad()
+        loss = 2 * embedding(torch.tensor(query)).sum() + 3 * embedding(torch.tensor(history)).sum()
+        loss.backward()
+        optim.step()
+
+
+@pytest.mark.parametrize("policy", ["lru", "lfu"])
+def test_second_lookup_keeps_the_rows_of_the_first(tmp_path, policy):
+    reference = torch.nn.Embedding(10, 3)
+    cached = CachedEmbedding.from_embedding(reference, str(tmp_path / "table.npy"), 4, policy=policy)
+    train(cached)
+    train(reference)
+    cached.flush()
+    assert np.allclose(np.load(cached.path), reference.weight.detach().numpy())
+
+
+def test_training_step_over_capacity(tmp_path):
+    cached = CachedEmbedding.from_embedding(torch.nn.Embedding(10, 3), str(tmp_path / "table.npy"), 3)
+    with pytest.raises(ValueError):
+        train(cached, [([0, 1], [2, 3])])
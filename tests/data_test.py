@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from deepctr_torch.data import UserInteractionIndex, NegativeSampler, SAUCBatchDataset
+
+NUM_ITEMS = 50
+
+
+def make_index(seed=0, num_users=40):
+    rng = np.random.default_rng(seed)
+    # a few users own most of the items, so their negatives are redrawn often
+    lengths = np.where(np.arange(num_users) % 10 == 0, NUM_ITEMS // 2, rng.integers(1, 8, size=num_users))
+    users = np.repeat(np.arange(num_users) * 7, lengths)
+    items = np.concatenate([rng.choice(NUM_ITEMS, size=n, replace=False) for n in lengths])
+    return UserInteractionIndex.from_interactions(users, items)
+
+
+@pytest.mark.parametrize("mode", ["uniform", "popularity"])
+@pytest.mark.parametrize("neg_ratio", [1, 3])
+def test_negative_sampler_never_returns_a_positive(mode, neg_ratio):
+    index = make_index()
+    sampler = NegativeSampler(index, NUM_ITEMS, mode=mode, neg_ratio=neg_ratio, seed=0)
+    for _ in range(5):
+        rows = np.random.default_rng(1).permutation(len(index))
+        neg_items, neg_lengths = sampler.sample(rows)
+        assert neg_lengths.tolist() == np.maximum(index.lengths.numpy()[rows] * neg_ratio, 1).tolist()
+        neg_rows = np.repeat(rows, neg_lengths.numpy())
+        for row, item in zip(neg_rows, neg_items.tolist()):
+            assert item not in set(index.positives(row).tolist())
+            assert 0 <= item < NUM_ITEMS
+
+
+def collect(dataset, num_workers, epoch):
+    dataset.set_epoch(epoch)
+    loader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
+    return [[tensor.clone() for tensor in batch] for batch in loader]
+
+
+@pytest.mark.parametrize("source_rows", [False, True])
+def test_sauc_batches_do_not_depend_on_num_workers(source_rows):
+    index = make_index()
+    runs = {}
+    for num_workers in (0, 2, 3):
+        dataset = SAUCBatchDataset(index, NegativeSampler(index, NUM_ITEMS, seed=num_workers), batch_size=6,
+                                   seed=2024, source_rows=source_rows)
+        runs[num_workers] = [collect(dataset, num_workers, epoch) for epoch in range(2)]
+
+    assert len(runs[0][0]) == len(dataset)
+    assert not all(torch.equal(a, b) for a, b in zip(runs[0][0][0], runs[0][1][0]))
+    for num_workers in (2, 3):
+        for epoch in range(2):
+            assert len(runs[num_workers][epoch]) == len(runs[0][epoch])
+            for batch, expected in zip(runs[num_workers][epoch], runs[0][epoch]):
+                assert all(torch.equal(a, b) for a, b in zip(batch, expected))
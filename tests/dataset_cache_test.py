@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from deepctr_torch.data import UserInteractionIndex
+from deepctr_torch.dataset_cache import load_dataset, DEFAULT_TABLES, DEFAULT_USER_LIST
+
+USER_LIST = [(0, 0, 3), (1, 5, 9), (2, 12, 14)]
+
+
+def write_dataset(datadir):
+    rng = np.random.default_rng(0)
+    for file_name in DEFAULT_TABLES.values():
+        pd.DataFrame({"userInt": np.sort(rng.integers(0, 3, 20)), "newsInt": rng.integers(0, 50, 20),
+                      "label": 1}).to_csv(datadir / file_name, index=False)
+    pd.to_pickle({"train_data3_user_list": USER_LIST}, datadir / DEFAULT_USER_LIST)
+
+
+def test_interaction_index_keeps_source_rows(tmp_path):
+    write_dataset(tmp_path)
+    index = load_dataset(str(tmp_path)).interaction_index()
+    expected = UserInteractionIndex.from_user_list(USER_LIST, pd.read_csv(tmp_path / DEFAULT_TABLES["train"]))
+    for name in ("user_ids", "indptr", "items", "source_rows"):
+        assert torch.equal(getattr(index, name), getattr(expected, name))
+    assert index.source_rows.tolist() == [0, 1, 2, 5, 6, 7, 8, 12, 13]
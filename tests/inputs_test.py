@@ -0,0 +1,25 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from deepctr_torch.inputs import SparseFeat, VarLenSparseFeat, build_input_features, pooled_varlen_embedding_list
+
+
+@pytest.mark.parametrize("combiner", ["sum", "mean", "max"])
+def test_pooling_of_sparse_tables(combiner):
+    feat = VarLenSparseFeat(SparseFeat("hist", 10, embedding_dim=4), maxlen=4, combiner=combiner)
+    feature_index = build_input_features([feat])
+    X = torch.tensor([[1, 2, 3, 0], [4, 0, 0, 0], [0, 0, 0, 0]], dtype=torch.float32)
+
+    pooled = {}
+    for sparse in (False, True):
+        torch.manual_seed(0)
+        embedding = nn.Embedding(10, 4, sparse=sparse)
+        pooled[sparse] = pooled_varlen_embedding_list(X, {"hist": embedding}, feature_index, [feat])[0]
+        pooled[sparse].sum().backward()
+        assert embedding.weight.grad.is_sparse == sparse
+        pooled[sparse, "grad"] = embedding.weight.grad.to_dense()
+
+    assert torch.allclose(pooled[True], pooled[False])
+    assert torch.allclose(pooled[True, "grad"], pooled[False, "grad"])
+    assert torch.equal(pooled[True][2], torch.zeros(1, 4))
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from deepctr_torch.models.basemodel import SmoothAUCLossLambda, PairSegments
+
+TAU = 0.1
+
+
+def per_user_loss(sui, suj, tau=TAU):
+    """The per-user SAUC-Lambda loss of the original training loop, with its dense rank-gap matrix."""
+    sui = sui.reshape(-1, 1)
+    suj = suj.reshape(1, -1)
+    pos_neg_mat = torch.sigmoid((sui - suj) / tau)
+    _, idx = torch.cat([sui.reshape(-1), suj.reshape(-1)]).sort()
+    _, rank = idx.sort()
+    k = sui.shape[0]
+    lambda_weight = (torch.abs(rank[:k].reshape(-1, 1) - rank[k:].reshape(1, -1)) / (k * suj.shape[1])).detach()
+    return (1 - torch.mean(pos_neg_mat * lambda_weight), - torch.sum(pos_neg_mat * lambda_weight),
+            1 - torch.sum(pos_neg_mat) / (k * suj.shape[1]))
+
+
+def batch():
+    generator = torch.Generator().manual_seed(0)
+    pos_lengths = torch.randint(1, 40, (30,), generator=generator)
+    pos_lengths[3] = 90  # a heavy user, cut into tiles of its own
+    neg_lengths = torch.randint(1, 40, (30,), generator=generator)
+    pos_pred = torch.randn(int(pos_lengths.sum()), generator=generator, dtype=torch.float64)
+    neg_pred = torch.randn(int(neg_lengths.sum()), generator=generator, dtype=torch.float64)
+    return pos_pred, neg_pred, pos_lengths, neg_lengths
+
+
+@pytest.mark.parametrize("tile_size", [None, 7, 1000])
+def test_segment_forward_matches_per_user_loss(tile_size):
+    pos_pred, neg_pred, pos_lengths, neg_lengths = batch()
+
+    pos_ref, neg_ref = pos_pred.clone().requires_grad_(), neg_pred.clone().requires_grad_()
+    expected = [torch.stack(losses) for losses in zip(*[
+        per_user_loss(sui, suj) for sui, suj in zip(torch.split(pos_ref, pos_lengths.tolist()),
+                                                    torch.split(neg_ref, neg_lengths.tolist()))])]
+    sum(loss.sum() * weight for loss, weight in zip(expected, (1., 2., 3.))).backward()
+
+    pos, neg = pos_pred.clone().requires_grad_(), neg_pred.clone().requires_grad_()
+    losses = SmoothAUCLossLambda().segment_forward(pos, neg, pos_lengths, neg_lengths, tau=TAU, tile_size=tile_size)
+    sum(loss.sum() * weight for loss, weight in zip(losses, (1., 2., 3.))).backward()
+
+    for loss, loss_ref in zip(losses, expected):
+        assert torch.allclose(loss, loss_ref)
+    assert torch.allclose(pos.grad, pos_ref.grad)
+    assert torch.allclose(neg.grad, neg_ref.grad)
+
+
+def test_forward_of_one_user():
+    pos_pred, neg_pred, pos_lengths, neg_lengths = batch()
+    sui, suj = pos_pred[:int(pos_lengths[0])], neg_pred[:int(neg_lengths[0])]
+    for loss, loss_ref in zip(SmoothAUCLossLambda()(sui, suj, tau=TAU), per_user_loss(sui, suj)):
+        assert torch.allclose(loss, loss_ref)
+
+
+@pytest.mark.parametrize("tile_size", [None, 7, 1000])
+def test_pair_blocks_cover_the_real_pairs(tile_size):
+    _, _, pos_lengths, neg_lengths = batch()
+    pairs = PairSegments(pos_lengths, neg_lengths, tile_size)
+    covered = torch.zeros_like(pos_lengths)
+    padded = 0
+    for users, pos_positions, neg_positions in pairs.blocks:
+        block_pairs = len(users) * len(pos_positions) * len(neg_positions)
+        assert tile_size is None or block_pairs <= tile_size
+        padded += block_pairs
+        covered.index_add_(0, users, (torch.clamp(pos_lengths[users] - pos_positions[0], 0, len(pos_positions)) *
+                                      torch.clamp(neg_lengths[users] - neg_positions[0], 0, len(neg_positions))))
+    assert torch.equal(covered, pos_lengths * neg_lengths)
+    assert padded <= 2 * int((pos_lengths * neg_lengths).sum())
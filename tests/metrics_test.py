@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from deepctr_torch.inputs import SparseFeat, get_feature_names
+from deepctr_torch.metrics import segment_ranking_metrics, mean_over_users
+from deepctr_torch.models import DeepFM
+
+# three slates; the last one has no positive
+LABELS = np.array([1, 0, 0, 0, 1, 0, 0, 0])
+SCORES = np.array([0.9, 0.1, 0.2, 0.3, 0.8, 0.7, 0.4, 0.6])
+OFFSETS = np.array([0, 3, 6, 8])
+
+
+def test_degenerate_slate_is_undefined():
+    metrics = segment_ranking_metrics(LABELS, SCORES, OFFSETS)
+    assert metrics["auc"][:2].tolist() == [1., 1.]
+    assert np.isnan(metrics["auc"][2])
+
+
+@pytest.mark.parametrize("last_label", [0, 1])
+def test_mean_over_users_drops_degenerate_slates(last_label):
+    labels = LABELS.copy()
+    labels[6:] = last_label
+    metrics = segment_ranking_metrics(labels, SCORES, OFFSETS)
+    means, dropped = mean_over_users(metrics)
+    assert dropped == 1
+    assert means["auc"] == 1.
+    for name in ("auc", "mrr", "recall", "map", "ndcg"):
+        assert np.all(np.isfinite(means[name]))
+        assert np.allclose(means[name], metrics[name][:2].mean(axis=0))
+
+
+def test_mean_over_users_without_defined_slate():
+    with pytest.raises(ValueError):
+        mean_over_users(segment_ranking_metrics(np.zeros(3), SCORES[:3], np.array([0, 3])))
+
+
+def test_evaluate_personal_with_degenerate_slate():
+    feature_columns = [SparseFeat("userInt", 3, embedding_dim=4), SparseFeat("newsInt", 8, embedding_dim=4)]
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(4,))
+    model.compile("smooth_auc_loss_lambda", metrics=["auc_personal"])
+    x = {"userInt": np.repeat([0, 1, 2], np.diff(OFFSETS)), "newsInt": np.arange(8)}
+    x = {name: x[name] for name in get_feature_names(feature_columns)}
+
+    result = model.evaluate_personal(x, LABELS, slate_offsets=OFFSETS)
+    assert np.isfinite(result["auc_personal"])
+    assert result["dropped_users"] == 1
+
+    result = model.test_personal(x, LABELS, slate_offsets=OFFSETS)
+    assert all(np.all(np.isfinite(result[name])) for name in ("auc_personal", "mrr", "NDCG", "recall 2 4 6 8 10"))
+    assert result["dropped_users"] == 1
+
+
+def test_personal_metrics_match_the_legacy_loop():
+    num_users = 6
+    feature_columns = [SparseFeat("userInt", num_users, embedding_dim=4),
+                       SparseFeat("newsInt", num_users * 101, embedding_dim=4)]
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(4,), init_std=0.1)
+    model.compile("smooth_auc_loss_lambda", metrics=["auc_personal"])
+    # every user's slate of 101 distinct items, positive first, so no two scores of a slate tie
+    x = {"userInt": np.repeat(np.arange(num_users), 101), "newsInt": np.arange(num_users * 101)}
+    # make the positive of user u the item it ranks u-th, so the top-K metrics are not all zero
+    order = np.argsort(-model.predict(x).reshape(-1, 101), axis=1)
+    items = x["newsInt"].reshape(-1, 101)
+    for u in range(num_users):
+        items[u, [0, order[u, u]]] = items[u, [order[u, u], 0]]
+    x = {name: x[name] for name in get_feature_names(feature_columns)}
+    y = np.tile(np.r_[1, np.zeros(100)], num_users)
+
+    slates = model.predict(x).reshape(-1, 101)
+    assert np.argsort(-slates, axis=1)[np.arange(num_users), np.arange(num_users)].tolist() == [0] * num_users
+    label = np.r_[1, np.zeros(100, dtype=np.int64)]
+    legacy = [model.map_recall_at_k_multileveltobinary(label, scores, [2, 4, 6, 8, 10]) for scores in slates]
+    auc = np.mean([np.sum(scores[1:] < scores[0]) / 100 for scores in slates])
+    ndcg = np.mean([model.normalized_discounted_cumulative_gain_matrix(label, scores, 10) for scores in slates], axis=0)
+
+    assert np.isclose(model.evaluate_personal(x, y)["auc_personal"], auc)
+    result = model.test_personal(x, y)
+    assert np.isclose(result["auc_personal"], auc)
+    assert np.allclose(result["recall 2 4 6 8 10"], np.mean([r[0] for r in legacy], axis=0))
+    assert np.allclose(result["map 2 4 6 8 10"], np.mean([r[1] for r in legacy], axis=0))
+    assert np.isclose(result["mrr"], np.mean([r[2] for r in legacy]))
+    assert np.allclose(result["NDCG"], ndcg)
+    assert result["dropped_users"] == 0
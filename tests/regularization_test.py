@@ -0,0 +1,36 @@
+import torch
+
+from deepctr_torch.inputs import SparseFeat, DenseFeat
+from deepctr_torch.models import DeepFM
+
+
+def term_by_term_loss(model):
+    """The regularization loss as the training loop computed it weight by weight."""
+    total = torch.zeros((1,))
+    for weight_list, l1, l2 in model.regularization_weight:
+        for w in weight_list:
+            parameter = w[1] if isinstance(w, tuple) else w
+            if l1 > 0:
+                total += torch.sum(l1 * torch.abs(parameter))
+            if l2 > 0:
+                total += torch.sum(l2 * torch.square(parameter))
+    return total
+
+
+def test_full_regularization_keeps_the_term_by_term_numbers():
+    feature_columns = [SparseFeat("s%d" % i, 20, embedding_dim=4) for i in range(3)] + [DenseFeat("d", 1)]
+    model = DeepFM(feature_columns, feature_columns, dnn_hidden_units=(8, 4), l2_reg_dnn=1e-3)
+    # coefficient pairs that repeat, but not next to each other
+    model.add_regularization_weight(model.dnn.linears[0].weight, l1=1e-4, l2=1e-5)
+    model.add_regularization_weight(model.dnn_linear.weight, l2=1e-3)
+    model.add_regularization_weight(model.dnn.linears[1].weight, l1=1e-4, l2=1e-5)
+
+    loss = model.get_regularization_loss()
+    expected = term_by_term_loss(model)
+    assert torch.equal(loss, expected)
+
+    grads = torch.autograd.grad(loss, list(model.parameters()), allow_unused=True)
+    expected_grads = torch.autograd.grad(expected, list(model.parameters()), allow_unused=True)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert (grad is None) == (expected_grad is None)
+        assert grad is None or torch.equal(grad, expected_grad)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from deepctr_torch.layers.sequence import AttentionSequencePoolingLayer
+
+
+@pytest.mark.parametrize("activation", ["Dice", "relu"])
+@pytest.mark.parametrize("weight_normalization", [False, True])
+@pytest.mark.parametrize("return_score", [False, True])
+def test_chunked_attention_matches_full_history(activation, weight_normalization, return_score):
+    torch.manual_seed(0)
+    query = torch.randn(8, 1, 4, dtype=torch.float64)
+    keys = torch.randn(8, 50, 4, dtype=torch.float64)
+    keys_length = torch.randint(0, 51, (8, 1))
+    layers = [AttentionSequencePoolingLayer(att_hidden_units=(8, 4), att_activation=activation,
+                                            weight_normalization=weight_normalization, return_score=return_score,
+                                            chunk_size=chunk_size).double() for chunk_size in (None, 16)]
+    layers[1].load_state_dict(layers[0].state_dict())
+
+    results = []
+    for layer in layers:
+        layer_keys = keys.clone().requires_grad_()
+        outputs = layer(query, layer_keys, keys_length)
+        (outputs ** 2).sum().backward()
+        results.append([outputs, layer_keys.grad] + [param.grad for param in layer.parameters()] +
+                       list(layer.buffers()))
+    for full, chunked in zip(*results):
+        assert torch.allclose(full.double(), chunked.double(), atol=1e-10)